@@ -0,0 +1,87 @@
+import argparse
+import sys
+
+from lib.benchmarks import load_queries, expand_queries, wand_benchmark, postings_benchmark, build_benchmark, matrix_benchmark, quantization_benchmark, ivf_benchmark, hnsw_benchmark, startup_benchmark
+from lib.search_utils import BINARY_RESCORE, DEFAULT_SEARCH_LIMIT, HNSW_M, HNSW_EF_CONSTRUCTION
+
+def main():
+    parser = argparse.ArgumentParser(description="Search Benchmark CLI")
+    subparsers = parser.add_subparsers(dest="command", help="Available commands")
+
+    wand_parser = subparsers.add_parser("wand", help="Compare exhaustive BM25 with WAND pruning")
+    wand_parser.add_argument("--queries", type=str, help="File with one query per line (golden dataset queries by default)")
+    wand_parser.add_argument("--expand", action="store_true", help="Expand the queries with the LLM first")
+    wand_parser.add_argument("--limit", type=int, default=DEFAULT_SEARCH_LIMIT, help="How many top documents should be retrieved")
+
+    postings_parser = subparsers.add_parser("postings", help="Compare the compressed index segment with the pickled sets layout")
+    postings_parser.add_argument("--queries", type=str, help="File with one query per line (golden dataset queries by default)")
+
+    build_parser = subparsers.add_parser("build", help="Time the parallel index build for 1..N workers")
+    build_parser.add_argument("--max-workers", type=int, default=4, help="Highest number of worker processes to time")
+
+    matrix_parser = subparsers.add_parser("matrix", help="Compare BM25 throughput of the postings and the sparse matrix backends")
+    matrix_parser.add_argument("--queries", type=str, help="File with one query per line (golden dataset queries by default)")
+    matrix_parser.add_argument("--limit", type=int, default=DEFAULT_SEARCH_LIMIT, help="How many top documents should be retrieved")
+    matrix_parser.add_argument("--repeat", type=int, default=20, help="How many times the query list is run")
+
+    quantization_parser = subparsers.add_parser("quantization", help="Recall and memory of quantized and binary embeddings against exact float32 search")
+    quantization_parser.add_argument("--queries", type=str, help="File with one query per line (golden dataset queries by default)")
+    quantization_parser.add_argument("--limit", type=int, default=DEFAULT_SEARCH_LIMIT, help="How many top documents should be retrieved")
+    quantization_parser.add_argument("--rescore", type=int, default=50, help="How many top candidates are rescored with float32 embeddings (0: no rescoring)")
+    quantization_parser.add_argument("--binary-rescore", type=int, nargs="+", default=[100, BINARY_RESCORE, 1000], help="Candidates of the binary Hamming scan rescored with float32 embeddings")
+
+    ivf_parser = subparsers.add_parser("ivf", help="Recall and latency of the IVF chunk index for several nprobe values")
+    ivf_parser.add_argument("--queries", type=str, help="File with one query per line (golden dataset queries by default)")
+    ivf_parser.add_argument("--limit", type=int, default=DEFAULT_SEARCH_LIMIT, help="How many top chunks should be retrieved")
+    ivf_parser.add_argument("--nprobe", type=int, nargs="+", default=[1, 2, 4, 8, 16, 32], help="nprobe values to measure")
+    ivf_parser.add_argument("--nlist", type=int, help="Number of IVF lists (about 4 * sqrt(chunks) by default; the index is rebuilt when it differs)")
+
+    hnsw_parser = subparsers.add_parser("hnsw", help="Recall and latency of the HNSW movie and chunk graphs for several efSearch values")
+    hnsw_parser.add_argument("--queries", type=str, help="File with one query per line (golden dataset queries by default)")
+    hnsw_parser.add_argument("--limit", type=int, default=DEFAULT_SEARCH_LIMIT, help="How many top results should be retrieved")
+    hnsw_parser.add_argument("--ef-search", type=int, nargs="+", default=[16, 32, 64, 128, 256], help="efSearch values to measure")
+    hnsw_parser.add_argument("--m", type=int, default=HNSW_M, help="Links per node (the graphs are rebuilt when it differs)")
+    hnsw_parser.add_argument("--ef-construction", type=int, default=HNSW_EF_CONSTRUCTION, help="Candidates kept while building (the graphs are rebuilt when it differs)")
+
+    startup_parser = subparsers.add_parser("startup", help="Startup time and heavy imports of every CLI subcommand")
+    startup_parser.add_argument("clis", type=str, nargs="*", help="CLI scripts to measure (every *_cli.py by default)")
+    startup_parser.add_argument("--runs", type=int, default=3, help="How many times every subcommand is started (the best time is reported)")
+    startup_parser.add_argument("--budget-ms", type=float, help="Exit with status 1 when a subcommand takes longer than this to run")
+
+    args = parser.parse_args()
+
+    match args.command:
+        case "wand":
+            queries = load_queries(args.queries)
+            if args.expand:
+                queries = expand_queries(queries)
+            wand_benchmark(queries, args.limit)
+
+        case "postings":
+            postings_benchmark(load_queries(args.queries))
+
+        case "build":
+            build_benchmark(args.max_workers)
+
+        case "matrix":
+            matrix_benchmark(load_queries(args.queries), args.limit, args.repeat)
+
+        case "quantization":
+            quantization_benchmark(load_queries(args.queries), args.limit, args.rescore, args.binary_rescore)
+
+        case "ivf":
+            ivf_benchmark(load_queries(args.queries), args.limit, args.nprobe, args.nlist)
+
+        case "hnsw":
+            hnsw_benchmark(load_queries(args.queries), args.limit, args.ef_search, args.m, args.ef_construction)
+
+        case "startup":
+            if not startup_benchmark(args.clis, args.runs, args.budget_ms):
+                sys.exit(1)
+
+        case _:
+            parser.print_help()
+
+
+if __name__ == "__main__":
+    main()
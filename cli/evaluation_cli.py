@@ -1,8 +1,9 @@
 import argparse
 import json
 
-from lib.search_utils import GOLDEN_DATASET_PATH, DEFAULT_RRF_K
+from lib.search_utils import GOLDEN_DATASET_PATH, DEFAULT_RRF_K, EMBEDDING_MODEL_NAME
 from lib.hybrid_search import rrf_search
+from lib.query_cache import get_query_cache
 
 
 def main():
@@ -52,5 +53,8 @@ def main():
         print(f"  - Retrieved: {", ".join(retrieved)}")
         print(f"  - Relevant: {", ".join(relevant)}")
 
+    cache_info = get_query_cache(EMBEDDING_MODEL_NAME).cache_info()
+    print(f"\nQuery embedding cache: {cache_info['memory_hits']} memory hits, {cache_info['disk_hits']} disk hits, {cache_info['misses']} misses")
+
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -1,16 +1,17 @@
 import argparse
+import json
 
 from lib.hybrid_search import (
     normalize,
     weighted_search,
     rrf_search,
-    rerank_cross_encoder
+    rerank_cross_encoder,
+    batch_search
 )
 
+from lib.keyword_search import spell_command
 from lib.search_utils import DEFAULT_SEARCH_LIMIT, DEFAULT_ALPHA, DEFAULT_RRF_K
 
-from gemini_api import enhance, rerank_individual, rerank_batch, evaluate
-
 def main():
     parser = argparse.ArgumentParser(description="Hybrid Search CLI")
     subparsers = parser.add_subparsers(dest="command", help="Available commands")
@@ -22,15 +23,31 @@ def main():
     weighted_search_parser.add_argument("query", type=str, help="Search query")
     weighted_search_parser.add_argument("--alpha", type=float, default=DEFAULT_ALPHA, help="Weighting constant")
     weighted_search_parser.add_argument("--limit", type=int, default=DEFAULT_SEARCH_LIMIT, help="How many top documents should be shown")
+    weighted_search_parser.add_argument("--filter", type=str, help="Boolean keyword query (AND, OR, NOT) the results must match")
+    weighted_search_parser.add_argument("--keyword-backend", type=str, choices=["postings", "matrix", "bm25f"], default="postings", help="Score BM25 from the postings or from the precomputed BM25 matrix, or score title and description hits separately with BM25F")
+    weighted_search_parser.add_argument("--semantic-backend", type=str, choices=["flat", "ivf", "hnsw", "binary"], default="flat", help="Score every chunk embedding, only the probed lists of an IVF index, the chunks an HNSW graph walk finds, or the best chunks by Hamming distance of sign bits")
 
     rrf_search_parser = subparsers.add_parser("rrf-search", help="Reciprocal Rank Fusion search")
     rrf_search_parser.add_argument("query", type=str, help="Search query")
     rrf_search_parser.add_argument("-k", type=int, default=DEFAULT_RRF_K, help="Reciprocal Rank Fusion constant")
     rrf_search_parser.add_argument("--limit", type=int, default=DEFAULT_SEARCH_LIMIT, help="How many top documents should be shown")
-    rrf_search_parser.add_argument("--enhance", type=str, choices=["spell", "rewrite", "expand"], help="Query enhancement method")
+    rrf_search_parser.add_argument("--filter", type=str, help="Boolean keyword query (AND, OR, NOT) the results must match")
+    rrf_search_parser.add_argument("--keyword-backend", type=str, choices=["postings", "matrix", "bm25f"], default="postings", help="Score BM25 from the postings or from the precomputed BM25 matrix, or score title and description hits separately with BM25F")
+    rrf_search_parser.add_argument("--semantic-backend", type=str, choices=["flat", "ivf", "hnsw", "binary"], default="flat", help="Score every chunk embedding, only the probed lists of an IVF index, the chunks an HNSW graph walk finds, or the best chunks by Hamming distance of sign bits")
+    rrf_search_parser.add_argument("--enhance", type=str, choices=["spell", "local-spell", "rewrite", "expand"], help="Query enhancement method (local-spell corrects typos against the index vocabulary without an LLM call)")
     rrf_search_parser.add_argument("--rerank-method", type=str, choices=["individual", "batch", "cross_encoder"], help="Rerank method")
     rrf_search_parser.add_argument("--evaluate", action="store_true", help="Evaluate results with LLM")
 
+    batch_search_parser = subparsers.add_parser("batch-search", help="Search every query of a file (one per line) in batches and stream the results as JSON lines")
+    batch_search_parser.add_argument("queries", type=str, help="Path to a text file with one query per line")
+    batch_search_parser.add_argument("--method", type=str, choices=["bm25", "semantic", "weighted", "rrf"], default="rrf", help="Keyword, chunked semantic, weighted hybrid or Reciprocal Rank Fusion search")
+    batch_search_parser.add_argument("--limit", type=int, default=DEFAULT_SEARCH_LIMIT, help="How many top documents should be returned per query")
+    batch_search_parser.add_argument("--alpha", type=float, default=DEFAULT_ALPHA, help="Weighting constant of the weighted method")
+    batch_search_parser.add_argument("-k", type=int, default=DEFAULT_RRF_K, help="Reciprocal Rank Fusion constant of the rrf method")
+    batch_search_parser.add_argument("--filter", type=str, help="Boolean keyword query (AND, OR, NOT) the results of the hybrid methods must match")
+    batch_search_parser.add_argument("--keyword-backend", type=str, choices=["postings", "matrix", "bm25f"], default="matrix", help="Score BM25 from the postings or from the precomputed BM25 matrix (one sparse product per batch), or score title and description hits separately with BM25F")
+    batch_search_parser.add_argument("--semantic-backend", type=str, choices=["flat", "ivf", "hnsw", "binary"], default="flat", help="Score every chunk embedding, only the probed lists of an IVF index, the chunks an HNSW graph walk finds, or the best chunks by Hamming distance of sign bits")
+
     args = parser.parse_args()
 
     match args.command:
@@ -40,7 +57,7 @@ def main():
                 print(f"* {normalize_score:.4f}")
 
         case "weighted-search":
-            docs = weighted_search(args.query, args.alpha, args.limit)
+            docs = weighted_search(args.query, args.alpha, args.limit, args.filter, args.keyword_backend, args.semantic_backend)
             for i, item in enumerate(docs.items()):
                 title = item[1][3]
                 hybrid_score = item[1][2]
@@ -53,17 +70,25 @@ def main():
                 print(f"{description}\n")
 
         case "rrf-search":
-            if args.enhance:
+            if args.enhance == "local-spell":
+                enhanced_query = spell_command(args.query)
+                print(f"Enhanced query ({args.enhance}): '{args.query}' -> '{enhanced_query}'\n")
+                args.query = enhanced_query
+            elif args.enhance:
+                # the Gemini API (google.genai, dotenv) is only imported by the options that call it
+                from gemini_api import enhance
                 args.query = enhance(args.enhance, args.query)
             
             limit = args.limit * 5 if args.rerank_method else args.limit
 
-            docs = rrf_search(args.query, args.k, limit)
+            docs = rrf_search(args.query, args.k, limit, args.filter, args.keyword_backend, args.semantic_backend)
                 
             match args.rerank_method:
                 case "individual":
+                    from gemini_api import rerank_individual
                     docs = rerank_individual(docs, args.query)
                 case "batch":
+                    from gemini_api import rerank_batch
                     docs = rerank_batch(docs, args.query)
                 case "cross_encoder":
                     docs = rerank_cross_encoder(docs, args.query)
@@ -92,11 +117,16 @@ def main():
             # 3. Swiss Army Man: 0/3
             # 4. Disaster Movie: 0/3
             if args.evaluate:
+                from gemini_api import evaluate
                 score = evaluate(docs, args.query)
                 for i, item in enumerate(docs.items()):
                     title = item[1][3]
                     print(f"{i + 1}. {title}: {score[i]}/3")
 
+        case "batch-search":
+            for result in batch_search(args.queries, args.method, args.limit, args.alpha, args.k, args.filter, args.keyword_backend, args.semantic_backend):
+                print(json.dumps(result), flush=True)
+
         case _:
             parser.print_help()
 
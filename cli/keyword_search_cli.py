@@ -9,18 +9,41 @@ from lib.keyword_search import (
     get_tfidf,
     bm25_idf_command,
     bm25_tf_command,
-    get_bm25_search_command
+    get_bm25_search_command,
+    get_bm25f_search_command,
+    add_documents_command,
+    update_documents_command,
+    delete_documents_command,
+    merge_idx,
+    spell_command,
+    complete_command
 )
-from lib.search_utils import BM25_K1, BM25_B, DEFAULT_SEARCH_LIMIT
+from lib.search_utils import BM25_K1, BM25_B, BM25F_BOOSTS, DEFAULT_SEARCH_LIMIT, BUILD_BATCH_SIZE
 
 def main() -> None:
     parser = argparse.ArgumentParser(description="Keyword Search CLI")
     subparsers = parser.add_subparsers(dest="command", help="Available commands")
 
-    search_parser = subparsers.add_parser("search", help="Search movies using BM25")
-    search_parser.add_argument("query", type=str, help="Search query")
+    search_parser = subparsers.add_parser("search", help="Boolean search: AND, OR, NOT, (parentheses) and \"phrases\"")
+    search_parser.add_argument("query", type=str, help="Boolean query, adjacent words are ANDed")
+    search_parser.add_argument("--limit", type=int, default=DEFAULT_SEARCH_LIMIT, help="How many matching documents should be shown")
+    search_parser.add_argument("--rank", action="store_true", help="Rank the matches with BM25 instead of by ID")
 
-    subparsers.add_parser("build", help="Build inverted index from movies.json")
+    build_parser = subparsers.add_parser("build", help="Build inverted index from movies.json")
+    build_parser.add_argument("--workers", type=int, default=1, help="How many processes tokenize the movies in parallel")
+    build_parser.add_argument("--batch-size", type=int, default=BUILD_BATCH_SIZE, help="Movies indexed in memory before a run is spilled to disk")
+    build_parser.add_argument("--positions", action="store_true", help="Store token positions for phrase and proximity queries")
+
+    add_parser = subparsers.add_parser("add", help="Add new movies to the index without a rebuild")
+    add_parser.add_argument("path", type=str, help="JSON file with a \"movies\" list, same format as movies.json, or a JSONL file with one movie per line")
+
+    update_parser = subparsers.add_parser("update", help="Replace indexed movies with new versions")
+    update_parser.add_argument("path", type=str, help="JSON file with a \"movies\" list, same format as movies.json, or a JSONL file with one movie per line")
+
+    delete_parser = subparsers.add_parser("delete", help="Delete movies from the index")
+    delete_parser.add_argument("ids", type=int, nargs="+", help="document ids")
+
+    subparsers.add_parser("merge", help="Merge delta segments and deletions into a new base segment")
 
     tf_parser = subparsers.add_parser("tf", help="Term frequency in the document with the given ID")
     tf_parser.add_argument("id", type=int, help="document id")
@@ -43,41 +66,88 @@ def main() -> None:
     bm25_tf_parser.add_argument("b", type=float, nargs='?', default=BM25_B, help="Tunable BM25 b parameter")
 
     bm25search_parser = subparsers.add_parser("bm25search", help="Search movies using full BM25 scoring")
-    bm25search_parser.add_argument("query", type=str, help="Search query")
+    bm25search_parser.add_argument("query", type=str, help="Search query, \"quoted words\" must appear as a phrase")
     bm25search_parser.add_argument("--limit", type=int, default=DEFAULT_SEARCH_LIMIT, help="How many top documents should be shown")
+    bm25search_parser.add_argument("--pruning", type=str, choices=["wand"], help="Dynamic pruning method for top-k retrieval")
+    bm25search_parser.add_argument("--proximity", type=float, default=0.0, help="Weight of the boost for query terms appearing close together")
+    bm25search_parser.add_argument("--backend", type=str, choices=["postings", "matrix"], default="postings", help="Score from the postings or from the precomputed BM25 matrix")
+
+    bm25fsearch_parser = subparsers.add_parser("bm25fsearch", help="Search movies using BM25F, scoring title and description hits separately")
+    bm25fsearch_parser.add_argument("query", type=str, help="Search query, \"quoted words\" must appear as a phrase")
+    bm25fsearch_parser.add_argument("--limit", type=int, default=DEFAULT_SEARCH_LIMIT, help="How many top documents should be shown")
+    bm25fsearch_parser.add_argument("--title-boost", type=float, default=BM25F_BOOSTS["title"], help="Weight of a query term occurring in the title")
+    bm25fsearch_parser.add_argument("--description-boost", type=float, default=BM25F_BOOSTS["description"], help="Weight of a query term occurring in the description")
+
+    spell_parser = subparsers.add_parser("spell", help="Correct misspelled query words with the closest indexed terms")
+    spell_parser.add_argument("query", type=str, help="Query to correct")
+
+    complete_parser = subparsers.add_parser("complete", help="Autocomplete a prefix from the indexed terms or titles")
+    complete_parser.add_argument("prefix", type=str, help="What has been typed so far")
+    complete_parser.add_argument("--limit", type=int, default=DEFAULT_SEARCH_LIMIT, help="How many completions should be shown")
+    complete_parser.add_argument("--titles", action="store_true", help="Complete movie titles (by popularity, or by description length when the data has none) instead of words (by document frequency)")
 
     args = parser.parse_args()
 
     match args.command:
         case "search":
             print(f"Searching for: {args.query}")
-            get_movies_by_keyword(args.query)
+            get_movies_by_keyword(args.query, args.limit, args.rank)
         case "build":
             print("Building inverted index")
-            build_idx()
+            build_idx(args.workers, args.batch_size, args.positions)
+        case "add":
+            count = add_documents_command(args.path)
+            print(f"Added {count} movies")
+        case "update":
+            count = update_documents_command(args.path)
+            print(f"Updated {count} movies")
+        case "delete":
+            count = delete_documents_command(args.ids)
+            print(f"Deleted {count} movies")
+        case "merge":
+            num_docs = merge_idx()
+            print(f"Merged index into one segment with {num_docs} movies")
         case "tf":
             tf = get_tf(args.id, args.term)
-            print(f"Term frequency for {args.term} in document {args.id} is {tf}")
+            if tf is not None:
+                print(f"Term frequency for {args.term} in document {args.id} is {tf}")
         case "idf":
             idf = get_idf(args.term)
-            print(f"Inverse document frequency of '{args.term}': {idf:.2f}")
+            if idf is not None:
+                print(f"Inverse document frequency of '{args.term}': {idf:.2f}")
         case "tfidf":
             tf_idf = get_tfidf(args.doc_id, args.term)
-            print(f"TF-IDF score of '{args.term}' in document '{args.doc_id}': {tf_idf:.2f}")
+            if tf_idf is not None:
+                print(f"TF-IDF score of '{args.term}' in document '{args.doc_id}': {tf_idf:.2f}")
         case "bm25idf":
             bm25idf = bm25_idf_command(args.term)
-            print(f"BM25 IDF score of '{args.term}': {bm25idf:.2f}")
+            if bm25idf is not None:
+                print(f"BM25 IDF score of '{args.term}': {bm25idf:.2f}")
         case "bm25tf":
             bm25tf = bm25_tf_command(args.doc_id, args.term, args.k1, args.b)
-            print(f"BM25 TF score of '{args.term}' in document '{args.doc_id}': {bm25tf:.2f}")
+            if bm25tf is not None:
+                print(f"BM25 TF score of '{args.term}' in document '{args.doc_id}': {bm25tf:.2f}")
         case "bm25search":
-            top_files = get_bm25_search_command(args.query, args.limit)
+            top_files = get_bm25_search_command(args.query, args.limit, args.pruning, args.proximity, args.backend)
             # 1. (15) The Adventures of Mowgli - Score: 7.79
             for i, top_file in enumerate(top_files):
                 doc_id = top_file[0]
                 title = top_file[1][0]
                 score = top_file[1][1]
                 print(f"{i + 1}. ({doc_id}) {title} - Score: {score:.2f}")
+        case "bm25fsearch":
+            top_files = get_bm25f_search_command(args.query, args.limit, args.title_boost, args.description_boost)
+            for i, top_file in enumerate(top_files):
+                doc_id = top_file[0]
+                title = top_file[1][0]
+                score = top_file[1][1]
+                print(f"{i + 1}. ({doc_id}) {title} - Score: {score:.2f}")
+        case "spell":
+            print(spell_command(args.query))
+        case "complete":
+            completions = complete_command(args.prefix, args.limit, "titles" if args.titles else "terms")
+            for completion, score in completions:
+                print(f"{completion} ({score:g})")
         case _:
             parser.print_help()
 
@@ -0,0 +1,79 @@
+import string
+
+from collections import Counter, OrderedDict
+from functools import cached_property
+
+from .search_utils import STOPWORDS_PATH, STEM_CACHE_SIZE
+
+class Analyzer():
+    """long-lived text analyzer: lowercase, delete punctuation, split words,
+    remove empty tokens and stopwords, stemming"""
+    def __init__(self, stopwords_path=STOPWORDS_PATH, stem_cache_size=STEM_CACHE_SIZE):
+        self.translator = str.maketrans("", "", string.punctuation)
+        # stopwords are read from disk once and kept for the lifetime of the analyzer
+        with open(stopwords_path, "r") as file:
+            self.stop_words = frozenset(file.read().splitlines())
+
+        # bounded LRU memo of word -> stem
+        self.stem_cache = OrderedDict()
+        self.stem_cache_size = stem_cache_size
+        self.stem_hits = 0
+        self.stem_misses = 0
+
+    @cached_property
+    def stemmer(self):
+        """the Porter stemmer, created on first use: importing nltk.stem alone takes about a third of a second"""
+        from nltk.stem import PorterStemmer
+
+        return PorterStemmer()
+
+    def stem(self, word):
+        try:
+            stemmed = self.stem_cache[word]
+        except KeyError:
+            self.stem_misses += 1
+            stemmed = self.stemmer.stem(word)
+            self.stem_cache[word] = stemmed
+            if len(self.stem_cache) > self.stem_cache_size:
+                self.stem_cache.popitem(last=False)
+            return stemmed
+
+        self.stem_hits += 1
+        self.stem_cache.move_to_end(word)
+        return stemmed
+
+    def tokenize(self, text):
+        words = text.lower().translate(self.translator).split()
+        return [self.stem(word) for word in words if word not in self.stop_words]
+
+    def tokenize_many(self, texts):
+        return [self.tokenize(text) for text in texts]
+
+    def surface_forms(self, texts):
+        """stem -> the word of texts most often reduced to it (ties: the shortest, then alphabetically first)"""
+        counts = Counter()
+        for text in texts:
+            counts.update(word for word in text.lower().translate(self.translator).split() if word not in self.stop_words)
+        best = {}
+        for word, count in counts.items():
+            stem = self.stem(word)
+            if stem not in best or (-count, len(word), word) < (-best[stem][1], len(best[stem][0]), best[stem][0]):
+                best[stem] = (word, count)
+        return {stem: word for stem, (word, _) in best.items()}
+
+    def cache_info(self):
+        return {
+            "hits": self.stem_hits,
+            "misses": self.stem_misses,
+            "size": len(self.stem_cache),
+            "max_size": self.stem_cache_size
+        }
+
+_analyzer = None
+
+def get_analyzer():
+    """return the process-wide analyzer, creating it on first use"""
+    global _analyzer
+    if _analyzer is None:
+        _analyzer = Analyzer()
+    return _analyzer
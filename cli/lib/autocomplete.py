@@ -0,0 +1,195 @@
+import bisect
+import mmap
+import os
+import re
+import struct
+
+import numpy as np
+
+from .search_utils import AUTOCOMPLETE_SCAN_LIMIT
+
+AUTOCOMPLETE_MAGIC = b"RACP"
+AUTOCOMPLETE_VERSION = 2
+# sections of every dictionary, in file order: (name, dtype of the array, None for raw bytes)
+AUTOCOMPLETE_SECTIONS = (
+    ("key_offsets", np.uint64),
+    ("keys", None),
+    ("display_offsets", np.uint64),
+    ("displays", None),
+    ("scores", np.float64),
+    ("rank", np.int64),
+)
+AUTOCOMPLETE_DICTIONARIES = ("terms", "titles")
+AUTOCOMPLETE_HEADER = struct.Struct("<4sI")
+AUTOCOMPLETE_SECTION_TABLE = struct.Struct("<" + "QQ" * len(AUTOCOMPLETE_SECTIONS) * len(AUTOCOMPLETE_DICTIONARIES))
+AUTOCOMPLETE_ALIGNMENT = 8
+# sorts after every character a key can continue with
+MAX_CHAR = chr(0x10FFFF)
+
+def normalize_prefix(text):
+    """lowercase with runs of whitespace collapsed, as keys are stored"""
+    return re.sub(r"\s+", " ", text.lower()).lstrip()
+
+def encode_dictionary(entries):
+    """sections of one dictionary from (key, display, score) entries: keys sorted, one entry per key
+    (the best scoring), displays stored only where they differ from the key, and the rank of
+    every key position by descending score (ties by key)"""
+    best = {}
+    for key, display, score in entries:
+        if key and (key not in best or score > best[key][1]):
+            best[key] = (display, score)
+    keys = sorted(best)
+
+    encoded_keys = [key.encode("utf-8") for key in keys]
+    encoded_displays = [b"" if best[key][0] == key else best[key][0].encode("utf-8") for key in keys]
+    scores = np.array([best[key][1] for key in keys], dtype=np.float64)
+    return {
+        "key_offsets": np.concatenate(([0], np.cumsum([len(key) for key in encoded_keys]))).astype(np.uint64),
+        "keys": b"".join(encoded_keys),
+        "display_offsets": np.concatenate(([0], np.cumsum([len(display) for display in encoded_displays]))).astype(np.uint64),
+        "displays": b"".join(encoded_displays),
+        "scores": scores,
+        "rank": np.argsort(-scores, kind="stable").astype(np.int64)
+    }
+
+def encode_autocomplete(term_entries, title_entries):
+    """the autocomplete file contents: header, section table, then the sections of the term and title dictionaries"""
+    dictionaries = [encode_dictionary(term_entries), encode_dictionary(title_entries)]
+    position = AUTOCOMPLETE_HEADER.size + AUTOCOMPLETE_SECTION_TABLE.size
+    table = []
+    parts = []
+    for dictionary in dictionaries:
+        for name, _ in AUTOCOMPLETE_SECTIONS:
+            data = dictionary[name] if isinstance(dictionary[name], bytes) else dictionary[name].tobytes()
+            padding = -position % AUTOCOMPLETE_ALIGNMENT
+            parts.append(b"\0" * padding)
+            position += padding
+            table.extend((position, len(data)))
+            parts.append(data)
+            position += len(data)
+    header = AUTOCOMPLETE_HEADER.pack(AUTOCOMPLETE_MAGIC, AUTOCOMPLETE_VERSION) + AUTOCOMPLETE_SECTION_TABLE.pack(*table)
+    return header + b"".join(parts)
+
+def write_autocomplete(path, term_entries, title_entries):
+    # write then rename, so readers never see a half-written file
+    with open(f"{path}.tmp", "wb") as file:
+        file.write(encode_autocomplete(term_entries, title_entries))
+    os.replace(f"{path}.tmp", path)
+
+class CompletionDictionary():
+    """sorted keys with a score each: the keys starting with a prefix are one range found by binary
+    search, and its best keys come from a partial sort of the range or, for a wide range, from walking
+    the global rank order until enough keys fall inside it"""
+    def __init__(self, buffer, sections):
+        self.buffer = buffer
+        self.sections = sections
+        self.key_offsets = sections["key_offsets"]
+        self.display_offsets = sections["display_offsets"]
+        self.scores = sections["scores"]
+        self.rank = sections["rank"]
+        self.num_keys = len(self.scores)
+
+    def __raw(self, name, start, end):
+        offset, _ = self.sections[name]
+        return self.buffer[offset + start:offset + end]
+
+    def key(self, i):
+        return self.__raw("keys", int(self.key_offsets[i]), int(self.key_offsets[i + 1])).decode("utf-8")
+
+    def display(self, i):
+        start, end = int(self.display_offsets[i]), int(self.display_offsets[i + 1])
+        return self.__raw("displays", start, end).decode("utf-8") if end > start else self.key(i)
+
+    def __len__(self):
+        return self.num_keys
+
+    def prefix_range(self, prefix):
+        keys = range(self.num_keys)
+        return bisect.bisect_left(keys, prefix, key=self.key), bisect.bisect_left(keys, prefix + MAX_CHAR, key=self.key)
+
+    def complete(self, prefix, limit):
+        """(display, score) of the best limit keys starting with prefix, by descending score then by key"""
+        lo, hi = self.prefix_range(prefix)
+        if hi <= lo or limit <= 0:
+            return []
+
+        if hi - lo <= AUTOCOMPLETE_SCAN_LIMIT:
+            positions = lo + np.argsort(-self.scores[lo:hi], kind="stable")[:limit]
+        else:
+            # at least (hi - lo) / num_keys of every chunk of the rank order is inside the range on average
+            found = []
+            count = 0
+            for start in range(0, self.num_keys, AUTOCOMPLETE_SCAN_LIMIT):
+                chunk = self.rank[start:start + AUTOCOMPLETE_SCAN_LIMIT]
+                found.append(chunk[(chunk >= lo) & (chunk < hi)])
+                count += len(found[-1])
+                if count >= limit:
+                    break
+            positions = np.concatenate(found)[:limit]
+        return [(self.display(i), float(self.scores[i])) for i in positions.tolist()]
+
+class Autocomplete():
+    """prefix completion of the stemmed vocabulary (ranked by document frequency, shown as the most
+    frequent word of every stem) and of titles (ranked by popularity, or by description length when
+    the documents have none), read in place from the bytes of an autocomplete file"""
+    def __init__(self, buffer):
+        self.buffer = buffer
+        magic, version = AUTOCOMPLETE_HEADER.unpack_from(buffer)
+        if magic != AUTOCOMPLETE_MAGIC:
+            raise ValueError("not an autocomplete file")
+        if version != AUTOCOMPLETE_VERSION:
+            raise ValueError(f"autocomplete version {version}, expected {AUTOCOMPLETE_VERSION}: rebuild the index")
+
+        table = AUTOCOMPLETE_SECTION_TABLE.unpack_from(buffer, AUTOCOMPLETE_HEADER.size)
+        self.dictionaries = {}
+        i = 0
+        for dictionary in AUTOCOMPLETE_DICTIONARIES:
+            sections = {}
+            for name, dtype in AUTOCOMPLETE_SECTIONS:
+                offset, length = table[2 * i], table[2 * i + 1]
+                if dtype is None:
+                    sections[name] = (offset, length)
+                else:
+                    sections[name] = np.frombuffer(buffer, dtype=dtype, count=length // np.dtype(dtype).itemsize, offset=offset)
+                i += 1
+            self.dictionaries[dictionary] = CompletionDictionary(buffer, sections)
+
+    @classmethod
+    def open(cls, path):
+        """memory-map an autocomplete file"""
+        with open(path, "rb") as file:
+            return cls(mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ))
+
+    @classmethod
+    def from_entries(cls, term_entries, title_entries):
+        return cls(encode_autocomplete(term_entries, title_entries))
+
+    def complete(self, prefix, limit, field="terms"):
+        """top limit completions of a prefix in the "terms" or "titles" dictionary"""
+        try:
+            dictionary = self.dictionaries[field]
+        except KeyError:
+            raise ValueError(f"unknown autocomplete field: {field}")
+        return dictionary.complete(normalize_prefix(prefix), limit)
+
+    def displays(self, field="terms"):
+        """key -> display of every key of a dictionary"""
+        dictionary = self.dictionaries[field]
+        return {dictionary.key(i): dictionary.display(i) for i in range(len(dictionary))}
+
+def term_entries(terms, dfs, surface_forms=None):
+    """(stem, its surface form, df) of every term; a stem without a surface form is shown as it is"""
+    surface_forms = surface_forms or {}
+    return ((term, surface_forms.get(term, term), df) for term, df in zip(terms, dfs.tolist()))
+
+def title_score(document):
+    """popularity of a document when it has one, else the words of its description: the movie data has
+    no popularity, and longer descriptions go with better known movies"""
+    if "popularity" in document:
+        return float(document["popularity"])
+    return float(len(document["description"].split()))
+
+def title_entries(documents):
+    """(key, title, score) of every document"""
+    for document in documents:
+        yield normalize_prefix(document["title"]).strip(), document["title"], title_score(document)
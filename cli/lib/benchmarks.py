@@ -0,0 +1,301 @@
+import json
+import os
+import pickle
+import re
+import subprocess
+import sys
+import tempfile
+import time
+
+from collections import Counter
+
+import numpy as np
+
+from .embedding_store import open_binary_index, open_embedding_index
+from .hnsw import open_hnsw_index
+from .ivf import open_ivf_index
+from .keyword_search import InvertedIndex, get_inverted_idx_load
+from .search_utils import (
+    BINARY_RESCORE,
+    CACHE_DIR,
+    CHUNK_EMBEDDINGS_FILE_NAME,
+    DATA_PATH,
+    DEFAULT_SEARCH_LIMIT,
+    GOLDEN_DATASET_PATH,
+    HNSW_EF_CONSTRUCTION,
+    HNSW_M,
+    MOVIE_EMBEDDINGS_FILE_NAME
+)
+
+# modules that take long to import: a CLI should only import them inside the commands that use them
+HEAVY_MODULES = ("sentence_transformers", "torch", "transformers", "google.genai", "dotenv", "PIL", "nltk")
+# directory of the *_cli.py scripts
+CLI_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# subcommands that run without indexes or models, timed end to end; the others are timed up to their --help
+STARTUP_COMMANDS = {
+    ("hybrid_search_cli.py", "normalize"): ["0.5", "2.3", "1.2"],
+    ("semantic_search_cli.py", "chunk"): ["a short text to chunk", "--chunk-size", "2"],
+    ("semantic_search_cli.py", "semantic_chunk"): ["A short text. To chunk.", "--max-chunk-size", "1"]
+}
+
+def load_queries(queries_path=None):
+    """queries from a text file (one per line), or the golden dataset queries by default"""
+    if queries_path is None:
+        with open(GOLDEN_DATASET_PATH, "r") as file:
+            return [test_case["query"] for test_case in json.load(file)["test_cases"]]
+
+    with open(queries_path, "r") as file:
+        return [line.strip() for line in file if line.strip()]
+
+def expand_queries(queries):
+    # imported here so the benchmarks only need the Gemini API when asked to expand
+    from gemini_api import enhance
+
+    return [f"{query} {enhance('expand', query)}" for query in queries]
+
+def timed(function, *args, **kwargs):
+    start = time.perf_counter()
+    result = function(*args, **kwargs)
+    return result, (time.perf_counter() - start) * 1000
+
+def wand_benchmark(queries, limit):
+    """compare exhaustive term-at-a-time BM25 with WAND pruning: docs scored, latency and equal results"""
+    inverted_idx = get_inverted_idx_load(DATA_PATH)
+
+    total_candidates = 0
+    total_scored = 0
+    for query in queries:
+        exhaustive, exhaustive_ms = timed(inverted_idx.bm25_search, query, limit)
+        candidates = inverted_idx.last_search_stats["scored"]
+        wand, wand_ms = timed(inverted_idx.bm25_search, query, limit, "wand")
+        scored = inverted_idx.last_search_stats["scored"]
+
+        total_candidates += candidates
+        total_scored += scored
+        skipped = candidates - scored
+        skipped_pct = 100 * skipped / candidates if candidates else 0.0
+        print(f"- Query: {query[:80]}")
+        print(f"  - Matching docs: {candidates}, scored with WAND: {scored}, skipped: {skipped} ({skipped_pct:.1f}%)")
+        print(f"  - Exhaustive: {exhaustive_ms:.2f} ms, WAND: {wand_ms:.2f} ms, same results: {exhaustive == wand}")
+
+    total_skipped = total_candidates - total_scored
+    total_skipped_pct = 100 * total_skipped / total_candidates if total_candidates else 0.0
+    print(f"Total: {total_candidates} matching docs, {total_skipped} skipped ({total_skipped_pct:.1f}%)")
+
+def postings_benchmark(queries):
+    """compare the compressed, memory-mapped segment with the old pickled sets and Counters layout"""
+    inverted_idx = InvertedIndex(DATA_PATH)
+    inverted_idx.build()
+    postings = inverted_idx.postings
+
+    # the old layout: token -> set of document IDs, document ID -> Counter of tokens, plus docmap and lengths
+    index = {}
+    term_frequencies = {doc_id: Counter() for doc_id in inverted_idx.doc_ids.tolist()}
+    for term in postings.terms:
+        doc_ordinals, tfs = postings.get(term)
+        doc_ids = inverted_idx.doc_ids[doc_ordinals].tolist()
+        index[term] = set(doc_ids)
+        for doc_id, tf in zip(doc_ids, tfs.tolist()):
+            term_frequencies[doc_id][term] = tf
+    doc_lengths = dict(zip(inverted_idx.doc_ids.tolist(), inverted_idx.doc_lengths.tolist()))
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        pickle_paths = []
+        for name, obj in (("index", index), ("docmap", inverted_idx.docmap), ("term_frequencies", term_frequencies), ("doc_lengths", doc_lengths)):
+            pickle_paths.append(os.path.join(tmp_dir, f"{name}.pkl"))
+            with open(pickle_paths[-1], "wb") as file:
+                pickle.dump(obj, file)
+        segment_dir = os.path.join(tmp_dir, "segments")
+        inverted_idx.save(segment_dir)
+
+        pickle_size = sum(os.path.getsize(path) for path in pickle_paths)
+        segment_size = sum(os.path.getsize(os.path.join(segment_dir, name)) for name in os.listdir(segment_dir))
+
+        def load_pickles():
+            for path in pickle_paths:
+                with open(path, "rb") as file:
+                    pickle.load(file)
+
+        segment_idx = InvertedIndex(DATA_PATH)
+        _, pickle_load_ms = timed(load_pickles)
+        _, segment_load_ms = timed(segment_idx.load, segment_dir)
+
+        _, memory_search_ms = timed(lambda: [inverted_idx.bm25_search(query, DEFAULT_SEARCH_LIMIT) for query in queries])
+        _, segment_search_ms = timed(lambda: [segment_idx.bm25_search(query, DEFAULT_SEARCH_LIMIT) for query in queries])
+
+    print(f"Documents: {len(inverted_idx.doc_ids)}, terms: {len(postings)}, postings: {len(postings.doc_ordinals)}")
+    print(f"On disk:  pickles {pickle_size / 1024:.1f} KiB, segment {segment_size / 1024:.1f} KiB")
+    print(f"Postings: decoded arrays in memory {postings.nbytes() / 1024:.1f} KiB")
+    print(f"Load:     pickles {pickle_load_ms:.2f} ms, segment {segment_load_ms:.2f} ms")
+    print(f"Search ({len(queries)} queries): in-memory postings {memory_search_ms:.2f} ms, memory-mapped segment {segment_search_ms:.2f} ms")
+
+def build_benchmark(max_workers):
+    """time the index build for 1..max_workers processes and check every output is byte-identical to the serial one"""
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        serial_segment = None
+        serial_ms = None
+        for workers in range(1, max_workers + 1):
+            inverted_idx = InvertedIndex(DATA_PATH)
+            _, build_ms = timed(inverted_idx.build, workers)
+
+            segment_dir = os.path.join(tmp_dir, str(workers))
+            inverted_idx.save(segment_dir)
+            segment_name = next(name for name in os.listdir(segment_dir) if name.endswith(".seg"))
+            with open(os.path.join(segment_dir, segment_name), "rb") as file:
+                segment = file.read()
+
+            if workers == 1:
+                serial_segment, serial_ms = segment, build_ms
+            print(f"{workers} worker(s): {build_ms:.1f} ms, speedup {serial_ms / build_ms:.2f}x, identical to serial: {segment == serial_segment}")
+
+def matrix_benchmark(queries, limit, repeat):
+    """queries per second of the postings backend, the BM25 matrix one query at a time and the matrix in batches"""
+    inverted_idx = get_inverted_idx_load(DATA_PATH)
+    queries = queries * repeat
+
+    matrix, matrix_build_ms = timed(inverted_idx.get_bm25_matrix)
+    postings_results, postings_ms = timed(lambda: [inverted_idx.bm25_search(query, limit) for query in queries])
+    single_results, single_ms = timed(lambda: [inverted_idx.bm25_search(query, limit, backend="matrix") for query in queries])
+    batch_results, batch_ms = timed(inverted_idx.bm25_search_many, queries, limit)
+
+    print(f"BM25 matrix: {len(matrix.data)} weights, {matrix.nbytes() / 1024:.1f} KiB, built in {matrix_build_ms:.1f} ms")
+    for name, elapsed_ms in (("postings", postings_ms), ("matrix", single_ms), ("matrix batched", batch_ms)):
+        print(f"{name:>15}: {len(queries)} queries in {elapsed_ms:.1f} ms, {1000 * len(queries) / elapsed_ms:.0f} queries/s")
+    print(f"Same results: {postings_results == single_results == batch_results}")
+
+def recall(results, exact_results):
+    """mean fraction of the exact top ids every approximate search found"""
+    found = [len(set(ids.tolist()) & set(exact_ids.tolist())) / len(exact_ids) for ids, exact_ids in zip(results, exact_results) if len(exact_ids)]
+    return sum(found) / len(found) if found else 1.0
+
+def embed_queries(queries):
+    """embeddings of the queries, with the movie and chunk embeddings built if they are missing"""
+    # imported here so the keyword benchmarks do not need the embedding model
+    from .semantic_search import ChunkedSemanticSearch, get_documents
+
+    semantic_search = ChunkedSemanticSearch()
+    documents = get_documents(DATA_PATH)
+    semantic_search.load_or_create_embeddings(documents)
+    semantic_search.load_or_create_chunk_embeddings(documents)
+    return np.array([semantic_search.generate_embedding(query) for query in queries])
+
+def quantization_benchmark(queries, limit, rescore, binary_rescores=(BINARY_RESCORE,)):
+    """recall@limit, memory and latency of the float16 and int8 embeddings (with and without float32
+    rescoring) and of binary sign bits rescoring binary_rescores candidates, against exact float32
+    search of the movie and the chunk embeddings"""
+    query_embeddings = embed_queries(queries)
+
+    for name, file_name in (("movies", MOVIE_EMBEDDINGS_FILE_NAME), ("chunks", CHUNK_EMBEDDINGS_FILE_NAME)):
+        path = os.path.join(CACHE_DIR, file_name)
+        exact_index = open_embedding_index(path)
+        exact_results, exact_ms = timed(lambda: [exact_index.search(embedding, limit)[0] for embedding in query_embeddings])
+        print(f"{name}: {len(exact_index)} vectors, recall@{limit} against float32 search of {len(queries)} queries")
+        print(f"  {'float32':>16}: {exact_index.nbytes() / 1024:9.1f} KiB, recall 1.000, {exact_ms / len(queries):.2f} ms/query")
+
+        for precision in ("float16", "int8"):
+            for candidates in (0, rescore) if rescore else (0,):
+                index = open_embedding_index(path, precision, candidates)
+                results, elapsed_ms = timed(lambda: [index.search(embedding, limit)[0] for embedding in query_embeddings])
+                label = f"{precision} +{candidates}" if candidates else precision
+                # rescoring pages in the rescored float32 rows only, not counted here
+                print(f"  {label:>16}: {index.nbytes() / 1024:9.1f} KiB, recall {recall(results, exact_results):.3f}, {elapsed_ms / len(queries):.2f} ms/query")
+
+        for candidates in binary_rescores:
+            index = open_binary_index(path, candidates)
+            results, elapsed_ms = timed(lambda: [index.search(embedding, limit)[0] for embedding in query_embeddings])
+            _, scan_ms = timed(lambda: [index.distances(embedding) for embedding in query_embeddings])
+            label = f"binary +{candidates}"
+            print(f"  {label:>16}: {index.nbytes() / 1024:9.1f} KiB, recall {recall(results, exact_results):.3f}, {elapsed_ms / len(queries):.2f} ms/query (Hamming scan {scan_ms / len(queries):.2f} ms)")
+
+def ivf_benchmark(queries, limit, nprobes, nlist=None):
+    """recall@limit, chunks scanned and latency of the IVF index of the chunk embeddings for several
+    nprobe values, against exact search of every chunk"""
+    query_embeddings = embed_queries(queries)
+    path = os.path.join(CACHE_DIR, CHUNK_EMBEDDINGS_FILE_NAME)
+    exact_index = open_embedding_index(path)
+    _, build_ms = timed(open_ivf_index, path, nlist=nlist)
+    ivf_index = open_ivf_index(path, nlist=nlist)
+    exact_results, exact_ms = timed(lambda: [exact_index.search(embedding, limit)[0] for embedding in query_embeddings])
+
+    print(f"chunks: {len(exact_index)} vectors in {ivf_index.nlist()} lists (opened or built in {build_ms:.1f} ms), {len(queries)} queries")
+    print(f"  {'exact':>12}: recall@{limit} 1.000, {len(exact_index)} chunks scanned, {exact_ms / len(queries):.2f} ms/query")
+    for nprobe in nprobes:
+        ivf_index.nprobe = nprobe
+        scanned = sum(len(ivf_index.probe(embedding)[0]) for embedding in query_embeddings) / len(queries)
+        results, elapsed_ms = timed(lambda: [ivf_index.search(embedding, limit)[0] for embedding in query_embeddings])
+        print(f"  {f'nprobe {nprobe}':>12}: recall@{limit} {recall(results, exact_results):.3f}, {scanned:.0f} chunks scanned, {elapsed_ms / len(queries):.2f} ms/query")
+
+def hnsw_benchmark(queries, limit, ef_searches, M=HNSW_M, ef_construction=HNSW_EF_CONSTRUCTION):
+    """recall@limit and latency of the HNSW graphs of the movie and the chunk embeddings for several
+    ef_search values, against exact search"""
+    query_embeddings = embed_queries(queries)
+    for name, file_name in (("movies", MOVIE_EMBEDDINGS_FILE_NAME), ("chunks", CHUNK_EMBEDDINGS_FILE_NAME)):
+        path = os.path.join(CACHE_DIR, file_name)
+        exact_index = open_embedding_index(path)
+        hnsw_index, build_ms = timed(open_hnsw_index, path, M=M, ef_construction=ef_construction)
+        exact_results, exact_ms = timed(lambda: [exact_index.search(embedding, limit)[0] for embedding in query_embeddings])
+
+        print(f"{name}: {len(hnsw_index)} vectors, M {M}, efConstruction {ef_construction} (opened or built in {build_ms:.1f} ms, {hnsw_index.nbytes() / 1024:.1f} KiB), {len(queries)} queries")
+        print(f"  {'exact':>14}: recall@{limit} 1.000, {exact_ms / len(queries):.2f} ms/query")
+        for ef_search in ef_searches:
+            hnsw_index.ef_search = ef_search
+            results, elapsed_ms = timed(lambda: [hnsw_index.search(embedding, limit)[0] for embedding in query_embeddings])
+            print(f"  {f'efSearch {ef_search}':>14}: recall@{limit} {recall(results, exact_results):.3f}, {elapsed_ms / len(queries):.2f} ms/query")
+
+def cli_subcommands(cli):
+    """subcommands of a CLI script, read from the usage line of its --help ([None] for a CLI without subcommands)"""
+    result = subprocess.run([sys.executable, cli, "--help"], cwd=CLI_DIR, capture_output=True, text=True)
+    if result.returncode != 0:
+        raise Exception(result.stderr.strip().splitlines()[-1] if result.stderr.strip() else f"exit status {result.returncode}")
+    match = re.search(r"\{([^}]*)\}", result.stdout)
+    return match.group(1).split(",") if match else [None]
+
+def imported_modules(command):
+    """(top-level import time in ms, imported modules) of a command, from python -X importtime"""
+    result = subprocess.run([sys.executable, "-X", "importtime", *command], cwd=CLI_DIR, capture_output=True, text=True)
+    import_us = 0
+    modules = []
+    for line in result.stderr.splitlines():
+        fields = line.removeprefix("import time:").split("|")
+        if len(fields) != 3 or not fields[1].strip().isdigit():
+            continue
+        module = fields[2].rstrip()
+        # nested imports are indented under the module importing them
+        if not module.startswith("  "):
+            import_us += int(fields[1])
+        modules.append(module.strip())
+    return import_us / 1000, modules
+
+def startup_benchmark(clis=None, runs=3, budget_ms=None):
+    """wall time (best of runs), import time and heavy modules imported of every subcommand of the CLI scripts;
+    returns False when a subcommand fails, or takes longer than budget_ms"""
+    if not clis:
+        clis = sorted(name for name in os.listdir(CLI_DIR) if name.endswith("_cli.py"))
+    baseline_ms = min(timed(subprocess.run, [sys.executable, "-c", "pass"])[1] for _ in range(runs))
+    print(f"Interpreter startup: {baseline_ms:.0f} ms (best of {runs})")
+
+    ok = True
+    for cli in clis:
+        try:
+            subcommands = cli_subcommands(cli)
+        except Exception as e:
+            print(f"{cli}: fails to start: {e}")
+            ok = False
+            continue
+        print(cli)
+        for subcommand in subcommands:
+            if subcommand is None:
+                command = [cli, "--help"]
+            else:
+                command = [cli, subcommand, *STARTUP_COMMANDS.get((cli, subcommand), ["--help"])]
+            results = [timed(subprocess.run, [sys.executable, *command], cwd=CLI_DIR, capture_output=True) for _ in range(runs)]
+            wall_ms = min(elapsed_ms for _, elapsed_ms in results)
+            import_ms, modules = imported_modules(command)
+            heavy = sorted({name for name in HEAVY_MODULES for module in modules if module == name or module.startswith(f"{name}.")})
+            failed = any(result.returncode != 0 for result, _ in results)
+            slow = budget_ms is not None and wall_ms > budget_ms
+            ok = ok and not failed and not slow
+            flags = (" FAILED" if failed else "") + (" OVER BUDGET" if slow else "")
+            mode = "run" if (cli, subcommand) in STARTUP_COMMANDS else "--help"
+            print(f"  {subcommand or cli:>24} ({mode}): {wall_ms:6.0f} ms, imports {import_ms:6.0f} ms, heavy modules: {', '.join(heavy) or 'none'}{flags}")
+    return ok
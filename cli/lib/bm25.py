@@ -0,0 +1,39 @@
+import math
+import numpy as np
+
+from .search_utils import BM25_K1, BM25_B
+
+def bm25_idf(N, df):
+    return math.log((N - df + 0.5) / (df + 0.5) + 1)
+
+def bm25_length_norms(doc_lengths, b=BM25_B):
+    """average document length and the length normalization factor of every document"""
+    N = len(doc_lengths)
+    avg_doc_length = float(doc_lengths.sum()) / N if N else 0.0
+    length_norms = 1 - b + b * (doc_lengths / avg_doc_length) if N else np.zeros(0)
+    return avg_doc_length, length_norms
+
+def bm25f_field_norms(field_lengths, live_field_lengths, b):
+    """BM25F length normalization of one field in every document, against the average field length
+    of the live documents; an empty field has no occurrences to normalize and gets 1"""
+    avg_field_length = float(live_field_lengths.sum()) / len(live_field_lengths) if len(live_field_lengths) else 0.0
+    if avg_field_length == 0:
+        return np.ones(len(field_lengths))
+    field_norms = 1 - b + b * (field_lengths / avg_field_length)
+    return np.where(field_lengths > 0, field_norms, 1.0)
+
+def bm25_max_impacts(postings, N, length_norms, k1=BM25_K1):
+    """a dictionary mapping every term of the postings to the highest BM25 score it gives any document"""
+    if len(postings) == 0:
+        return {}
+    dfs = postings.dfs()
+    idf = np.array([bm25_idf(N, df) for df in dfs.tolist()])
+    term_frequencies = postings.term_frequencies
+    impacts = (term_frequencies * (k1 + 1)) / (term_frequencies + k1 * length_norms[postings.doc_ordinals]) * np.repeat(idf, dfs)
+    return dict(zip(postings.terms, np.maximum.reduceat(impacts, postings.offsets[:-1]).tolist()))
+
+def bm25_tables(postings, doc_lengths, k1=BM25_K1, b=BM25_B):
+    """average document length, length normalization of every document
+    and maximum impact of every term of freshly built postings"""
+    avg_doc_length, length_norms = bm25_length_norms(doc_lengths, b)
+    return avg_doc_length, length_norms, bm25_max_impacts(postings, len(doc_lengths), length_norms, k1)
@@ -0,0 +1,67 @@
+from collections import Counter
+
+import numpy as np
+
+from .bm25 import bm25_idf
+from .search_utils import BM25_K1, BM25_MATRIX_BATCH_CELLS
+
+class BM25Matrix():
+    """the BM25-weighted term x document matrix in CSR form (the document x term matrix in CSC form):
+    row t holds the final BM25 weight, bm25_tf * idf, of term t in every document containing it.
+    A query is a gather of its rows and one weighted bincount; a batch of queries is the product
+    of the sparse query x term matrix with it, computed the same way into a dense query x document block."""
+    def __init__(self, terms, indptr, indices, data, num_docs):
+        # a dictionary mapping terms to their row
+        self.term_ids = {term: i for i, term in enumerate(terms)}
+        # the weights of row t are data[indptr[t]:indptr[t + 1]], in the documents indices[indptr[t]:indptr[t + 1]]
+        self.indptr = indptr
+        self.indices = indices
+        self.data = data
+        self.num_docs = num_docs
+
+    @classmethod
+    def from_postings(cls, postings, length_norms, num_docs, k1=BM25_K1):
+        """weights of in-memory postings, with the length normalization of every document ordinal"""
+        dfs = postings.dfs()
+        idf = np.array([bm25_idf(num_docs, df) for df in dfs.tolist()])
+        term_frequencies = postings.term_frequencies
+        bm25_tf = (term_frequencies * (k1 + 1)) / (term_frequencies + k1 * length_norms[postings.doc_ordinals])
+        return cls(postings.terms, postings.offsets, postings.doc_ordinals, bm25_tf * np.repeat(idf, dfs), len(length_norms))
+
+    def nbytes(self):
+        return self.indptr.nbytes + self.indices.nbytes + self.data.nbytes
+
+    def __query_entries(self, query_tokens):
+        """(row, query tf) of every distinct indexed token, in query order"""
+        entries = []
+        for query_token, query_tf in Counter(query_tokens).items():
+            term_id = self.term_ids.get(query_token)
+            if term_id is not None and self.indptr[term_id + 1] > self.indptr[term_id]:
+                entries.append((term_id, query_tf))
+        return entries
+
+    def score_many(self, queries_tokens):
+        """dense (number of queries x number of document ordinals) block of BM25 scores of tokenized queries;
+        a query token repeated n times contributes its score n times, summed in query order"""
+        query_ids = []
+        columns = []
+        weights = []
+        for query_id, query_tokens in enumerate(queries_tokens):
+            for term_id, query_tf in self.__query_entries(query_tokens):
+                start, end = self.indptr[term_id], self.indptr[term_id + 1]
+                query_ids.append(np.full(end - start, query_id, dtype=np.int64))
+                columns.append(self.indices[start:end])
+                weights.append(query_tf * self.data[start:end])
+
+        cells = len(queries_tokens) * self.num_docs
+        if not query_ids:
+            return np.zeros(cells).reshape(len(queries_tokens), self.num_docs)
+        flat = np.concatenate(query_ids) * self.num_docs + np.concatenate(columns)
+        return np.bincount(flat, weights=np.concatenate(weights), minlength=cells).reshape(len(queries_tokens), self.num_docs)
+
+    def score_batches(self, queries_tokens):
+        """score_many over consecutive batches of queries, so no block is larger than BM25_MATRIX_BATCH_CELLS;
+        yields (index of the first query, block)"""
+        batch_size = max(1, BM25_MATRIX_BATCH_CELLS // max(self.num_docs, 1))
+        for start in range(0, len(queries_tokens), batch_size):
+            yield start, self.score_many(queries_tokens[start:start + batch_size])
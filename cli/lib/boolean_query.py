@@ -0,0 +1,142 @@
+import re
+
+from .postings import intersect_sorted, difference_sorted, union_sorted
+from .proximity import phrase_matches
+
+# parentheses, quoted phrases, or runs of anything else
+BOOLEAN_TOKEN_PATTERN = re.compile(r'\(|\)|"[^"]*"|[^\s()"]+')
+BOOLEAN_OPERATORS = ("AND", "OR", "NOT")
+
+class _BooleanParser():
+    """recursive descent over the query tokens:
+        or_expr  := and_expr (OR and_expr)*
+        and_expr := not_expr ([AND] not_expr)*
+        not_expr := NOT not_expr | atom
+        atom     := ( or_expr ) | "phrase" | word
+    Nodes are tuples: ("term", token), ("phrase", tokens), ("and", children), ("or", children), ("not", child).
+    Words that analyze to nothing (stopwords, punctuation) become None and drop out of their operator."""
+    def __init__(self, query, analyzer):
+        if query.count('"') % 2:
+            raise ValueError("invalid boolean query: unterminated quote")
+        self.tokens = BOOLEAN_TOKEN_PATTERN.findall(query)
+        self.pos = 0
+        self.analyzer = analyzer
+
+    def __peek(self):
+        return self.tokens[self.pos] if self.pos < len(self.tokens) else None
+
+    def __next(self):
+        token = self.__peek()
+        self.pos += 1
+        return token
+
+    def parse(self):
+        node = self.__or_expr()
+        if self.__peek() is not None:
+            raise ValueError(f"invalid boolean query: unexpected '{self.__peek()}'")
+        return node
+
+    def __or_expr(self):
+        children = [self.__and_expr()]
+        while self.__peek() == "OR":
+            self.__next()
+            children.append(self.__and_expr())
+        return _combine("or", children)
+
+    def __and_expr(self):
+        children = [self.__not_expr()]
+        while self.__peek() not in (None, ")", "OR"):
+            if self.__peek() == "AND":
+                self.__next()
+            children.append(self.__not_expr())
+        return _combine("and", children)
+
+    def __not_expr(self):
+        if self.__peek() == "NOT":
+            self.__next()
+            child = self.__not_expr()
+            return ("not", child) if child is not None else None
+        return self.__atom()
+
+    def __atom(self):
+        token = self.__next()
+        if token is None or token in (")", "AND", "OR"):
+            raise ValueError(f"invalid boolean query: expected a word, a phrase or '(' but got {token!r}")
+        if token == "(":
+            node = self.__or_expr()
+            if self.__next() != ")":
+                raise ValueError("invalid boolean query: missing ')'")
+            return node
+
+        if token.startswith('"'):
+            text_tokens = self.analyzer.tokenize(token.strip('"'))
+            if len(text_tokens) > 1:
+                return ("phrase", text_tokens)
+        else:
+            # a word the analyzer splits into several tokens needs all of them
+            text_tokens = self.analyzer.tokenize(token)
+        return _combine("and", [("term", text_token) for text_token in text_tokens])
+
+def _combine(operator, children):
+    children = [child for child in children if child is not None]
+    if not children:
+        return None
+    if len(children) == 1:
+        return children[0]
+    return (operator, children)
+
+def parse_boolean_query(query, analyzer):
+    """syntax tree of an AND / OR / NOT query with parentheses and "quoted phrases"; adjacent terms are ANDed"""
+    return _BooleanParser(query, analyzer).parse()
+
+def positive_tokens(node):
+    """tokens of the terms and phrases that are not negated, in query order"""
+    if node is None:
+        return []
+    match node[0]:
+        case "term":
+            return [node[1]]
+        case "phrase":
+            return list(node[1])
+        case "not":
+            return []
+        case _:
+            return [token for child in node[1] for token in positive_tokens(child)]
+
+def evaluate_boolean_query(node, postings, all_doc_ordinals):
+    """sorted doc ordinals matching the syntax tree. AND intersects its operands shortest first
+    and removes its negated operands from the result; a NOT on its own is taken against all_doc_ordinals."""
+    if node is None:
+        return all_doc_ordinals[:0]
+
+    match node[0]:
+        case "term":
+            return postings.get(node[1])[0]
+
+        case "phrase":
+            if not postings.has_positions:
+                raise Exception("phrase queries need positions: rebuild the index with --positions")
+            return phrase_matches([postings.get_positions(token) for token in node[1]])[0]
+
+        case "not":
+            return difference_sorted(all_doc_ordinals, evaluate_boolean_query(node[1], postings, all_doc_ordinals))
+
+        case "or":
+            return union_sorted([evaluate_boolean_query(child, postings, all_doc_ordinals) for child in node[1]])
+
+        case "and":
+            included = [evaluate_boolean_query(child, postings, all_doc_ordinals) for child in node[1] if child[0] != "not"]
+            excluded = [evaluate_boolean_query(child[1], postings, all_doc_ordinals) for child in node[1] if child[0] == "not"]
+
+            if included:
+                included.sort(key=len)
+                doc_ordinals = included[0]
+                for other in included[1:]:
+                    if len(doc_ordinals) == 0:
+                        break
+                    doc_ordinals = intersect_sorted(doc_ordinals, other)
+            else:
+                doc_ordinals = all_doc_ordinals
+            for other in excluded:
+                doc_ordinals = difference_sorted(doc_ordinals, other)
+            return doc_ordinals
@@ -0,0 +1,209 @@
+import json
+import mmap
+import os
+import shutil
+import struct
+import tempfile
+import zlib
+
+from collections import OrderedDict
+from collections.abc import Mapping, Sequence
+
+import numpy as np
+
+from .ingest import iter_documents
+from .search_utils import (
+    CACHE_DIR,
+    DATA_PATH,
+    DOCSTORE_FILE_NAME,
+    DOCSTORE_CACHE_SIZE,
+    DOCSTORE_COMPRESSION_LEVEL
+)
+
+DOCSTORE_MAGIC = b"RDOC"
+DOCSTORE_VERSION = 1
+# magic, version, flags, number of documents
+DOCSTORE_HEADER = struct.Struct("<4sHHQ")
+# flags: records are zlib compressed
+DOCSTORE_COMPRESSED = 1
+
+def write_docstore(path, documents, compress=True):
+    """write documents (any iterable, read once) as a docstore file: header, document IDs in ascending order,
+    the record number of each of them, the byte offset of every record, then the records in input order.
+    Records are the JSON encoded documents, zlib compressed one by one with compress."""
+    doc_ids = []
+    record_ends = []
+    end = 0
+    directory = os.path.dirname(path) or "."
+    with tempfile.NamedTemporaryFile(dir=directory, delete=False) as records, \
+         tempfile.NamedTemporaryFile(dir=directory, delete=False) as file:
+        try:
+            for document in documents:
+                record = json.dumps(document).encode("utf-8")
+                if compress:
+                    record = zlib.compress(record, DOCSTORE_COMPRESSION_LEVEL)
+                records.write(record)
+                end += len(record)
+                doc_ids.append(document["id"])
+                record_ends.append(end)
+            records.flush()
+
+            doc_ids = np.array(doc_ids, dtype=np.int64)
+            record_ids = np.argsort(doc_ids, kind="stable")
+            sorted_doc_ids = doc_ids[record_ids]
+            if len(sorted_doc_ids) > 1 and (sorted_doc_ids[1:] == sorted_doc_ids[:-1]).any():
+                raise ValueError("the same document ID is stored more than once")
+
+            file.write(DOCSTORE_HEADER.pack(DOCSTORE_MAGIC, DOCSTORE_VERSION, DOCSTORE_COMPRESSED if compress else 0, len(doc_ids)))
+            file.write(sorted_doc_ids.tobytes())
+            file.write(record_ids.astype(np.int64).tobytes())
+            file.write(np.array([0] + record_ends, dtype=np.uint64).tobytes())
+            records.seek(0)
+            shutil.copyfileobj(records, file)
+        except BaseException:
+            os.remove(file.name)
+            raise
+        finally:
+            os.remove(records.name)
+    # readers never see a half-written docstore
+    os.replace(file.name, path)
+
+class DocStore(Sequence):
+    """read-only, memory-mapped documents, in the order they were written (the corpus order),
+    with lookup by document ID through by_id. Only the header is read on open; a record is
+    read and decoded when first asked for, and the most recently used documents stay decoded
+    in a small LRU cache."""
+    def __init__(self, path, cache_size=DOCSTORE_CACHE_SIZE):
+        with open(path, "rb") as file:
+            self.mmap = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic, version, flags, num_docs = DOCSTORE_HEADER.unpack_from(self.mmap)
+        if magic != DOCSTORE_MAGIC:
+            raise ValueError(f"{path} is not a docstore")
+        if version != DOCSTORE_VERSION:
+            raise ValueError(f"{path} has docstore version {version}, expected {DOCSTORE_VERSION}: rebuild it")
+
+        self.path = path
+        self.compressed = bool(flags & DOCSTORE_COMPRESSED)
+        self.num_docs = num_docs
+        offset = DOCSTORE_HEADER.size
+        # ascending document IDs, and the record number of each of them
+        self.doc_ids = np.frombuffer(self.mmap, dtype=np.int64, count=num_docs, offset=offset)
+        self.record_ids = np.frombuffer(self.mmap, dtype=np.int64, count=num_docs, offset=offset + 8 * num_docs)
+        # record i is records[record_offsets[i]:record_offsets[i + 1]]
+        self.record_offsets = np.frombuffer(self.mmap, dtype=np.uint64, count=num_docs + 1, offset=offset + 16 * num_docs)
+        self.records_start = offset + 24 * num_docs + 8
+
+        # bounded LRU of record number -> decoded document
+        self.cache = OrderedDict()
+        self.cache_size = cache_size
+        self.cache_hits = 0
+        self.cache_misses = 0
+
+    def __len__(self):
+        return self.num_docs
+
+    def __getitem__(self, record_id):
+        """document by record number (its place in the corpus)"""
+        if isinstance(record_id, slice):
+            return [self[i] for i in range(*record_id.indices(self.num_docs))]
+        if record_id < 0:
+            record_id += self.num_docs
+        if not 0 <= record_id < self.num_docs:
+            raise IndexError(record_id)
+
+        try:
+            document = self.cache[record_id]
+        except KeyError:
+            self.cache_misses += 1
+            document = self.cache[record_id] = self.__decode(record_id)
+            if len(self.cache) > self.cache_size:
+                self.cache.popitem(last=False)
+            return document
+
+        self.cache_hits += 1
+        self.cache.move_to_end(record_id)
+        return document
+
+    def __iter__(self):
+        # a full scan decodes every record once and leaves the cache alone
+        for record_id in range(self.num_docs):
+            yield self.__decode(record_id)
+
+    def __decode(self, record_id):
+        start = self.records_start + int(self.record_offsets[record_id])
+        end = self.records_start + int(self.record_offsets[record_id + 1])
+        record = self.mmap[start:end]
+        if self.compressed:
+            record = zlib.decompress(record)
+        return json.loads(record)
+
+    def get_record_id(self, doc_id):
+        """record number of a document ID, None if it is not stored"""
+        i = int(np.searchsorted(self.doc_ids, doc_id))
+        if i < self.num_docs and self.doc_ids[i] == doc_id:
+            return int(self.record_ids[i])
+        return None
+
+    @property
+    def by_id(self):
+        return DocStoreMap(self)
+
+    def nbytes(self):
+        return len(self.mmap)
+
+    def cache_info(self):
+        return {
+            "hits": self.cache_hits,
+            "misses": self.cache_misses,
+            "size": len(self.cache),
+            "max_size": self.cache_size
+        }
+
+class DocStoreMap(Mapping):
+    """document ID -> document view of a DocStore, iterated in corpus order"""
+    def __init__(self, docstore):
+        self.docstore = docstore
+
+    def __getitem__(self, doc_id):
+        record_id = self.docstore.get_record_id(doc_id)
+        if record_id is None:
+            raise KeyError(doc_id)
+        return self.docstore[record_id]
+
+    def __len__(self):
+        return len(self.docstore)
+
+    def __iter__(self):
+        record_doc_ids = np.empty(len(self.docstore), dtype=np.int64)
+        record_doc_ids[self.docstore.record_ids] = self.docstore.doc_ids
+        return iter(record_doc_ids.tolist())
+
+    def __contains__(self, doc_id):
+        return self.docstore.get_record_id(doc_id) is not None
+
+def document_map(documents):
+    """document ID -> document of a list of documents or of a DocStore, without decoding a DocStore"""
+    if isinstance(documents, DocStore):
+        return documents.by_id
+    return {document["id"]: document for document in documents}
+
+# process-wide docstores by source path, opened on first use
+_docstores = {}
+
+def get_docstore(path=DATA_PATH, cache_dir=CACHE_DIR, compress=True):
+    """return the shared docstore of a JSON / JSONL corpus, (re)building its file in cache_dir
+    when it is missing or older than the corpus"""
+    try:
+        return _docstores[path]
+    except KeyError:
+        pass
+
+    name, _ = os.path.splitext(os.path.basename(path))
+    docstore_path = os.path.join(cache_dir, f"{name}_{DOCSTORE_FILE_NAME}")
+    if not os.path.exists(docstore_path) or os.path.getmtime(docstore_path) < os.path.getmtime(path):
+        os.makedirs(cache_dir, exist_ok=True)
+        write_docstore(docstore_path, iter_documents(path), compress)
+
+    docstore = _docstores[path] = DocStore(docstore_path)
+    return docstore
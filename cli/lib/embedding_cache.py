@@ -0,0 +1,167 @@
+import hashlib
+import json
+import os
+
+import numpy as np
+
+from .docstore import DocStore
+from .ingest import encode_to_npy
+from .search_utils import CACHE_DIR, EMBEDDING_BATCH_SIZE, EMBEDDING_CACHE_DIR_NAME, VECTOR_BLOCK_ROWS
+
+EMBEDDING_MANIFEST_VERSION = 1
+# bytes of a content hash, stored as hex (fixed-width numpy bytes would drop trailing zero bytes)
+CONTENT_HASH_SIZE = 16
+CONTENT_KEY_DTYPE = f"S{2 * CONTENT_HASH_SIZE}"
+
+def content_hash(model_name, text):
+    """key of the embedding of a text by a model"""
+    return hashlib.blake2b(f"{model_name}\0{text}".encode("utf-8"), digest_size=CONTENT_HASH_SIZE).hexdigest().encode("ascii")
+
+def new_digest():
+    return hashlib.blake2b(digest_size=CONTENT_HASH_SIZE)
+
+def update_digest(digest, text):
+    digest.update(text.encode("utf-8"))
+    digest.update(b"\0")
+
+class EmbeddingCache():
+    """embeddings of one model keyed by content hash, kept in a directory as the sorted hashes and their
+    vectors (memory-mapped), plus the vectors added since the last save. A text is encoded once, whichever
+    document or chunk it belongs to and however often the embeddings are rebuilt."""
+    def __init__(self, model_name, cache_dir=CACHE_DIR):
+        self.model_name = model_name
+        self.directory = os.path.join(cache_dir, EMBEDDING_CACHE_DIR_NAME, model_name.replace("/", "_"))
+        keys_path = os.path.join(self.directory, "keys.npy")
+        if os.path.exists(keys_path):
+            self.keys = np.load(keys_path)
+            self.vectors = np.load(os.path.join(self.directory, "vectors.npy"), mmap_mode="r")
+        else:
+            self.keys = np.zeros(0, dtype=CONTENT_KEY_DTYPE)
+            self.vectors = None
+        # content hash -> vector added since the last save
+        self.pending = {}
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.keys) + len(self.pending)
+
+    def get(self, key):
+        """the cached vector of a content hash, None if there is none"""
+        i = int(np.searchsorted(self.keys, key))
+        if i < len(self.keys) and self.keys[i] == key:
+            self.hits += 1
+            return np.asarray(self.vectors[i])
+        vector = self.pending.get(key)
+        if vector is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return vector
+
+    def add(self, key, vector):
+        self.pending[key] = np.asarray(vector, dtype=np.float32)
+
+    def save(self):
+        """merge the added vectors into the cache directory"""
+        if not self.pending:
+            return
+        new_keys = np.array(list(self.pending), dtype=CONTENT_KEY_DTYPE)
+        keys = np.concatenate((self.keys, new_keys))
+        order = np.argsort(keys, kind="stable")
+        dim = len(next(iter(self.pending.values())))
+
+        os.makedirs(self.directory, exist_ok=True)
+        # written under temporary names then renamed, vectors first: keys never point past the vectors
+        vectors_path = os.path.join(self.directory, "vectors.npy")
+        vectors = np.lib.format.open_memmap(f"{vectors_path}.tmp.npy", mode="w+", dtype=np.float32, shape=(len(keys), dim))
+        pending = np.array(list(self.pending.values()), dtype=np.float32)
+        for start in range(0, len(order), VECTOR_BLOCK_ROWS):
+            block = order[start:start + VECTOR_BLOCK_ROWS]
+            cached = block < len(self.keys)
+            rows = np.empty((len(block), dim), dtype=np.float32)
+            if cached.any():
+                rows[cached] = self.vectors[block[cached]]
+            rows[~cached] = pending[block[~cached] - len(self.keys)]
+            vectors[start:start + len(block)] = rows
+        vectors.flush()
+        del vectors
+        keys_path = os.path.join(self.directory, "keys.npy")
+        np.save(f"{keys_path}.tmp.npy", keys[order])
+        os.replace(f"{vectors_path}.tmp.npy", vectors_path)
+        os.replace(f"{keys_path}.tmp.npy", keys_path)
+
+        self.keys = keys[order]
+        self.vectors = np.load(vectors_path, mmap_mode="r")
+        self.pending = {}
+
+class CachingEncoder():
+    """stands in for the model in encode_to_npy: texts already in the cache are not encoded again"""
+    def __init__(self, model, cache):
+        self.model = model
+        self.cache = cache
+        self.encoded = 0
+
+    def get_sentence_embedding_dimension(self):
+        return self.model.get_sentence_embedding_dimension()
+
+    def encode(self, texts, show_progress_bar=False):
+        keys = [content_hash(self.cache.model_name, text) for text in texts]
+        vectors = [self.cache.get(key) for key in keys]
+        missing = [i for i, vector in enumerate(vectors) if vector is None]
+        if missing:
+            encoded = self.model.encode([texts[i] for i in missing], show_progress_bar=show_progress_bar)
+            self.encoded += len(missing)
+            for i, vector in zip(missing, encoded):
+                vectors[i] = vector
+                self.cache.add(keys[i], vector)
+        return np.array(vectors, dtype=np.float32)
+
+def manifest_path(path):
+    root, _ = os.path.splitext(path)
+    return f"{root}.manifest.json"
+
+def source_fingerprint(documents):
+    """size and modification time of a DocStore's file, None for other documents"""
+    if not isinstance(documents, DocStore):
+        return None
+    stat = os.stat(documents.path)
+    return {"path": documents.path, "size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+
+def write_manifest(path, model_name, count, digest, source):
+    """record what the embeddings at path were built from: the model, the digest of their texts and the source file"""
+    with open(f"{manifest_path(path)}.tmp", "w") as file:
+        json.dump({
+            "version": EMBEDDING_MANIFEST_VERSION,
+            "model": model_name,
+            "count": count,
+            "digest": digest,
+            "source": source
+        }, file)
+    os.replace(f"{manifest_path(path)}.tmp", manifest_path(path))
+
+def embeddings_fresh(path, model_name, source, digest_fn):
+    """whether the embeddings at path were built by the model from the current texts: the source file is
+    unchanged, or else the digest of the texts (digest_fn(), computed only then) is the recorded one"""
+    try:
+        with open(manifest_path(path), "r") as file:
+            manifest = json.load(file)
+    except FileNotFoundError:
+        return False
+    if manifest.get("version") != EMBEDDING_MANIFEST_VERSION or manifest.get("model") != model_name:
+        return False
+    if not os.path.exists(path) or len(np.load(path, mmap_mode="r")) != manifest["count"]:
+        return False
+    if source is not None and manifest["source"] == source:
+        return True
+    return digest_fn() == manifest["digest"]
+
+def encode_cached(model, model_name, texts, path, digest, source):
+    """embed texts into the .npy file at path through the model's embedding cache, then write its manifest;
+    digest is updated by the texts as they are read. Returns (rows written, texts actually encoded)."""
+    cache = EmbeddingCache(model_name)
+    encoder = CachingEncoder(model, cache)
+    rows = encode_to_npy(encoder, texts, path, EMBEDDING_BATCH_SIZE)
+    cache.save()
+    write_manifest(path, model_name, rows, digest.hexdigest(), source)
+    return rows, encoder.encoded
@@ -0,0 +1,162 @@
+import os
+
+import numpy as np
+
+from .search_utils import BINARY_RESCORE, DEFAULT_EMBEDDING_PRECISION, VECTOR_BLOCK_ROWS
+from .vector_search import FlatIndex, inverse_norms, normalize_rows, top_k
+
+# how embeddings can be stored for search: as built, half precision, or 8-bit integers with a scale per dimension
+EMBEDDING_PRECISIONS = ("float32", "float16", "int8")
+INT8_MAX = 127
+
+def quantized_paths(path, precision):
+    """(vectors path, per-dimension scale path or None) of the quantized copy of a float32 .npy file"""
+    root, _ = os.path.splitext(path)
+    if precision == "float16":
+        return f"{root}.float16.npy", None
+    if precision == "int8":
+        return f"{root}.int8.npy", f"{root}.int8_scale.npy"
+    raise ValueError(f"unknown quantized precision: {precision}")
+
+def norms_path(path, precision):
+    """path of the inverse row norms of the embeddings at path stored in the given precision"""
+    root, _ = os.path.splitext(path)
+    if precision == "float32":
+        return f"{root}.norms.npy"
+    return f"{root}.{precision}_norms.npy"
+
+def write_norms(path, vectors, dim_scale=None):
+    """save the inverse norms of (possibly memory-mapped) vectors, so opening an index does not read every row"""
+    # written under a temporary name then renamed, so readers never see a half-written file
+    np.save(f"{path}.tmp.npy", inverse_norms(vectors, dim_scale))
+    os.replace(f"{path}.tmp.npy", path)
+
+def int8_scale(embeddings):
+    """per-dimension scale mapping the largest absolute value of the normalized embeddings in each dimension to 127"""
+    max_abs = np.zeros(embeddings.shape[1], dtype=np.float32)
+    for start in range(0, len(embeddings), VECTOR_BLOCK_ROWS):
+        block = normalize_rows(embeddings[start:start + VECTOR_BLOCK_ROWS])
+        np.maximum(max_abs, np.abs(block).max(axis=0, initial=0), out=max_abs)
+    return np.where(max_abs > 0, max_abs / INT8_MAX, 1.0).astype(np.float32)
+
+def quantize(vectors, precision, scale=None):
+    """normalized vectors stored as float16, or as int8 multiples of the per-dimension scale"""
+    vectors = normalize_rows(vectors)
+    if precision == "float16":
+        return vectors.astype(np.float16)
+    return np.clip(np.rint(vectors / scale), -INT8_MAX, INT8_MAX).astype(np.int8)
+
+def write_quantized(path, precision):
+    """write the quantized copy of the float32 embeddings at path next to it, one block at a time"""
+    embeddings = np.load(path, mmap_mode="r")
+    vectors_path, scale_path = quantized_paths(path, precision)
+    scale = None
+    if scale_path is not None:
+        scale = int8_scale(embeddings)
+        np.save(scale_path, scale)
+
+    dtype = np.float16 if precision == "float16" else np.int8
+    # written under a temporary name then renamed, so readers never see a half-written file
+    tmp_path = f"{vectors_path}.tmp.npy"
+    quantized = np.lib.format.open_memmap(tmp_path, mode="w+", dtype=dtype, shape=embeddings.shape)
+    for start in range(0, len(embeddings), VECTOR_BLOCK_ROWS):
+        quantized[start:start + VECTOR_BLOCK_ROWS] = quantize(embeddings[start:start + VECTOR_BLOCK_ROWS], precision, scale)
+    quantized.flush()
+    del quantized
+    os.replace(tmp_path, vectors_path)
+    write_norms(norms_path(path, precision), np.load(vectors_path, mmap_mode="r"), scale)
+
+def open_embedding_index(path, precision=DEFAULT_EMBEDDING_PRECISION, rescore=0):
+    """FlatIndex over the embeddings saved at path, memory-mapped, in the given precision, with the inverse
+    row norms saved next to them. Quantized copies and norms are (re)written next to the embeddings when
+    missing or older than them; with rescore > 0 the best rescore candidates of a quantized search are
+    rescored against the float32 embeddings."""
+    if precision not in EMBEDDING_PRECISIONS:
+        raise ValueError(f"unknown embedding precision: {precision}")
+    embeddings = np.load(path, mmap_mode="r")
+    row_norms_path = norms_path(path, precision)
+    if precision == "float32":
+        if stale(row_norms_path, path):
+            write_norms(row_norms_path, embeddings)
+        return FlatIndex(embeddings, row_scale=np.load(row_norms_path, mmap_mode="r"))
+
+    vectors_path, scale_path = quantized_paths(path, precision)
+    if any(stale(derived_path, path) for derived_path in (vectors_path, scale_path, row_norms_path) if derived_path is not None):
+        write_quantized(path, precision)
+
+    vectors = np.load(vectors_path, mmap_mode="r")
+    scale = np.load(scale_path) if scale_path is not None else None
+    return FlatIndex(vectors, scale, exact=embeddings if rescore > 0 else None, rescore=rescore, row_scale=np.load(row_norms_path, mmap_mode="r"))
+
+def stale(derived_path, path):
+    """whether a file derived from the embeddings at path is missing or older than them"""
+    return not os.path.exists(derived_path) or os.path.getmtime(derived_path) < os.path.getmtime(path)
+
+def binary_path(path):
+    root, _ = os.path.splitext(path)
+    return f"{root}.binary.npy"
+
+def pack_signs(vectors):
+    """one bit per dimension, set where the value is positive, packed 8 dimensions per byte"""
+    return np.packbits(np.asarray(vectors) > 0, axis=-1)
+
+def write_binary(path):
+    """write the sign bits of the float32 embeddings at path next to them, one block at a time"""
+    embeddings = np.load(path, mmap_mode="r")
+    vectors_path = binary_path(path)
+    tmp_path = f"{vectors_path}.tmp.npy"
+    packed = np.lib.format.open_memmap(tmp_path, mode="w+", dtype=np.uint8, shape=(len(embeddings), (embeddings.shape[1] + 7) // 8))
+    for start in range(0, len(embeddings), VECTOR_BLOCK_ROWS):
+        packed[start:start + VECTOR_BLOCK_ROWS] = pack_signs(embeddings[start:start + VECTOR_BLOCK_ROWS])
+    packed.flush()
+    del packed
+    os.replace(tmp_path, vectors_path)
+
+class BinaryIndex():
+    """two-pass cosine search: the Hamming distance between sign bits (a popcount of XORed packed bytes)
+    picks the rescore best candidates, which are then scored exactly against the float32 embeddings.
+    Same search interface as FlatIndex."""
+    def __init__(self, packed, exact, rescore=BINARY_RESCORE):
+        # packed sign bits, viewed as 64-bit words when every row is a whole number of them
+        self.packed = packed.view(np.uint64) if packed.shape[1] % 8 == 0 else packed
+        self.exact = exact
+        self.rescore = rescore
+
+    def __len__(self):
+        return len(self.packed)
+
+    def nbytes(self):
+        """bytes of the packed bits (the float32 rows are only read for candidates)"""
+        return self.packed.nbytes
+
+    def distances(self, query):
+        """Hamming distance between the sign bits of the query and of every vector"""
+        query_bits = pack_signs(query).view(self.packed.dtype)
+        distances = np.empty(len(self.packed), dtype=np.int32)
+        for start in range(0, len(self.packed), VECTOR_BLOCK_ROWS):
+            block = self.packed[start:start + VECTOR_BLOCK_ROWS]
+            distances[start:start + len(block)] = np.bitwise_count(block ^ query_bits).sum(axis=1)
+        return distances
+
+    def probe(self, query, k=0):
+        """(ids ascending, exact cosine similarities) of the max(rescore, k) vectors closest in Hamming distance"""
+        # sorted candidates read the exact (possibly memory-mapped) vectors in file order
+        candidates = np.sort(top_k(-self.distances(query), max(self.rescore, k)))
+        return candidates, normalize_rows(self.exact[candidates]) @ normalize_rows(query)
+
+    def search(self, query, k):
+        """(ids, scores) of the k most similar candidates, best first"""
+        ids, scores = self.probe(query, k)
+        best = top_k(scores, k)
+        return ids[best], scores[best]
+
+    def search_many(self, queries, k):
+        return [self.search(query, k) for query in queries]
+
+def open_binary_index(path, rescore=BINARY_RESCORE):
+    """BinaryIndex over the embeddings saved at path, with the packed bits (re)written next to them when
+    missing or older than the embeddings; both are memory-mapped"""
+    vectors_path = binary_path(path)
+    if not os.path.exists(vectors_path) or os.path.getmtime(vectors_path) < os.path.getmtime(path):
+        write_binary(path)
+    return BinaryIndex(np.load(vectors_path, mmap_mode="r"), np.load(path, mmap_mode="r"), rescore)
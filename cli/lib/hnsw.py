@@ -0,0 +1,284 @@
+import heapq
+import json
+import math
+import os
+import shutil
+import zlib
+
+import numpy as np
+
+from .search_utils import HNSW_M, HNSW_EF_CONSTRUCTION, HNSW_EF_SEARCH, VECTOR_BLOCK_ROWS
+from .vector_search import normalize_rows, top_k
+
+HNSW_VERSION = 1
+# arrays of an HNSW index directory, each one .npy file
+HNSW_ARRAYS = ("vectors", "levels", "link_offsets", "links")
+
+def embeddings_checksum(embeddings, count):
+    """crc32 of the first count embeddings, read block by block"""
+    checksum = 0
+    for start in range(0, count, VECTOR_BLOCK_ROWS):
+        checksum = zlib.crc32(np.ascontiguousarray(embeddings[start:min(start + VECTOR_BLOCK_ROWS, count)]).tobytes(), checksum)
+    return checksum
+
+def embeddings_fingerprint(path):
+    """size and modification time of an embeddings file: a graph whose recorded fingerprint is still the
+    file's is used without reading the embeddings"""
+    stat = os.stat(path)
+    return {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+
+def write_meta(directory, meta):
+    with open(os.path.join(directory, "meta.json.tmp"), "w") as file:
+        json.dump(meta, file)
+    os.replace(os.path.join(directory, "meta.json.tmp"), os.path.join(directory, "meta.json"))
+
+class HNSWIndex():
+    """hierarchical navigable small world graph for approximate cosine search. Every vector is a node on
+    layer 0 and, with exponentially decreasing probability, on the layers above; a search walks greedily
+    down from the entry point on the top layer and ends with a best-first search of ef nodes on layer 0.
+    Vectors are inserted one at a time, so new ones are added without a rebuild. An opened index keeps
+    its links in the flat on-disk arrays until the first insertion turns them into lists.
+    Same search interface as FlatIndex."""
+    def __init__(self, dim, M=HNSW_M, ef_construction=HNSW_EF_CONSTRUCTION, ef_search=HNSW_EF_SEARCH, seed=0):
+        self.M = M
+        # layer 0 keeps twice as many links, as in the original paper
+        self.max_links_0 = 2 * M
+        self.ef_construction = ef_construction
+        self.ef_search = ef_search
+        self.level_factor = 1 / math.log(M)
+        self.rng = np.random.default_rng(seed)
+
+        # normalized vectors (the first count rows of a growing buffer) and the top layer of every node
+        self.vectors = np.zeros((0, dim), dtype=np.float32)
+        self.count = 0
+        self.levels = []
+        # links[node][level] -> neighbour nodes, or None while the links are the flat arrays below
+        self.links = []
+        # flat links: the neighbours of node on level are links_flat[link_offsets[s]:link_offsets[s + 1]]
+        # with s = node_slots[node] + level
+        self.node_slots = None
+        self.link_offsets = None
+        self.links_flat = None
+        self.entry_point = -1
+        self.max_level = -1
+
+    def __len__(self):
+        return self.count
+
+    def nbytes(self):
+        links = self.links_flat.nbytes + self.link_offsets.nbytes if self.links is None else 4 * sum(len(neighbours) for node in self.links for neighbours in node)
+        return self.count * self.vectors.shape[1] * 4 + links
+
+    def __neighbours(self, node, level):
+        if self.links is None:
+            slot = self.node_slots[node] + level
+            return self.links_flat[self.link_offsets[slot]:self.link_offsets[slot + 1]].tolist()
+        return self.links[node][level]
+
+    def __thaw(self):
+        """turn flat links into lists before the graph is changed"""
+        if self.links is not None:
+            return
+        self.links = [
+            [self.__neighbours(node, level) for level in range(self.levels[node] + 1)]
+            for node in range(self.count)
+        ]
+        self.node_slots = self.link_offsets = self.links_flat = None
+        self.vectors = np.array(self.vectors[:self.count])
+
+    def __search_layer(self, query, entry_points, ef, level):
+        """(similarity, node) of the ef nodes most similar to query found by best-first search of a layer, best first"""
+        visited = set(entry_points)
+        similarities = (self.vectors[entry_points] @ query).tolist()
+        # candidates to expand, most similar first, and the best ef found so far as a min-heap
+        candidates = [(-similarity, node) for similarity, node in zip(similarities, entry_points)]
+        heapq.heapify(candidates)
+        found = [(similarity, node) for similarity, node in zip(similarities, entry_points)]
+        heapq.heapify(found)
+        while len(found) > ef:
+            heapq.heappop(found)
+
+        while candidates:
+            negative_similarity, node = heapq.heappop(candidates)
+            if -negative_similarity < found[0][0] and len(found) >= ef:
+                break
+            neighbours = [neighbour for neighbour in self.__neighbours(node, level) if neighbour not in visited]
+            if not neighbours:
+                continue
+            visited.update(neighbours)
+            for similarity, neighbour in zip((self.vectors[neighbours] @ query).tolist(), neighbours):
+                if len(found) < ef or similarity > found[0][0]:
+                    heapq.heappush(candidates, (-similarity, neighbour))
+                    heapq.heappush(found, (similarity, neighbour))
+                    if len(found) > ef:
+                        heapq.heappop(found)
+        return sorted(found, key=lambda item: (-item[0], item[1]))
+
+    def __select_neighbours(self, vector, candidates, max_links):
+        """the heuristic of the paper: a candidate (most similar first) is kept only when it is more
+        similar to the new vector than to every neighbour kept so far, so links spread out in every direction"""
+        nodes = [node for _, node in candidates]
+        if len(nodes) <= max_links:
+            return nodes
+        candidate_vectors = self.vectors[nodes]
+        pairwise = candidate_vectors @ candidate_vectors.T
+        similarities = candidate_vectors @ vector
+        kept = []
+        for i in range(len(nodes)):
+            if all(similarities[i] > pairwise[i, j] for j in kept):
+                kept.append(i)
+                if len(kept) == max_links:
+                    break
+        return [nodes[i] for i in kept]
+
+    def __link(self, node, neighbour, level):
+        links = self.links[neighbour][level]
+        links.append(node)
+        max_links = self.max_links_0 if level == 0 else self.M
+        if len(links) > max_links:
+            vector = self.vectors[neighbour]
+            candidates = sorted(zip((self.vectors[links] @ vector).tolist(), links), key=lambda item: (-item[0], item[1]))
+            self.links[neighbour][level] = self.__select_neighbours(vector, candidates, max_links)
+
+    def add(self, vectors):
+        """insert vectors as the next nodes, in order"""
+        self.__thaw()
+        vectors = normalize_rows(np.asarray(vectors).reshape(-1, self.vectors.shape[1]))
+        if self.count + len(vectors) > len(self.vectors):
+            grown = np.zeros((max(self.count + len(vectors), 2 * len(self.vectors)), self.vectors.shape[1]), dtype=np.float32)
+            grown[:self.count] = self.vectors[:self.count]
+            self.vectors = grown
+
+        for vector in vectors:
+            node = self.count
+            self.vectors[node] = vector
+            self.count += 1
+            level = int(-math.log(1.0 - self.rng.random()) * self.level_factor)
+            self.levels.append(level)
+            self.links.append([[] for _ in range(level + 1)])
+            if self.entry_point < 0:
+                self.entry_point, self.max_level = node, level
+                continue
+
+            entry_points = [self.entry_point]
+            for layer in range(self.max_level, level, -1):
+                entry_points = [self.__search_layer(vector, entry_points, 1, layer)[0][1]]
+            for layer in range(min(level, self.max_level), -1, -1):
+                found = self.__search_layer(vector, entry_points, self.ef_construction, layer)
+                neighbours = self.__select_neighbours(vector, found, self.max_links_0 if layer == 0 else self.M)
+                self.links[node][layer] = neighbours
+                for neighbour in neighbours:
+                    self.__link(node, neighbour, layer)
+                entry_points = [node for _, node in found]
+
+            if level > self.max_level:
+                self.entry_point, self.max_level = node, level
+
+    def probe(self, query, k=0):
+        """(ids ascending, cosine similarities) of the max(ef_search, k) nodes found closest to the query"""
+        if self.count == 0:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.float32)
+        query = normalize_rows(query)
+        entry_points = [self.entry_point]
+        for layer in range(self.max_level, 0, -1):
+            entry_points = [self.__search_layer(query, entry_points, 1, layer)[0][1]]
+        found = self.__search_layer(query, entry_points, max(self.ef_search, k), 0)
+        ids = np.array([node for _, node in found], dtype=np.int64)
+        scores = np.array([similarity for similarity, _ in found], dtype=np.float32)
+        order = np.argsort(ids)
+        return ids[order], scores[order]
+
+    def search(self, query, k):
+        """(ids, scores) of the k most similar vectors found, best first"""
+        ids, scores = self.probe(query, k)
+        best = top_k(scores, k)
+        return ids[best], scores[best]
+
+    def search_many(self, queries, k):
+        return [self.search(query, k) for query in queries]
+
+    def save(self, directory, checksum, fingerprint=None):
+        """write the graph as flat arrays; checksum and fingerprint identify the embeddings it was built from"""
+        levels = np.array(self.levels, dtype=np.int64)
+        if self.links is None:
+            link_offsets, links = self.link_offsets, self.links_flat
+        else:
+            lists = [neighbours for node in self.links for neighbours in node]
+            link_offsets = np.concatenate(([0], np.cumsum([len(neighbours) for neighbours in lists]))).astype(np.int64)
+            links = np.fromiter((neighbour for neighbours in lists for neighbour in neighbours), dtype=np.int32, count=int(link_offsets[-1]))
+        arrays = {"vectors": self.vectors[:self.count], "levels": levels, "link_offsets": link_offsets, "links": links}
+
+        # built next to the final directory then swapped in, so readers never see a half-written graph
+        tmp_directory = f"{directory}.tmp"
+        shutil.rmtree(tmp_directory, ignore_errors=True)
+        os.makedirs(tmp_directory)
+        for name in HNSW_ARRAYS:
+            np.save(os.path.join(tmp_directory, f"{name}.npy"), arrays[name])
+        write_meta(tmp_directory, {
+            "version": HNSW_VERSION,
+            "M": self.M,
+            "ef_construction": self.ef_construction,
+            "entry_point": self.entry_point,
+            "count": self.count,
+            "checksum": checksum,
+            "fingerprint": fingerprint
+        })
+        shutil.rmtree(directory, ignore_errors=True)
+        os.replace(tmp_directory, directory)
+
+    @classmethod
+    def open(cls, directory, ef_search=HNSW_EF_SEARCH):
+        """memory-map a saved graph; returns (index, its metadata: the checksum and fingerprint of the embeddings it was built from)"""
+        with open(os.path.join(directory, "meta.json"), "r") as file:
+            meta = json.load(file)
+        if meta["version"] != HNSW_VERSION:
+            raise ValueError(f"HNSW index version {meta['version']}, expected {HNSW_VERSION}: rebuild it")
+        arrays = {name: np.load(os.path.join(directory, f"{name}.npy"), mmap_mode="r") for name in HNSW_ARRAYS}
+
+        index = cls(arrays["vectors"].shape[1], meta["M"], meta["ef_construction"], ef_search)
+        index.vectors = arrays["vectors"]
+        index.count = meta["count"]
+        index.levels = np.asarray(arrays["levels"]).tolist()
+        index.links = None
+        index.node_slots = np.concatenate(([0], np.cumsum(np.asarray(arrays["levels"]) + 1)))
+        index.link_offsets = np.asarray(arrays["link_offsets"])
+        index.links_flat = arrays["links"]
+        index.entry_point = meta["entry_point"]
+        index.max_level = index.levels[index.entry_point] if index.count else -1
+        # later insertions draw levels from a stream that depends on the graph size
+        index.rng = np.random.default_rng(index.count)
+        return index, meta
+
+def hnsw_dir(path):
+    root, _ = os.path.splitext(path)
+    return f"{root}.hnsw"
+
+def open_hnsw_index(path, ef_search=HNSW_EF_SEARCH, M=HNSW_M, ef_construction=HNSW_EF_CONSTRUCTION):
+    """HNSW graph of the embeddings saved at path, kept in the directory next to them. A graph whose
+    recorded fingerprint (file size and mtime) is the embeddings file's is used as it is; otherwise the
+    embeddings are checksummed: a saved graph of their first rows gets the rows appended since inserted,
+    a graph of other embeddings or built with another M or ef_construction is rebuilt."""
+    embeddings = np.load(path, mmap_mode="r")
+    fingerprint = embeddings_fingerprint(path)
+    directory = hnsw_dir(path)
+    index = None
+    if os.path.exists(os.path.join(directory, "meta.json")):
+        index, meta = HNSWIndex.open(directory, ef_search)
+        if index.M != M or index.ef_construction != ef_construction or index.count > len(embeddings):
+            index = None
+        elif meta.get("fingerprint") == fingerprint and index.count == len(embeddings):
+            return index
+        elif embeddings_checksum(embeddings, index.count) != meta["checksum"]:
+            index = None
+        elif index.count == len(embeddings):
+            # the same embeddings rewritten: record the new fingerprint so the next open skips the checksum
+            meta["fingerprint"] = fingerprint
+            write_meta(directory, meta)
+            return index
+
+    if index is None:
+        index = HNSWIndex(embeddings.shape[1], M, ef_construction, ef_search)
+    for start in range(index.count, len(embeddings), VECTOR_BLOCK_ROWS):
+        index.add(embeddings[start:start + VECTOR_BLOCK_ROWS])
+    index.save(directory, embeddings_checksum(embeddings, len(embeddings)), fingerprint)
+    return index
@@ -1,22 +1,28 @@
 import os
-from sentence_transformers import CrossEncoder
+from .ingest import batched
 from .keyword_search import InvertedIndex
 from .semantic_search import ChunkedSemanticSearch, get_documents
-from .search_utils import DATA_PATH
+from .search_utils import DATA_PATH, QUERY_BATCH_SIZE
 
 
 class HybridSearch:
-    def __init__(self, documents):
+    def __init__(self, documents, keyword_backend="postings", semantic_backend="flat"):
         self.documents = documents
-        self.semantic_search = ChunkedSemanticSearch()
+        # how the keyword side is scored: BM25 from "postings" or the "matrix" (see InvertedIndex.bm25_search),
+        # or field-weighted "bm25f" (see InvertedIndex.bm25f_search)
+        self.keyword_backend = keyword_backend
+        # how the chunk embeddings are searched: every chunk ("flat"), the probed lists of an IVF index ("ivf")
+        # an HNSW graph walk ("hnsw") or a sign bit Hamming prefilter ("binary")
+        self.semantic_search = ChunkedSemanticSearch(backend=semantic_backend)
         self.semantic_search.load_or_create_chunk_embeddings(documents)
 
         self.idx = InvertedIndex(DATA_PATH)
         self.idx.load()
 
     def _bm25_search(self, query, limit):
-        self.idx.load()
-        return self.idx.bm25_search(query, limit)
+        if self.keyword_backend == "bm25f":
+            return self.idx.bm25f_search(query, limit)
+        return self.idx.bm25_search(query, limit, backend=self.keyword_backend)
     
     def _tuple_to_list_bm25_search(self, lst_of_tuples):
         # [(1771, ('Paddington', 10.489448461845111))]
@@ -30,8 +36,47 @@ class HybridSearch:
 
         return keyword_results_lst
 
-    def weighted_search(self, query, alpha, limit=5):
-        keyword_results = self._tuple_to_list_bm25_search(self._bm25_search(query, 500 * limit))
+    def _prefilter(self, filter_query, keyword_results, semantic_results):
+        # keep only the documents matching a boolean keyword query (AND / OR / NOT), before scores are normalized or ranked
+        if filter_query is None:
+            return keyword_results, semantic_results
+        allowed = self.idx.boolean_doc_ids(filter_query)
+        return (
+            [keyword_result for keyword_result in keyword_results if keyword_result[0] in allowed],
+            [semantic_result for semantic_result in semantic_results if semantic_result["id"] in allowed]
+        )
+
+    def _live_semantic(self, semantic_results):
+        # the chunk embeddings come from movies.json: drop the movies deleted from the keyword index since
+        return [semantic_result for semantic_result in semantic_results if self.idx.has_document(semantic_result["id"])]
+
+    def _document(self, doc_id):
+        """the indexed version of a document (added or updated ones included), else the one in movies.json"""
+        try:
+            return self.idx.docmap[doc_id]
+        except KeyError:
+            return self.semantic_search.document_map[doc_id]
+
+    def _bm25_search_many(self, queries, limit):
+        return keyword_search_many(self.idx, queries, limit, self.keyword_backend)
+
+    def weighted_search(self, query, alpha, limit=5, filter_query=None):
+        keyword_results = self._bm25_search(query, 500 * limit)
+        semantic_results = self.semantic_search.search_chunks(query, 500 * limit)
+        return self._weighted_fuse(keyword_results, semantic_results, alpha, limit, filter_query)
+
+    def weighted_search_many(self, queries, alpha, limit=5, filter_query=None):
+        """weighted_search of every query: the keyword and semantic sides are each searched for all the queries in batches"""
+        keyword_results = self._bm25_search_many(queries, 500 * limit)
+        semantic_results = self.semantic_search.search_chunks_many(queries, 500 * limit)
+        return [
+            self._weighted_fuse(keyword_result, semantic_result, alpha, limit, filter_query)
+            for keyword_result, semantic_result in zip(keyword_results, semantic_results)
+        ]
+
+    def _weighted_fuse(self, keyword_results, semantic_results, alpha, limit, filter_query):
+        keyword_results = self._tuple_to_list_bm25_search(keyword_results)
+        keyword_results, semantic_results = self._prefilter(filter_query, keyword_results, self._live_semantic(semantic_results))
 
         keyword_scores = [keyword_result[1][1] for keyword_result in keyword_results]
         keyword_scores_normalized = normalize(keyword_scores)
@@ -41,7 +86,6 @@ class HybridSearch:
         # [{'id': 2784, 'title': 'Legends of the Fall', 
         #   'description': 'Sick of betrayals the United States government perpetrated on the Native Americans, Colonel William ', 
         #   'score': np.float32(0.5236), 'metadata': {}}]
-        semantic_results = self.semantic_search.search_chunks(query, 500 * limit)
         semantic_scores = [semantic_result["score"] for semantic_result in semantic_results]
         semantic_scores_normalized = normalize(semantic_scores)
         for i in range(len(semantic_results)):
@@ -57,14 +101,16 @@ class HybridSearch:
         id_to_scores = self._combine_keyword_semantic(keyword_results, semantic_results)
 
         for key, value in id_to_scores.items():
+            document = self._document(key)
             id_to_scores[key][2] = hybrid_score(value[0], value[1], alpha)
-            id_to_scores[key][3] = f"{self.semantic_search.document_map[key]['title']}"
-            id_to_scores[key][4] = f"{self.semantic_search.document_map[key]['description'][:100]}..."
+            id_to_scores[key][3] = f"{document['title']}"
+            id_to_scores[key][4] = f"{document['description'][:100]}..."
 
         id_to_scores = dict(sorted(id_to_scores.items(), key=lambda item: item[1][2], reverse=True))
         return dict(list(id_to_scores.items())[:limit])
     
     def _combine_keyword_semantic(self, keyword_results, semantic_results):
+        # keyword search only returns documents matching a query term, so both lists may differ in length
         id_to_scores = {}
         for i in range(len(keyword_results)):
             id = keyword_results[i][0]
@@ -74,6 +120,7 @@ class HybridSearch:
             except KeyError:
                 id_to_scores[id] = [score, 0, 0, "", ""]
 
+        for i in range(len(semantic_results)):
             id = semantic_results[i]["id"]
             score = semantic_results[i]["score"]
             try:
@@ -83,13 +130,28 @@ class HybridSearch:
 
         return id_to_scores
 
-    def rrf_search(self, query, k, limit=10):
-        keyword_results = self._tuple_to_list_bm25_search(self._bm25_search(query, 500 * limit))
+    def rrf_search(self, query, k, limit=10, filter_query=None):
+        keyword_results = self._bm25_search(query, 500 * limit)
+        semantic_results = self.semantic_search.search_chunks(query, 500 * limit)
+        return self._rrf_fuse(keyword_results, semantic_results, k, limit, filter_query)
+
+    def rrf_search_many(self, queries, k, limit=10, filter_query=None):
+        """rrf_search of every query: the keyword and semantic sides are each searched for all the queries in batches"""
+        keyword_results = self._bm25_search_many(queries, 500 * limit)
+        semantic_results = self.semantic_search.search_chunks_many(queries, 500 * limit)
+        return [
+            self._rrf_fuse(keyword_result, semantic_result, k, limit, filter_query)
+            for keyword_result, semantic_result in zip(keyword_results, semantic_results)
+        ]
+
+    def _rrf_fuse(self, keyword_results, semantic_results, k, limit, filter_query):
+        keyword_results = self._tuple_to_list_bm25_search(keyword_results)
+        keyword_results, semantic_results = self._prefilter(filter_query, keyword_results, self._live_semantic(semantic_results))
+
         keyword_results.sort(key=lambda item: item[1][1], reverse=True)
         for i in range(len(keyword_results)):
             keyword_results[i][1][1] = i + 1
 
-        semantic_results = self.semantic_search.search_chunks(query, 500 * limit)
         semantic_results.sort(key=lambda item: item["score"], reverse=True)
         for i in range(len(semantic_results)):
             semantic_results[i]["score"] = i + 1
@@ -100,9 +162,10 @@ class HybridSearch:
         for key, value in id_to_scores.items():
             rrf_score_keyword = 0 if value[0] == 0 else rrf_score(value[0], k)
             rrf_score_semantic = 0 if value[1] == 0 else rrf_score(value[1], k)
+            document = self._document(key)
             id_to_scores[key][2] = rrf_score_keyword + rrf_score_semantic
-            id_to_scores[key][3] = f"{self.semantic_search.document_map[key]['title']}"
-            id_to_scores[key][4] = f"{self.semantic_search.document_map[key]['description']}"
+            id_to_scores[key][3] = f"{document['title']}"
+            id_to_scores[key][4] = f"{document['description']}"
 
         id_to_scores = dict(sorted(id_to_scores.items(), key=lambda item: item[1][2], reverse=True))
         return dict(list(id_to_scores.items())[:limit])
@@ -114,23 +177,81 @@ def hybrid_score(bm25_score, semantic_score, alpha=0.5):
     return alpha * bm25_score + (1 - alpha) * semantic_score
     
 def normalize(scores):
+    if not scores:
+        return []
     maximum = max(scores)
     minimum = min(scores)
     if maximum == minimum:
         return [1.0 for i in range(len(scores))]
     return [(score - minimum) / (maximum - minimum) for score in scores]
 
-def weighted_search(query, alpha, limit):
+def weighted_search(query, alpha, limit, filter_query=None, keyword_backend="postings", semantic_backend="flat"):
+    documents = get_documents(DATA_PATH)
+    hybrid_search = HybridSearch(documents, keyword_backend, semantic_backend)
+
+    return hybrid_search.weighted_search(query, alpha, limit, filter_query)
+
+def rrf_search(query, k, limit, filter_query=None, keyword_backend="postings", semantic_backend="flat"):
+    documents = get_documents(DATA_PATH)
+    hybrid_search = HybridSearch(documents, keyword_backend, semantic_backend)
+
+    return hybrid_search.rrf_search(query, k, limit, filter_query)
+
+def weighted_search_many(queries, alpha, limit, filter_query=None, keyword_backend="postings", semantic_backend="flat"):
     documents = get_documents(DATA_PATH)
-    hybrid_search = HybridSearch(documents)
+    hybrid_search = HybridSearch(documents, keyword_backend, semantic_backend)
 
-    return hybrid_search.weighted_search(query, alpha, limit)
+    return hybrid_search.weighted_search_many(queries, alpha, limit, filter_query)
 
-def rrf_search(query, k, limit):
+def rrf_search_many(queries, k, limit, filter_query=None, keyword_backend="postings", semantic_backend="flat"):
     documents = get_documents(DATA_PATH)
-    hybrid_search = HybridSearch(documents)
+    hybrid_search = HybridSearch(documents, keyword_backend, semantic_backend)
+
+    return hybrid_search.rrf_search_many(queries, k, limit, filter_query)
 
-    return hybrid_search.rrf_search(query, k, limit)
+def keyword_search_many(idx, queries, limit, keyword_backend="postings"):
+    """keyword results of every query; BM25F has no batched scoring, so its queries are searched one by one"""
+    if keyword_backend == "bm25f":
+        return [idx.bm25f_search(query, limit) for query in queries]
+    return idx.bm25_search_many(queries, limit, backend=keyword_backend)
+
+def batch_search(queries_path, method, limit, alpha=0.5, k=60, filter_query=None, keyword_backend="postings", semantic_backend="flat"):
+    """{"query", "results"} of every line of a queries file, in order, searched QUERY_BATCH_SIZE queries at a
+    time with the *_many searches; results are {"id", "title", "score"} best first (the filter only applies to
+    the hybrid methods)"""
+    match method:
+        case "bm25":
+            idx = InvertedIndex(DATA_PATH)
+            idx.load()
+            def search_many(queries):
+                return [
+                    [{"id": doc_id, "title": title, "score": float(score)} for doc_id, (title, score) in results]
+                    for results in keyword_search_many(idx, queries, limit, keyword_backend)
+                ]
+        case "semantic":
+            semantic_search = ChunkedSemanticSearch(backend=semantic_backend)
+            semantic_search.load_or_create_chunk_embeddings(get_documents(DATA_PATH))
+            def search_many(queries):
+                return [
+                    [{"id": result["id"], "title": result["title"], "score": float(result["score"])} for result in results]
+                    for results in semantic_search.search_chunks_many(queries, limit)
+                ]
+        case "weighted" | "rrf":
+            hybrid_search = HybridSearch(get_documents(DATA_PATH), keyword_backend, semantic_backend)
+            def search_many(queries):
+                if method == "weighted":
+                    docs = hybrid_search.weighted_search_many(queries, alpha, limit, filter_query)
+                else:
+                    docs = hybrid_search.rrf_search_many(queries, k, limit, filter_query)
+                # { id: [keyword_score, semantic_score, hybrid_score, title, description] }
+                return [[{"id": id, "title": value[3], "score": float(value[2])} for id, value in doc.items()] for doc in docs]
+        case _:
+            raise ValueError(f"unknown search method: {method}")
+
+    with open(queries_path, "r") as file:
+        for queries in batched((line.strip() for line in file if line.strip()), QUERY_BATCH_SIZE):
+            for query, results in zip(queries, search_many(queries)):
+                yield {"query": query, "results": results}
 
 def rerank_cross_encoder(docs, query):
     # { id: [keyword_score, semantic_score, hybrid_score, title, description] }
@@ -141,6 +262,9 @@ def rerank_cross_encoder(docs, query):
         description = lst[4]
         pairs.append([query, f"{title} - {description}"])
 
+    # imported here so the other searches do not pay for importing sentence_transformers (and torch)
+    from sentence_transformers import CrossEncoder
+
     cross_encoder = CrossEncoder("cross-encoder/ms-marco-TinyBERT-L2-v2")
     # scores is a list of numbers, one for each pair
     scores = cross_encoder.predict(pairs)
@@ -0,0 +1,117 @@
+import json
+import os
+import tempfile
+
+from itertools import islice
+
+import numpy as np
+
+from .search_utils import INGEST_READ_SIZE
+
+class _JsonStream():
+    """incremental reader over a JSON text: values are decoded one at a time
+    and only the undecoded tail of the file is kept in memory"""
+    def __init__(self, file):
+        self.file = file
+        self.decoder = json.JSONDecoder()
+        self.buffer = ""
+        self.pos = 0
+        self.eof = False
+
+    def __fill(self):
+        chunk = self.file.read(INGEST_READ_SIZE)
+        if not chunk:
+            self.eof = True
+            return False
+        self.buffer = self.buffer[self.pos:] + chunk
+        self.pos = 0
+        return True
+
+    def peek(self):
+        """next non-whitespace character, None at the end of the file"""
+        while True:
+            while self.pos < len(self.buffer) and self.buffer[self.pos].isspace():
+                self.pos += 1
+            if self.pos < len(self.buffer):
+                return self.buffer[self.pos]
+            if not self.__fill():
+                return None
+
+    def expect(self, char):
+        if self.peek() != char:
+            raise ValueError(f"invalid JSON: expected '{char}' at offset {self.pos}")
+        self.pos += 1
+
+    def decode(self):
+        """decode the next complete JSON value"""
+        self.peek()
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buffer, self.pos)
+                # a number running into the end of the buffer may continue in the next chunk
+                if end < len(self.buffer) or self.eof:
+                    self.pos = end
+                    return value
+            except json.JSONDecodeError:
+                if self.eof:
+                    raise
+            self.__fill()
+
+def iter_documents(path, key="movies"):
+    """yield the documents of a JSONL file (one per line) or of the `key` list of a JSON object
+    one by one, without loading the whole file"""
+    with open(path, "r") as file:
+        if path.endswith(".jsonl"):
+            for line in file:
+                if line.strip():
+                    yield json.loads(line)
+            return
+
+        stream = _JsonStream(file)
+        stream.expect("{")
+        while stream.peek() != "}":
+            name = stream.decode()
+            stream.expect(":")
+            if name != key:
+                # another top-level value: decode it and move on
+                stream.decode()
+            else:
+                stream.expect("[")
+                while stream.peek() != "]":
+                    yield stream.decode()
+                    if stream.peek() == ",":
+                        stream.expect(",")
+                stream.expect("]")
+            if stream.peek() == ",":
+                stream.expect(",")
+
+def batched(iterable, size):
+    """lists of up to size consecutive items"""
+    iterator = iter(iterable)
+    while batch := list(islice(iterator, size)):
+        yield batch
+
+def encode_to_npy(model, texts, path, batch_size):
+    """encode texts batch by batch, spill every batch of embeddings to disk and merge them
+    into one .npy file at the end, so at most one batch of embeddings is held in memory"""
+    with tempfile.TemporaryDirectory(dir=os.path.dirname(path)) as spill_dir:
+        parts = []
+        for batch in batched(texts, batch_size):
+            part_path = os.path.join(spill_dir, f"part_{len(parts)}.npy")
+            np.save(part_path, model.encode(batch, show_progress_bar=False))
+            parts.append(part_path)
+
+        if not parts:
+            np.save(path, np.zeros((0, model.get_sentence_embedding_dimension()), dtype=np.float32))
+            return 0
+
+        part_arrays = [np.load(part_path, mmap_mode="r") for part_path in parts]
+        rows = sum(len(part) for part in part_arrays)
+        merged = np.lib.format.open_memmap(path, mode="w+", dtype=part_arrays[0].dtype, shape=(rows, part_arrays[0].shape[1]))
+        row = 0
+        for part in part_arrays:
+            merged[row:row + len(part)] = part
+            row += len(part)
+        merged.flush()
+        del merged
+        return rows
@@ -0,0 +1,164 @@
+import json
+import math
+import os
+import shutil
+
+import numpy as np
+
+from .search_utils import IVF_KMEANS_ITERATIONS, IVF_NPROBE, IVF_TRAIN_PER_LIST, VECTOR_BLOCK_ROWS
+from .vector_search import normalize_rows, top_k
+
+IVF_VERSION = 1
+# arrays of an IVF index directory, each one .npy file
+IVF_ARRAYS = ("centroids", "list_offsets", "ids", "vectors")
+
+def default_nlist(num_vectors):
+    """about 4 * sqrt(n) lists, the usual IVF rule of thumb"""
+    return max(1, min(num_vectors, int(4 * math.sqrt(num_vectors))))
+
+def nearest_centroids(vectors, centroids):
+    """the list of every (normalized) vector: its most similar centroid, computed block by block"""
+    assignments = np.empty(len(vectors), dtype=np.int64)
+    for start in range(0, len(vectors), VECTOR_BLOCK_ROWS):
+        block = normalize_rows(vectors[start:start + VECTOR_BLOCK_ROWS])
+        assignments[start:start + len(block)] = np.argmax(block @ centroids.T, axis=1)
+    return assignments
+
+def kmeans(vectors, k, iterations=IVF_KMEANS_ITERATIONS, seed=0):
+    """spherical k-means (cosine) of normalized vectors: k unit centroids. Centroids start at random
+    vectors; a list left empty is restarted at the vector worst served by its centroid."""
+    rng = np.random.default_rng(seed)
+    centroids = vectors[rng.choice(len(vectors), size=k, replace=False)].copy()
+    for _ in range(iterations):
+        similarities = vectors @ centroids.T
+        assignments = np.argmax(similarities, axis=1)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assignments, vectors)
+        counts = np.bincount(assignments, minlength=k)
+
+        empty = np.flatnonzero(counts == 0)
+        if len(empty):
+            worst = np.argsort(similarities[np.arange(len(vectors)), assignments], kind="stable")[:len(empty)]
+            sums[empty[:len(worst)]] = vectors[worst]
+        new_centroids = normalize_rows(sums)
+        if np.array_equal(new_centroids, centroids):
+            break
+        centroids = new_centroids
+    return centroids
+
+def build_ivf(embeddings, nlist=None, seed=0):
+    """IVF arrays of (possibly memory-mapped) embeddings: the centroids are trained on a sample of
+    IVF_TRAIN_PER_LIST vectors per list, then every vector is assigned to its nearest centroid and the
+    normalized vectors are stored list by list, with their row ids"""
+    if len(embeddings) == 0:
+        return {
+            "centroids": np.zeros((0, embeddings.shape[1]), dtype=np.float32),
+            "list_offsets": np.zeros(1, dtype=np.int64),
+            "ids": np.zeros(0, dtype=np.int64),
+            "vectors": np.zeros((0, embeddings.shape[1]), dtype=np.float32)
+        }
+    if nlist is None:
+        nlist = default_nlist(len(embeddings))
+    nlist = max(1, min(nlist, len(embeddings)))
+    rng = np.random.default_rng(seed)
+    sample_size = min(len(embeddings), nlist * IVF_TRAIN_PER_LIST)
+    sample = np.sort(rng.choice(len(embeddings), size=sample_size, replace=False))
+    centroids = kmeans(normalize_rows(embeddings[sample]), nlist, seed=seed)
+
+    assignments = nearest_centroids(embeddings, centroids)
+    ids = np.argsort(assignments, kind="stable")
+    list_offsets = np.concatenate(([0], np.cumsum(np.bincount(assignments, minlength=nlist)))).astype(np.int64)
+    vectors = np.empty((len(embeddings), embeddings.shape[1]), dtype=np.float32)
+    for start in range(0, len(ids), VECTOR_BLOCK_ROWS):
+        block_ids = ids[start:start + VECTOR_BLOCK_ROWS]
+        # gathered from the embeddings in file order, then put in list order
+        order = np.argsort(block_ids)
+        vectors[start + order] = normalize_rows(embeddings[block_ids[order]])
+    return {"centroids": centroids, "list_offsets": list_offsets, "ids": ids.astype(np.int64), "vectors": vectors}
+
+def ivf_dir(path):
+    root, _ = os.path.splitext(path)
+    return f"{root}.ivf"
+
+def write_ivf(directory, arrays, nlist):
+    # built next to the final directory then swapped in, so readers never see a half-written index
+    tmp_directory = f"{directory}.tmp"
+    shutil.rmtree(tmp_directory, ignore_errors=True)
+    os.makedirs(tmp_directory)
+    for name in IVF_ARRAYS:
+        np.save(os.path.join(tmp_directory, f"{name}.npy"), arrays[name])
+    with open(os.path.join(tmp_directory, "meta.json"), "w") as file:
+        json.dump({"version": IVF_VERSION, "nlist": nlist}, file)
+    shutil.rmtree(directory, ignore_errors=True)
+    os.replace(tmp_directory, directory)
+
+class IVFIndex():
+    """inverted-file approximate cosine search: the vectors are grouped in lists by their nearest k-means
+    centroid, and a query only scans the contiguous vectors of the nprobe lists whose centroids are most
+    similar to it. Same search interface as FlatIndex."""
+    def __init__(self, centroids, list_offsets, ids, vectors, nprobe=IVF_NPROBE):
+        # unit centroid of every list; the vectors of list i are vectors[list_offsets[i]:list_offsets[i + 1]]
+        self.centroids = centroids
+        self.list_offsets = list_offsets
+        # row id (in the embeddings) of every vector, and the normalized vectors, list by list
+        self.ids = ids
+        self.vectors = vectors
+        self.nprobe = nprobe
+
+    @classmethod
+    def open(cls, directory, nprobe=IVF_NPROBE):
+        """memory-map an IVF index directory"""
+        with open(os.path.join(directory, "meta.json"), "r") as file:
+            version = json.load(file)["version"]
+        if version != IVF_VERSION:
+            raise ValueError(f"IVF index version {version}, expected {IVF_VERSION}: rebuild it")
+        arrays = {name: np.load(os.path.join(directory, f"{name}.npy"), mmap_mode="r") for name in IVF_ARRAYS}
+        return cls(np.asarray(arrays["centroids"]), np.asarray(arrays["list_offsets"]), arrays["ids"], arrays["vectors"], nprobe)
+
+    def __len__(self):
+        return len(self.ids)
+
+    def nlist(self):
+        return len(self.centroids)
+
+    def probe(self, query, k=0):
+        """(row ids ascending, cosine similarities) of every vector in the nprobe lists closest to the query;
+        k is there for the HNSWIndex interface, the lists hold however many vectors they hold"""
+        query = normalize_rows(query)
+        lists = top_k(self.centroids @ query, self.nprobe)
+        ids = []
+        scores = []
+        for i in lists.tolist():
+            start, end = int(self.list_offsets[i]), int(self.list_offsets[i + 1])
+            ids.append(self.ids[start:end])
+            scores.append(self.vectors[start:end] @ query)
+        if not ids:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.float32)
+        ids = np.concatenate(ids)
+        order = np.argsort(ids)
+        return ids[order], np.concatenate(scores)[order]
+
+    def search(self, query, k):
+        """(ids, scores) of the k most similar vectors found in the probed lists, best first"""
+        ids, scores = self.probe(query)
+        best = top_k(scores, k)
+        return ids[best], scores[best]
+
+    def search_many(self, queries, k):
+        return [self.search(query, k) for query in queries]
+
+def open_ivf_index(path, nprobe=IVF_NPROBE, nlist=None):
+    """IVF index of the embeddings saved at path, (re)built in the directory next to them when it is
+    missing, older than the embeddings, or built with a different explicitly given nlist"""
+    directory = ivf_dir(path)
+    meta_path = os.path.join(directory, "meta.json")
+    stale = not os.path.exists(meta_path) or os.path.getmtime(meta_path) < os.path.getmtime(path)
+    if not stale:
+        with open(meta_path, "r") as file:
+            meta = json.load(file)
+        stale = meta.get("version") != IVF_VERSION or (nlist is not None and meta.get("nlist") != nlist)
+    if stale:
+        embeddings = np.load(path, mmap_mode="r")
+        arrays = build_ivf(embeddings, nlist)
+        write_ivf(directory, arrays, len(arrays["centroids"]))
+    return IVFIndex.open(directory, nprobe)
@@ -1,142 +1,298 @@
-import json
-import string
 import math
-import pickle
 import os
+import re
+import heapq
+import tempfile
+import numpy as np
 
-from pathlib import Path
 from collections import Counter
-from nltk.stem import PorterStemmer
-
+from itertools import chain
+from multiprocessing import Pool
+
+from .analyzer import get_analyzer
+from .autocomplete import Autocomplete, normalize_prefix, write_autocomplete, term_entries, title_entries
+from .bm25 import bm25_idf, bm25_tables, bm25f_field_norms
+from .bm25_matrix import BM25Matrix
+from .boolean_query import parse_boolean_query, evaluate_boolean_query, positive_tokens
+from .ingest import iter_documents, batched
+from .postings import Postings, merge_postings, sorted_contains
+from .proximity import phrase_matches, min_distances
+from .spell import SpellIndex
+from .segment import (
+    Segment,
+    SegmentSet,
+    SegmentDocmap,
+    write_segment,
+    merge_segments,
+    read_manifest,
+    write_manifest,
+    open_segments,
+    segment_file_name,
+    remove_segment_files
+)
 from .search_utils import (
     DEFAULT_SEARCH_LIMIT,
     DATA_PATH,
-    STOPWORDS_PATH,
     CACHE_DIR,
-    INDEX_FILE_NAME,
-    DOCMAP_FILE_NAME,
-    TERM_FREQUENCIES_FILE_NAME,
-    DOC_LENGTHS_FILE_NAME,
+    MANIFEST_FILE_NAME,
+    MAX_DELTA_SEGMENTS,
+    BUILD_SHARDS_PER_WORKER,
+    BUILD_BATCH_SIZE,
     BM25_K1,
-    BM25_B
+    BM25_B,
+    BM25F_BOOSTS,
+    BM25F_B,
+    FIELD_POSITION_GAP,
+    PROXIMITY_WINDOW
 )
 
 def process_str(text):
     """lowercase, delete punctuation, split words, 
     remove empty tokens and stopwords, stemming"""
-    translator = str.maketrans("", "", string.punctuation)
-
-    with open(STOPWORDS_PATH, "r") as file:
-        stop_words = file.read().splitlines()
-
-    stemmer = PorterStemmer()
-    
-    processed_s = text.lower().translate(translator).split()
-    processed_s = [stemmer.stem(s) for s in processed_s if s != "" and s not in stop_words]
-
-    return processed_s
-
-def get_movies_by_keyword(keyword):
-    keyword_tokens = process_str(keyword)
+    return get_analyzer().tokenize(text)
 
+def get_movies_by_keyword(query, limit=DEFAULT_SEARCH_LIMIT, rank=False):
+    """boolean search: AND / OR / NOT, parentheses and "quoted phrases"; adjacent words are ANDed"""
     try:
         inverted_idx = get_inverted_idx_load(DATA_PATH)
     except Exception as e:
         print(e)
+        return
 
-
-    found_movies = []
-    # instead, iterate over each token in the query, and use the inverted index to get any matching documents for each token. Once you have 5 results, 
-    # stop searching and just return them. Print the resulting document titles and IDs.
     try:
-        for keyword_token in keyword_tokens:
-            docs = inverted_idx.get_documents(keyword_token)
-            if docs:
-                for doc in docs:
-                    found_movies.append({"id": doc, "title": inverted_idx.docmap[doc]["title"]})
-                    if len(found_movies) == DEFAULT_SEARCH_LIMIT:
-                        raise StopIteration
-    except StopIteration:
-        pass
-        
-    for movie in found_movies:
-        print(f"{movie["id"]} {movie["title"]}")
+        results = inverted_idx.boolean_search(query, limit, rank)
+    except ValueError as e:
+        # a malformed query: a dangling operator, unbalanced parentheses or an unterminated quote
+        print(e)
+        return
+
+    for doc_id, (title, score) in results:
+        if score is None:
+            print(f"{doc_id} {title}")
+        else:
+            print(f"{doc_id} {title} - Score: {score:.2f}")
+
+def add_document_tokens(term_postings, doc_ordinal, title_tokens, description_tokens, positions=False):
+    """add each token of the already tokenized title and description to the postings with the document ordinal,
+    how many of its occurrences are in the title (and, with positions, where in the title + description text it occurs:
+    the description starts FIELD_POSITION_GAP positions past the end of the title)"""
+    title_counts = Counter(title_tokens)
+    text_tokens = title_tokens + description_tokens
+    if positions:
+        token_positions = {}
+        for position, text_token in enumerate(title_tokens):
+            token_positions.setdefault(text_token, []).append(position)
+        for position, text_token in enumerate(description_tokens, len(title_tokens) + FIELD_POSITION_GAP):
+            token_positions.setdefault(text_token, []).append(position)
+        for text_token, occurrences in token_positions.items():
+            try:
+                doc_ordinals, term_frequencies, title_frequencies, term_positions = term_postings[text_token]
+            except KeyError:
+                doc_ordinals, term_frequencies, title_frequencies, term_positions = term_postings[text_token] = ([], [], [], [])
+            doc_ordinals.append(doc_ordinal)
+            term_frequencies.append(len(occurrences))
+            title_frequencies.append(title_counts[text_token])
+            term_positions.extend(occurrences)
+        return
+
+    for text_token, tf in Counter(text_tokens).items():
+        try:
+            doc_ordinals, term_frequencies, title_frequencies = term_postings[text_token]
+        except KeyError:
+            doc_ordinals, term_frequencies, title_frequencies = term_postings[text_token] = ([], [], [])
+        doc_ordinals.append(doc_ordinal)
+        term_frequencies.append(tf)
+        title_frequencies.append(title_counts[text_token])
+
+def index_texts(texts, analyzer, first_ordinal=0, positions=False):
+    """postings, document lengths and title lengths of (title, description) texts, numbered in order from first_ordinal"""
+    term_postings = {}
+    doc_lengths = []
+    title_lengths = []
+    titles_tokens = analyzer.tokenize_many(title for title, _ in texts)
+    descriptions_tokens = analyzer.tokenize_many(description for _, description in texts)
+    for doc_ordinal, (title_tokens, description_tokens) in enumerate(zip(titles_tokens, descriptions_tokens), first_ordinal):
+        add_document_tokens(term_postings, doc_ordinal, title_tokens, description_tokens, positions)
+        doc_lengths.append(len(title_tokens) + len(description_tokens))
+        title_lengths.append(len(title_tokens))
+    return Postings.from_dict(term_postings, True, positions), doc_lengths, title_lengths
+
+# analyzer of a build worker process, set once by the pool initializer
+_worker_analyzer = None
+
+def _init_build_worker(analyzer):
+    global _worker_analyzer
+    _worker_analyzer = analyzer
+
+def _index_shard(shard):
+    first_ordinal, texts, positions = shard
+    return index_texts(texts, _worker_analyzer, first_ordinal, positions)
 
 class InvertedIndex():
-    def __init__(self, path):
+    def __init__(self, path, analyzer=None):
         # path to json data
         self.path = path
-        # a dictionary mapping tokens (strings) to sets of document IDs (integers).
-        self.index = {}
-        # a dictionary mapping document IDs to their full document objects.
+        # shared text analyzer (cached stopwords and stems)
+        self.analyzer = analyzer if analyzer is not None else get_analyzer()
+        # postings of every token: sorted doc ordinals with parallel term frequencies
+        # (a Postings after build, the memory-mapped SegmentSet after load)
+        self.postings = Postings.from_dict({})
+        # the memory-mapped base and delta segments, None until load
+        self.segments = None
+        # directory and manifest the segments were loaded from
+        self.cache_dir = None
+        self.manifest = None
+        # temporary directory holding the runs of a build too large for one batch, until save
+        self.spill_dir = None
+        # a mapping of document IDs to their full document objects.
         self.docmap = {}
-        # a dictionary of document IDs to Counter objects for keeping track of how many times each term appears in each document
-        self.term_frequencies = {}
-        # a dictionary of document IDs to their lengths
-        self.doc_lengths = {}
-
-    def __add_document(self, doc_id, text):
-        """tokenize the input text, then add each token to the index with the document ID"""
-        text_tokens = process_str(text)
-        self.term_frequencies[doc_id].update(text_tokens)
-        self.doc_lengths[doc_id] = len(text_tokens)
-        for text_token in text_tokens:
-            try:
-                self.index[text_token].add(doc_id)
-            except KeyError:
-                self.index[text_token] = {doc_id}
+        # number of live (not deleted) documents
+        self.num_docs = 0
+        # every document has an ordinal; doc_ids maps that ordinal back to the document ID
+        self.doc_ids = np.zeros(0, dtype=np.int64)
+        # document lengths in tokens, by ordinal
+        self.doc_lengths = np.zeros(0, dtype=np.int32)
+        # title lengths in tokens, by ordinal (the description is the rest of the document)
+        self.title_lengths = np.zeros(0, dtype=np.int32)
+        # scoring tables, computed once after build/load
+        self.avg_doc_length = 0.0
+        # BM25 length normalization factor of every document, by ordinal
+        self.length_norms = np.zeros(0)
+        # a dictionary mapping tokens to the highest BM25 score they give any document (WAND upper bound)
+        self.max_impacts = {}
+        # BM25Matrix scoring backend, built on first use
+        self.bm25_matrix = None
+        # BM25F (title, description) length normalization of every document, computed on first use
+        self.field_norms = None
+        # SpellIndex over the vocabulary, built on first use
+        self.spell_index = None
+        # Autocomplete of terms and titles, opened or built on first use
+        self.autocomplete = None
+        # how many documents the last bm25_search scored
+        self.last_search_stats = {}
+
+    def __index_documents(self, movies, workers=1, positions=False):
+        """postings, document IDs, document lengths and title lengths of movies; ordinals follow ascending document IDs.
+        With several workers, contiguous shards are tokenized in a process pool and their postings merged."""
+        movies = sorted(movies, key=lambda movie: movie["id"])
+        texts = [(movie["title"], movie["description"]) for movie in movies]
+
+        if workers <= 1:
+            postings, doc_lengths, title_lengths = index_texts(texts, self.analyzer, positions=positions)
+        else:
+            shard_size = max(1, -(-len(texts) // (workers * BUILD_SHARDS_PER_WORKER)))
+            shards = [(start, texts[start:start + shard_size], positions) for start in range(0, len(texts), shard_size)]
+            with Pool(workers, initializer=_init_build_worker, initargs=(self.analyzer,)) as pool:
+                shard_results = pool.map(_index_shard, shards)
+            postings = merge_postings([shard_postings for shard_postings, _, _ in shard_results])
+            doc_lengths = [doc_length for _, shard_doc_lengths, _ in shard_results for doc_length in shard_doc_lengths]
+            title_lengths = [title_length for _, _, shard_title_lengths in shard_results for title_length in shard_title_lengths]
+
+        return (
+            movies,
+            postings,
+            np.array([movie["id"] for movie in movies], dtype=np.int64),
+            np.array(doc_lengths, dtype=np.int32),
+            np.array(title_lengths, dtype=np.int32)
+        )
+
+    def __get_doc_ordinal(self, doc_id):
+        """ordinal of the live version of a document ID, None if it is not indexed"""
+        if self.segments is not None:
+            return self.segments.get_doc_ordinal(doc_id)
+
+        doc_ordinal = int(np.searchsorted(self.doc_ids, doc_id))
+        if doc_ordinal < len(self.doc_ids) and self.doc_ids[doc_ordinal] == doc_id:
+            return doc_ordinal
+        return None
+
+    def has_document(self, doc_id):
+        """whether a live version of a document ID is indexed (False once it is deleted)"""
+        return self.__get_doc_ordinal(doc_id) is not None
+
+    def __get_max_impact(self, term, doc_ordinals, term_frequencies, idf):
+        try:
+            return self.max_impacts[term]
+        except KeyError:
+            pass
 
-    def __get_avg_doc_length(self):
-        number_docs = len(self.doc_lengths)
-        if number_docs == 0:
-            return 0.0
-        
-        accumulated_length = 0
-        for length in self.doc_lengths.values():
-            accumulated_length += length
+        max_impact = self.segments.max_impact(term) if self.segments is not None else None
+        if max_impact is None:
+            # statistics changed since the segments were written: compute it from the live postings
+            max_impact = float((self.__bm25_tf(term_frequencies, doc_ordinals) * idf).max())
+        self.max_impacts[term] = max_impact
+        return max_impact
 
-        return accumulated_length / number_docs
+    def __bm25_tf(self, term_frequencies, doc_ordinals, k1=BM25_K1):
+        return (term_frequencies * (k1 + 1)) / (term_frequencies + k1 * self.length_norms[doc_ordinals])
 
     def get_documents(self, term):
         """get the set of document IDs for a given token, and return them as a list, sorted in ascending order"""
         # lowercase term
-        try:
-            return sorted(self.index[term.lower()])
-        except KeyError:
-            return []
-
-    def build(self):
-        """iterate over all the movies from self.path and add them to both the index and the docmap"""
+        doc_ordinals, _ = self.postings.get(term.lower())
+        return np.sort(self.doc_ids[doc_ordinals]).tolist()
+
+    def build(self, workers=1, batch_size=BUILD_BATCH_SIZE, positions=False):
+        """iterate over all the movies from self.path and add them to both the index and the docmap.
+        The movies are streamed from the file batch_size at a time: a corpus that fits in one batch
+        is indexed in memory, otherwise every batch is indexed and spilled to disk as a run segment,
+        and the runs are searched as one index and merged into the base segment by save.
+        With positions, the token positions of every posting are stored for phrase and proximity queries."""
         # When adding the movie data to the index with __add_document(), concatenate the title and the description and use that as the input text. 
         # For example: f"{m['title']} {m['description']}"
-        with open(self.path, "r") as file:
-            movies = json.load(file)["movies"]
-
-        for movie in movies:
-            self.term_frequencies[movie["id"]] = Counter()
-            self.__add_document(movie["id"], f"{movie['title']} {movie['description']}")
-
-            self.docmap[movie["id"]] = movie
+        batches = batched(iter_documents(self.path), batch_size)
+        first_batch = next(batches, [])
+        second_batch = next(batches, None)
+
+        if second_batch is None:
+            movies, self.postings, self.doc_ids, self.doc_lengths, self.title_lengths = self.__index_documents(first_batch, workers, positions)
+            self.docmap = {movie["id"]: movie for movie in movies}
+            self.segments = None
+            self.spill_dir = None
+            self.num_docs = len(movies)
+            self.avg_doc_length, self.length_norms, self.max_impacts = bm25_tables(self.postings, self.doc_lengths)
+            self.bm25_matrix = None
+            self.field_norms = None
+            self.spell_index = None
+            self.autocomplete = None
+            return
+
+        self.spill_dir = tempfile.TemporaryDirectory(prefix="index_build_")
+        runs = []
+        for batch in chain([first_batch, second_batch], batches):
+            movies, postings, doc_ids, doc_lengths, title_lengths = self.__index_documents(batch, workers, positions)
+            avg_doc_length, length_norms, max_impacts = bm25_tables(postings, doc_lengths)
+            run_path = os.path.join(self.spill_dir.name, f"run_{len(runs)}.seg")
+            write_segment(run_path, postings, doc_ids, doc_lengths, title_lengths, movies, avg_doc_length, length_norms, max_impacts)
+            runs.append(Segment(run_path))
+        self.__use_segments(SegmentSet(runs, []))
 
     def get_tf(self, doc_id, term):
         """return the times the token appears in the document with the given ID"""
         # if the term doesn't exist in that document, return 0
         # be sure to tokenize the term, but assume that there is only one token. If there's more than one, raise an exception.
-        term_token = process_str(term)
+        term_token = self.analyzer.tokenize(term)
         if len(term_token) != 1:
             raise Exception("term argument is more than one token")
         term_token = term_token[0]
-        
-        try:
-            return self.term_frequencies[doc_id][term_token]
-        except KeyError:
+
+        doc_ordinal = self.__get_doc_ordinal(doc_id)
+        if doc_ordinal is None:
             return 0
+        doc_ordinals, term_frequencies = self.postings.get(term_token)
+        i = np.searchsorted(doc_ordinals, doc_ordinal)
+        if i < len(doc_ordinals) and doc_ordinals[i] == doc_ordinal:
+            return int(term_frequencies[i])
+        return 0
         
     def get_bm25_tf(self, doc_id, term, k1=BM25_K1, b=BM25_B):
-        doc_length = self.doc_lengths[doc_id]
-        avg_doc_length = self.__get_avg_doc_length()
+        doc_ordinal = self.__get_doc_ordinal(doc_id)
+        # a document that is not indexed contains no term, as in get_tf
+        if doc_ordinal is None:
+            return 0.0
+        doc_length = self.doc_lengths[doc_ordinal]
         # Length normalization factor
-        length_norm = 1 - b + b * (doc_length / avg_doc_length)
+        length_norm = 1 - b + b * (doc_length / self.avg_doc_length)
         
         tf = self.get_tf(doc_id, term)
         # Apply to term frequency
@@ -144,91 +300,495 @@ class InvertedIndex():
         
     def get_bm25_idf(self, term):
         """"""
-        term_token = process_str(term)
+        term_token = self.analyzer.tokenize(term)
         if len(term_token) != 1:
             raise Exception("term argument is more than one token")
         term_token = term_token[0]
 
-        N = len(self.docmap)
-        df = len(self.get_documents(term_token))        
-        return math.log((N - df + 0.5) / (df + 0.5) + 1)
+        return bm25_idf(self.num_docs, self.postings.df(term_token))
     
     def bm25(self, doc_id, term):
         bm25_tf = self.get_bm25_tf(doc_id, term)
         bm25_idf = self.get_bm25_idf(term)
         return bm25_tf * bm25_idf
     
-    def bm25_search(self, query, limit):
-        # Tokenize the query.
-        # Initialize a scores dictionary, to map document IDs to their total BM25 scores.
-        # For each document in the index, calculate the total BM25 score:
-        # For each query token, add its BM25 score to the document's running total.
-        # Store the total score in the scores dictionary.
-        # Sort the documents by score in descending order.
-        # Return the top limit documents along with their scores.
-        query_tokens = process_str(query)
+    def bm25_search(self, query, limit, pruning=None, proximity=0.0, backend="postings"):
+        """term-at-a-time BM25: only the postings of the query terms are scored,
+        using the length normalization table computed at build/load.
+        With pruning="wand" the same top results are found with WAND dynamic pruning.
+        With backend="matrix" the same scores come from the precomputed BM25 matrix instead.
+        Quoted parts of the query are phrases: only documents containing every phrase are returned.
+        A proximity weight above 0 adds weight / distance to a document's score for every pair of
+        consecutive query terms, distance being how close the two terms get in the document."""
+        query_tokens, phrase_doc_ordinals = self.__parse_query(query, proximity)
+
+        match backend, pruning:
+            case "postings", None:
+                doc_ordinals, scores = self.__score_exhaustive(self.__query_terms(query_tokens))
+            case "postings", "wand":
+                if proximity:
+                    raise ValueError("the proximity boost cannot be combined with WAND pruning")
+                doc_ordinals, scores = self.__score_wand(self.__query_terms(query_tokens), limit, phrase_doc_ordinals)
+                phrase_doc_ordinals = None
+            case "matrix", None:
+                doc_ordinals, scores = self.__matrix_hits(self.get_bm25_matrix().score_many([query_tokens])[0])
+            case ("postings" | "matrix"), _:
+                raise ValueError(f"unknown pruning method for the {backend} backend: {pruning}")
+            case _:
+                raise ValueError(f"unknown scoring backend: {backend}")
+
+        if phrase_doc_ordinals is not None:
+            keep = np.isin(doc_ordinals, phrase_doc_ordinals)
+            doc_ordinals, scores = doc_ordinals[keep], scores[keep]
+        if proximity:
+            scores = scores + self.__proximity_boost(query_tokens, doc_ordinals, proximity)
+
+        return self.__results(doc_ordinals, scores, limit)
+
+    def bm25f_search(self, query, limit, boosts=None, k1=BM25_K1):
+        """term-at-a-time BM25F over the title and description fields: a term's occurrences in each field
+        are length normalized against that field's average length and weighted by the field's boost
+        before one BM25 saturation, so a title hit outweighs a passing mention in a long description.
+        boosts overrides some or all of BM25F_BOOSTS. Quoted parts of the query are phrases, as in bm25_search."""
+        boosts = {**BM25F_BOOSTS, **(boosts or {})}
+        query_tokens, phrase_doc_ordinals = self.__parse_query(query)
+        title_norms, description_norms = self.get_field_norms()
+
+        matched_ordinals = []
+        contributions = []
+        for query_token, query_tf in Counter(query_tokens).items():
+            doc_ordinals, term_frequencies, title_frequencies = self.postings.get_fields(query_token)
+            if len(doc_ordinals) == 0:
+                continue
+            idf = bm25_idf(self.num_docs, len(doc_ordinals))
+            weighted_tf = (
+                boosts["title"] * title_frequencies / title_norms[doc_ordinals]
+                + boosts["description"] * (term_frequencies - title_frequencies) / description_norms[doc_ordinals]
+            )
+            matched_ordinals.append(doc_ordinals)
+            contributions.append(query_tf * (weighted_tf * (k1 + 1) / (weighted_tf + k1) * idf))
+
+        if not matched_ordinals:
+            self.last_search_stats = {"scored": 0}
+            return []
+        doc_ordinals, accumulator_ids = np.unique(np.concatenate(matched_ordinals), return_inverse=True)
+        scores = np.bincount(accumulator_ids, weights=np.concatenate(contributions))
+        self.last_search_stats = {"scored": len(doc_ordinals)}
+
+        if phrase_doc_ordinals is not None:
+            keep = np.isin(doc_ordinals, phrase_doc_ordinals)
+            doc_ordinals, scores = doc_ordinals[keep], scores[keep]
+        return self.__results(doc_ordinals, scores, limit)
+
+    def get_field_norms(self, b=BM25F_B):
+        """(title, description) BM25F length normalization of every document ordinal,
+        computed from the live documents' field lengths on first use"""
+        if self.field_norms is None:
+            live = self.segments.live_doc_ordinals() if self.segments is not None else slice(None)
+            description_lengths = self.doc_lengths - self.title_lengths
+            self.field_norms = (
+                bm25f_field_norms(self.title_lengths, self.title_lengths[live], b["title"]),
+                bm25f_field_norms(description_lengths, description_lengths[live], b["description"])
+            )
+        return self.field_norms
+
+    def get_spell_index(self):
+        """the SpellIndex over the live vocabulary, built on first use with the surface forms of the autocomplete terms"""
+        if self.spell_index is None:
+            self.spell_index = SpellIndex.from_postings(self.postings, self.get_autocomplete().displays("terms"))
+        return self.spell_index
+
+    def correct_spelling(self, query):
+        """query with its misspelled words replaced by the closest indexed terms, found locally"""
+        return self.get_spell_index().correct_query(query, self.analyzer)
+
+    def get_autocomplete(self):
+        """the Autocomplete saved next to a loaded base segment, or built from the live index
+        when there is none (an index not saved yet, or with delta segments)"""
+        if self.autocomplete is None:
+            path = None
+            if self.segments is not None and self.segments.is_single() and self.cache_dir is not None:
+                path = os.path.join(self.cache_dir, autocomplete_file_name(self.manifest["segments"][0]["file"]))
+            if path is not None and os.path.exists(path):
+                self.autocomplete = Autocomplete.open(path)
+            else:
+                dfs = self.postings.dfs()
+                live = dfs > 0
+                terms = [term for term, is_live in zip(self.postings.terms, live.tolist()) if is_live]
+                surface_forms = self.analyzer.surface_forms(document_text(document) for document in self.docmap.values())
+                self.autocomplete = Autocomplete.from_entries(term_entries(terms, dfs[live], surface_forms), title_entries(self.docmap.values()))
+        return self.autocomplete
+
+    def complete(self, prefix, limit, field="terms"):
+        """top limit (completion, score) of a prefix: indexed terms by document frequency, shown as words,
+        or titles by popularity (description length without one). The terms are stems, so a term prefix
+        is looked up both as typed and stemmed: a whole word that stemming shortens still completes."""
+        autocomplete = self.get_autocomplete()
+        completions = autocomplete.complete(prefix, limit, field)
+        if field != "terms":
+            return completions
+
+        word = normalize_prefix(prefix).strip()
+        stemmed = self.analyzer.stem(word) if word else word
+        if stemmed != word:
+            best = dict(completions)
+            for completion, score in autocomplete.complete(stemmed, limit, field):
+                best.setdefault(completion, score)
+            completions = sorted(best.items(), key=lambda item: (-item[1], item[0]))[:limit]
+        return completions
+
+    def bm25_search_many(self, queries, limit, backend="matrix"):
+        """bm25_search of every query; the matrix backend scores each batch of queries with one sparse-dense product"""
+        if backend != "matrix":
+            return [self.bm25_search(query, limit, backend=backend) for query in queries]
+
+        parsed_queries = [self.__parse_query(query) for query in queries]
+        results = []
+        for start, block in self.get_bm25_matrix().score_batches([query_tokens for query_tokens, _ in parsed_queries]):
+            for (_, phrase_doc_ordinals), row in zip(parsed_queries[start:start + len(block)], block):
+                doc_ordinals, scores = self.__matrix_hits(row)
+                if phrase_doc_ordinals is not None:
+                    keep = np.isin(doc_ordinals, phrase_doc_ordinals)
+                    doc_ordinals, scores = doc_ordinals[keep], scores[keep]
+                results.append(self.__results(doc_ordinals, scores, limit))
+        return results
+
+    def __parse_query(self, query, proximity=0.0):
+        """query tokens, and the ordinals of the documents containing every quoted phrase (None without phrases)"""
+        query_tokens = self.analyzer.tokenize(query)
+        phrases = [tokens for tokens in map(self.analyzer.tokenize, re.findall(r'"([^"]*)"', query)) if tokens]
+        if (phrases or proximity) and not self.postings.has_positions:
+            raise Exception("phrase and proximity queries need positions: rebuild the index with --positions")
+        return query_tokens, self.__phrase_doc_ordinals(phrases) if phrases else None
+
+    def __results(self, doc_ordinals, scores, limit):
+        return [
+            (doc_id, (self.docmap[doc_id]["title"], score))
+            for doc_id, score in self.__top_scores(doc_ordinals, scores, limit)
+        ]
+
+    def get_bm25_matrix(self):
+        """the BM25Matrix scoring backend, built from the live postings on first use"""
+        if self.bm25_matrix is None:
+            postings = self.postings.to_postings() if self.segments is not None else self.postings
+            self.bm25_matrix = BM25Matrix.from_postings(postings, self.length_norms, self.num_docs)
+        return self.bm25_matrix
+
+    def __matrix_hits(self, scores):
+        # every BM25 weight is positive, so the documents matching a query term are the ones scoring above 0
+        doc_ordinals = np.flatnonzero(scores > 0)
+        self.last_search_stats = {"scored": len(doc_ordinals)}
+        return doc_ordinals, scores[doc_ordinals]
+
+    def __query_terms(self, query_tokens):
+        """(token, query tf, doc ordinals, term frequencies, idf) of every distinct query token that is indexed"""
+        # a query token repeated n times contributes its BM25 score n times
+        query_terms = []
+        for query_token, query_tf in Counter(query_tokens).items():
+            doc_ordinals, term_frequencies = self.postings.get(query_token)
+            if len(doc_ordinals):
+                idf = bm25_idf(self.num_docs, len(doc_ordinals))
+                query_terms.append((query_token, query_tf, doc_ordinals, term_frequencies, idf))
+        return query_terms
+
+    def boolean_search(self, query, limit, rank=False):
+        """documents matching an AND / OR / NOT query with parentheses and "quoted phrases".
+        Matches come in ascending document ID order with a None score, or with rank,
+        by the BM25 score of their terms that are not negated."""
+        node = parse_boolean_query(query, self.analyzer)
+        doc_ordinals = self.boolean_doc_ordinals(node)
+
+        if not rank:
+            doc_ids = np.sort(self.doc_ids[doc_ordinals])[:max(limit, 0)].tolist()
+            return [(doc_id, (self.docmap[doc_id]["title"], None)) for doc_id in doc_ids]
+
+        scored_ordinals, scored = self.__score_exhaustive(self.__query_terms(positive_tokens(node)))
+        # matches without any positively scored term (e.g. NOT queries) score 0
+        scores = np.zeros(len(doc_ordinals))
+        found = sorted_contains(scored_ordinals, doc_ordinals)
+        scores[found] = scored[np.searchsorted(scored_ordinals, doc_ordinals[found])]
+        return self.__results(doc_ordinals, scores, limit)
+
+    def boolean_doc_ordinals(self, node):
+        """sorted ordinals of the live documents matching a parsed boolean query"""
+        if self.segments is not None:
+            all_doc_ordinals = self.segments.live_doc_ordinals()
+        else:
+            all_doc_ordinals = np.arange(len(self.doc_ids))
+        return evaluate_boolean_query(node, self.postings, all_doc_ordinals)
+
+    def boolean_doc_ids(self, query):
+        """set of the document IDs matching a boolean query, e.g. as a filter for other searches"""
+        return set(self.doc_ids[self.boolean_doc_ordinals(parse_boolean_query(query, self.analyzer))].tolist())
+
+    def __phrase_doc_ordinals(self, phrases):
+        """sorted ordinals of the documents containing every phrase"""
+        doc_ordinals = None
+        for phrase in phrases:
+            phrase_postings = [self.postings.get_positions(token) for token in phrase]
+            matches, _ = phrase_matches(phrase_postings)
+            doc_ordinals = matches if doc_ordinals is None else np.intersect1d(doc_ordinals, matches, assume_unique=True)
+        return doc_ordinals
+
+    def __proximity_boost(self, query_tokens, doc_ordinals, weight):
+        """weight / smallest distance of every pair of consecutive query terms at most PROXIMITY_WINDOW apart, summed per document"""
+        boost = np.zeros(len(doc_ordinals))
+        positions = {token: self.postings.get_positions(token) for token in set(query_tokens)}
+        for first, second in zip(query_tokens, query_tokens[1:]):
+            if first == second:
+                continue
+            pair_doc_ordinals, distances = min_distances(positions[first], positions[second])
+            close = distances <= PROXIMITY_WINDOW
+            pair_doc_ordinals, distances = pair_doc_ordinals[close], distances[close]
+            found = sorted_contains(doc_ordinals, pair_doc_ordinals)
+            boost[np.searchsorted(doc_ordinals, pair_doc_ordinals[found])] += weight / distances[found]
+        return boost
+
+    def __top_scores(self, doc_ordinals, scores, limit):
+        """(document ID, score) of the best limit documents, ties broken by ascending document ID"""
+        if limit <= 0 or len(scores) == 0:
+            return []
+        if len(scores) > limit:
+            # keep everything scoring at least the limit-th best score, so ties are resolved below
+            kth_score = np.partition(scores, len(scores) - limit)[len(scores) - limit]
+            keep = scores >= kth_score
+            doc_ordinals, scores = doc_ordinals[keep], scores[keep]
+        doc_ids = self.doc_ids[doc_ordinals]
+        order = np.lexsort((doc_ids, -scores))[:limit]
+        return list(zip(doc_ids[order].tolist(), scores[order].tolist()))
+
+    def __score_exhaustive(self, query_terms):
+        if not query_terms:
+            self.last_search_stats = {"scored": 0}
+            return np.zeros(0, dtype=np.int32), np.zeros(0)
+
+        matched_ordinals = []
+        contributions = []
+        for _, query_tf, doc_ordinals, term_frequencies, idf in query_terms:
+            matched_ordinals.append(doc_ordinals)
+            contributions.append(query_tf * (self.__bm25_tf(term_frequencies, doc_ordinals) * idf))
+
+        # accumulators, one per document that matches at least one query term, summed in query order
+        doc_ordinals, accumulator_ids = np.unique(np.concatenate(matched_ordinals), return_inverse=True)
+        scores = np.bincount(accumulator_ids, weights=np.concatenate(contributions))
+
+        self.last_search_stats = {"scored": len(doc_ordinals)}
+        return doc_ordinals, scores
+
+    def __score_wand(self, query_terms, limit, allowed_doc_ordinals=None, k1=BM25_K1):
+        """document-at-a-time WAND: a document is fully scored only when the upper bounds
+        of the terms pointing at or before it can beat the current k-th best score.
+        With allowed_doc_ordinals, any other document is skipped without being scored."""
+        self.last_search_stats = {"scored": 0}
+        if limit <= 0:
+            return np.zeros(0, dtype=np.int32), np.zeros(0)
+
+        # cursors: [current position, doc ordinals, term frequencies, upper bound, idf, query tf, order in the query]
+        cursors = []
+        for order, (query_token, query_tf, doc_ordinals, term_frequencies, idf) in enumerate(query_terms):
+            upper_bound = query_tf * self.__get_max_impact(query_token, doc_ordinals, term_frequencies, idf)
+            cursors.append([0, doc_ordinals, term_frequencies, upper_bound, idf, query_tf, order])
+
+        allowed = set(allowed_doc_ordinals.tolist()) if allowed_doc_ordinals is not None else None
+        # min-heap of the best (score, -doc_id) found so far
+        top = []
         scores = {}
-        for doc_id in self.docmap.keys():
-            bm25_sum = 0
-            for query_token in query_tokens:
-                bm25_sum += self.bm25(doc_id, query_token)
-            scores[doc_id] = (self.docmap[doc_id]["title"], bm25_sum)
-        
-        sorted_scores = sorted(scores.items(), key=lambda item: item[1][1], reverse=True)
-        return sorted_scores[:limit]
-                
-
-    def save(self):
-        """save the index and docmap attributes to disk using the pickle module's dump function"""
-        # Use the file path/name cache/index.pkl for the index.
-        # Use the file path/name cache/docmap.pkl for the docmap.
-        # Have this method create the cache directory if it doesn't exist (before trying to write files into it).
-        Path("cache").mkdir(parents=True, exist_ok=True)
+        while cursors:
+            cursors.sort(key=lambda cursor: cursor[1][cursor[0]])
+            threshold = top[0][0] if len(top) == limit else 0.0
+
+            # pivot: first cursor where the accumulated upper bounds reach the threshold
+            pivot = None
+            accumulated = 0.0
+            for i, cursor in enumerate(cursors):
+                accumulated += cursor[3]
+                # tolerance keeps documents tying with the threshold, as exhaustive scoring does
+                if accumulated >= threshold - 1e-9:
+                    pivot = i
+                    break
+            if pivot is None:
+                break
+
+            pivot_doc = int(cursors[pivot][1][cursors[pivot][0]])
+            if cursors[0][1][cursors[0][0]] == pivot_doc:
+                # every cursor up to the pivot sits on pivot_doc: score it in query order like __score_exhaustive
+                matching = sorted(
+                    (cursor for cursor in cursors if cursor[1][cursor[0]] == pivot_doc),
+                    key=lambda cursor: cursor[6]
+                )
+                if allowed is not None and pivot_doc not in allowed:
+                    for cursor in matching:
+                        cursor[0] += 1
+                    cursors = [cursor for cursor in cursors if cursor[0] < len(cursor[1])]
+                    continue
+
+                score = 0.0
+                for cursor in matching:
+                    tf = cursor[2][cursor[0]]
+                    bm25_tf = (tf * (k1 + 1)) / (tf + k1 * self.length_norms[pivot_doc])
+                    score = score + cursor[5] * (bm25_tf * cursor[4])
+                    cursor[0] += 1
+                scores[pivot_doc] = score
+
+                entry = (score, -int(self.doc_ids[pivot_doc]))
+                if len(top) < limit:
+                    heapq.heappush(top, entry)
+                elif entry > top[0]:
+                    heapq.heapreplace(top, entry)
+            else:
+                # no document before pivot_doc can make it into the top results: skip ahead
+                for cursor in cursors[:pivot]:
+                    cursor[0] += int(np.searchsorted(cursor[1][cursor[0]:], pivot_doc))
+
+            cursors = [cursor for cursor in cursors if cursor[0] < len(cursor[1])]
+
+        self.last_search_stats = {"scored": len(scores)}
+        return np.fromiter(scores.keys(), dtype=np.int32, count=len(scores)), np.fromiter(scores.values(), dtype=np.float64, count=len(scores))
+
+    def save(self, cache_dir=CACHE_DIR):
+        """write the index as the single base segment (term dictionary, compressed postings,
+        scoring tables, document arrays and the docstore) and point the manifest at it.
+        An index held in segments (spilled build runs, or loaded base and deltas) is merged into it."""
+        os.makedirs(cache_dir, exist_ok=True)
 
-        with open(os.path.join(CACHE_DIR, INDEX_FILE_NAME), "wb") as file:
-            pickle.dump(self.index, file)
-
-        with open(os.path.join(CACHE_DIR, DOCMAP_FILE_NAME), "wb") as file:
-            pickle.dump(self.docmap, file)
-
-        with open(os.path.join(CACHE_DIR, TERM_FREQUENCIES_FILE_NAME), "wb") as file:
-            pickle.dump(self.term_frequencies, file)
-
-        with open(os.path.join(CACHE_DIR, DOC_LENGTHS_FILE_NAME), "wb") as file:
-            pickle.dump(self.doc_lengths, file)
-
-    def load(self):
-        """load the index and docmap from disk using the pickle module's load function"""
-        # use cache/index.pkl for the index
-        # use cache/docmap.pkl for the docmap
-        # raise an error if the files don't exist
         try:
-            with open(os.path.join(CACHE_DIR, INDEX_FILE_NAME), "rb") as file:
-                self.index = pickle.load(file)
+            old_manifest = read_manifest(cache_dir, MANIFEST_FILE_NAME)
         except FileNotFoundError:
-            raise Exception("cache/index.pkl is missing")
-        
-        try:
-            with open(os.path.join(CACHE_DIR, DOCMAP_FILE_NAME), "rb") as file:
-                self.docmap = pickle.load(file)
-        except FileNotFoundError:
-            raise Exception("cache/docmap.pkl is missing")
-        
-        try:
-            with open(os.path.join(CACHE_DIR, TERM_FREQUENCIES_FILE_NAME), "rb") as file:
-                self.term_frequencies = pickle.load(file)
-        except FileNotFoundError:
-            raise Exception("cache/term_frequencies.pkl is missing")
-        
+            old_manifest = {"segments": [], "next_segment": 0}
+
+        file_name = segment_file_name(old_manifest["next_segment"])
+        if self.segments is not None:
+            merge_segments(self.segments, os.path.join(cache_dir, file_name))
+        else:
+            write_segment(
+                os.path.join(cache_dir, file_name),
+                self.postings,
+                self.doc_ids,
+                self.doc_lengths,
+                self.title_lengths,
+                [self.docmap[doc_id] for doc_id in self.doc_ids.tolist()],
+                self.avg_doc_length,
+                self.length_norms,
+                self.max_impacts
+            )
+        # the autocomplete file of a segment is written from the segment itself
+        segment = Segment(os.path.join(cache_dir, file_name))
+        surface_forms = self.analyzer.surface_forms(document_text(segment.get_document(doc_ordinal)) for doc_ordinal in range(segment.num_docs))
+        write_autocomplete(
+            os.path.join(cache_dir, autocomplete_file_name(file_name)),
+            term_entries(segment.terms, segment.sections["dfs"], surface_forms),
+            title_entries(segment.get_document(doc_ordinal) for doc_ordinal in range(segment.num_docs))
+        )
+        write_manifest(cache_dir, MANIFEST_FILE_NAME, {
+            "segments": [{"file": file_name, "deleted": []}],
+            "next_segment": old_manifest["next_segment"] + 1
+        })
+        remove_segment_files(cache_dir, old_manifest["segments"])
+        remove_segment_files(cache_dir, [{"file": autocomplete_file_name(entry["file"])} for entry in old_manifest["segments"]])
+
+    def load(self, cache_dir=CACHE_DIR):
+        """memory-map the segments listed in the manifest: only their headers are read here,
+        everything else is paged in when a query first touches it"""
+        # raise an error if the files don't exist
         try:
-            with open(os.path.join(CACHE_DIR, DOC_LENGTHS_FILE_NAME), "rb") as file:
-                self.doc_lengths = pickle.load(file)
-        except FileNotFoundError:
-            raise Exception("cache/doc_lengths.pkl is missing")
-
-def build_idx():
+            manifest = read_manifest(cache_dir, MANIFEST_FILE_NAME)
+            segments = open_segments(cache_dir, manifest)
+        except FileNotFoundError as e:
+            raise Exception(f"{e.filename} is missing")
+
+        self.cache_dir = cache_dir
+        self.manifest = manifest
+        self.spill_dir = None
+        self.__use_segments(segments)
+
+    def __use_segments(self, segments):
+        self.segments = segments
+        self.postings = segments
+        self.docmap = SegmentDocmap(segments)
+        self.num_docs = segments.num_docs
+        self.doc_ids = segments.doc_ids
+        self.doc_lengths = segments.doc_lengths
+        self.title_lengths = segments.title_lengths
+        self.avg_doc_length = segments.avg_doc_length
+        self.length_norms = segments.length_norms
+        if self.length_norms is None:
+            self.length_norms = 1 - BM25_B + BM25_B * (self.doc_lengths / self.avg_doc_length)
+        self.max_impacts = {}
+        self.bm25_matrix = None
+        self.field_norms = None
+        self.spell_index = None
+        self.autocomplete = None
+
+    def add_documents(self, movies):
+        """index new movies into a delta segment"""
+        self.__check_ids(movies, must_exist=False)
+        self.__write_delta(movies, [])
+
+    def update_documents(self, movies):
+        """tombstone the current versions of the movies and index the new versions into a delta segment"""
+        self.__check_ids(movies, must_exist=True)
+        self.__write_delta(movies, [self.__get_doc_ordinal(movie["id"]) for movie in movies])
+
+    def delete_documents(self, doc_ids):
+        """tombstone documents; their postings are dropped by the next merge"""
+        self.__check_ids([{"id": doc_id} for doc_id in doc_ids], must_exist=True)
+        self.__write_delta([], [self.__get_doc_ordinal(doc_id) for doc_id in doc_ids])
+
+    def __check_ids(self, movies, must_exist):
+        if self.manifest is None:
+            raise Exception("the index must be loaded before it can be changed")
+        doc_ids = [movie["id"] for movie in movies]
+        if len(set(doc_ids)) != len(doc_ids):
+            raise ValueError("the same document ID is given more than once")
+        for doc_id in doc_ids:
+            exists = self.__get_doc_ordinal(doc_id) is not None
+            if exists and not must_exist:
+                raise ValueError(f"document {doc_id} is already indexed")
+            if not exists and must_exist:
+                raise ValueError(f"document {doc_id} is not indexed")
+
+    def __write_delta(self, movies, deleted_ordinals):
+        manifest = self.manifest
+        for doc_ordinal in deleted_ordinals:
+            segment_id = int(np.searchsorted(self.segments.bases, doc_ordinal, side="right")) - 1
+            manifest["segments"][segment_id]["deleted"].append(doc_ordinal - int(self.segments.bases[segment_id]))
+
+        if movies:
+            # deltas store positions when the index does
+            movies, postings, doc_ids, doc_lengths, title_lengths = self.__index_documents(movies, positions=self.postings.has_positions)
+            avg_doc_length, length_norms, max_impacts = bm25_tables(postings, doc_lengths)
+            file_name = segment_file_name(manifest["next_segment"])
+            write_segment(
+                os.path.join(self.cache_dir, file_name),
+                postings, doc_ids, doc_lengths, title_lengths, movies, avg_doc_length, length_norms, max_impacts
+            )
+            manifest["segments"].append({"file": file_name, "deleted": []})
+            manifest["next_segment"] += 1
+
+        write_manifest(self.cache_dir, MANIFEST_FILE_NAME, manifest)
+        self.load(self.cache_dir)
+
+        if len(self.manifest["segments"]) - 1 > MAX_DELTA_SEGMENTS:
+            self.merge()
+
+    def merge(self):
+        """compact the base and delta segments into a new base segment without tombstones;
+        postings are merged as they are, nothing is tokenized again"""
+        if self.manifest is None:
+            raise Exception("the index must be loaded before it can be merged")
+
+        self.save(self.cache_dir)
+        self.load(self.cache_dir)
+
+def document_text(document):
+    return f"{document['title']} {document['description']}"
+
+def autocomplete_file_name(segment_file):
+    return f"{os.path.splitext(segment_file)[0]}.acp"
+
+def build_idx(workers=1, batch_size=BUILD_BATCH_SIZE, positions=False):
     inverted_idx = InvertedIndex(DATA_PATH)
-    inverted_idx.build()
+    inverted_idx.build(workers, batch_size, positions)
     inverted_idx.save()
 
 def get_tf(id, term):
@@ -236,6 +796,7 @@ def get_tf(id, term):
         inverted_idx = get_inverted_idx_load(DATA_PATH)
     except Exception as e:
         print(e)
+        return
 
     return inverted_idx.get_tf(id, term)
 
@@ -244,6 +805,7 @@ def bm25_tf_command(id, term, k1=BM25_K1, b=BM25_B):
         inverted_idx = get_inverted_idx_load(DATA_PATH)
     except Exception as e:
         print(e)
+        return
 
     return inverted_idx.get_bm25_tf(id, term, k1, b)
 
@@ -252,6 +814,7 @@ def get_idf(term):
         inverted_idx = get_inverted_idx_load(DATA_PATH)
     except Exception as e:
         print(e)
+        return
 
     doc_count = len(inverted_idx.docmap)
     term_doc_count = len(inverted_idx.get_documents(process_str(term)[0]))
@@ -262,11 +825,15 @@ def bm25_idf_command(term):
         inverted_idx = get_inverted_idx_load(DATA_PATH)
     except Exception as e:
         print(e)
+        return
 
     return inverted_idx.get_bm25_idf(term)
 
 def get_tfidf(id, term):
-    return get_tf(id, term) * get_idf(term)
+    tf = get_tf(id, term)
+    if tf is None:
+        return None
+    return tf * get_idf(term)
 
 def get_inverted_idx_load(DATA_PATH):
     inverted_idx = InvertedIndex(DATA_PATH)
@@ -276,10 +843,53 @@ def get_inverted_idx_load(DATA_PATH):
     except Exception as e:
         raise e
     
-def get_bm25_search_command(query, limit):
+def get_bm25_search_command(query, limit, pruning=None, proximity=0.0, backend="postings"):
     try:
         inverted_idx = get_inverted_idx_load(DATA_PATH)
     except Exception as e:
         print(e)
+        return []
+
+    return inverted_idx.bm25_search(query, limit, pruning, proximity, backend)
 
-    return inverted_idx.bm25_search(query, limit)
\ No newline at end of file
+def get_bm25f_search_command(query, limit, title_boost=BM25F_BOOSTS["title"], description_boost=BM25F_BOOSTS["description"]):
+    try:
+        inverted_idx = get_inverted_idx_load(DATA_PATH)
+    except Exception as e:
+        print(e)
+        return []
+
+    return inverted_idx.bm25f_search(query, limit, {"title": title_boost, "description": description_boost})
+
+def spell_command(query):
+    inverted_idx = get_inverted_idx_load(DATA_PATH)
+    return inverted_idx.correct_spelling(query)
+
+def complete_command(prefix, limit, field="terms"):
+    inverted_idx = get_inverted_idx_load(DATA_PATH)
+    return inverted_idx.complete(prefix, limit, field)
+
+def get_movies_from_file(path):
+    return list(iter_documents(path))
+
+def add_documents_command(path):
+    inverted_idx = get_inverted_idx_load(DATA_PATH)
+    movies = get_movies_from_file(path)
+    inverted_idx.add_documents(movies)
+    return len(movies)
+
+def update_documents_command(path):
+    inverted_idx = get_inverted_idx_load(DATA_PATH)
+    movies = get_movies_from_file(path)
+    inverted_idx.update_documents(movies)
+    return len(movies)
+
+def delete_documents_command(doc_ids):
+    inverted_idx = get_inverted_idx_load(DATA_PATH)
+    inverted_idx.delete_documents(doc_ids)
+    return len(doc_ids)
+
+def merge_idx():
+    inverted_idx = get_inverted_idx_load(DATA_PATH)
+    inverted_idx.merge()
+    return inverted_idx.num_docs
\ No newline at end of file
@@ -1,37 +1,71 @@
-from PIL import Image
-from sentence_transformers import SentenceTransformer
+import os
 
-from .search_utils import DATA_PATH, DEFAULT_SEARCH_LIMIT
-from .semantic_search import get_documents, cosine_similarity
+from functools import cached_property
+
+import numpy as np
+
+from .embedding_cache import encode_cached, embeddings_fresh, new_digest, source_fingerprint, update_digest
+from .embedding_store import open_embedding_index
+from .query_cache import get_query_cache
+from .search_utils import CACHE_DIR, DATA_PATH, DEFAULT_SEARCH_LIMIT, DEFAULT_EMBEDDING_PRECISION
+from .semantic_search import get_documents, movie_digest, movie_text
 
 class MultimodalSearch:
-    def __init__(self, documents, model_name="clip-ViT-B-32"):
-        self.model = SentenceTransformer(model_name)
+    def __init__(self, documents, model_name="clip-ViT-B-32", precision=DEFAULT_EMBEDDING_PRECISION, rescore=0):
+        self.model_name = model_name
         self.documents = documents
-        
-        self.texts = []
-        for doc in self.documents:
-            self.texts.append(f"{doc["title"]}: {doc["description"]}")
+        # text query embeddings of this model, in memory and on disk
+        self.query_cache = get_query_cache(model_name)
+
+        # the text embeddings are built per model through its embedding cache, then memory-mapped like the movie embeddings
+        path = os.path.join(CACHE_DIR, f"multimodal_{model_name}_embeddings.npy")
+        source = source_fingerprint(documents)
+        if not embeddings_fresh(path, model_name, source, lambda: movie_digest(documents)):
+            os.makedirs(CACHE_DIR, exist_ok=True)
+            digest = new_digest()
+            def texts():
+                for doc in self.documents:
+                    text = movie_text(doc)
+                    update_digest(digest, text)
+                    yield text
+            encode_cached(self.model, model_name, texts(), path, digest, source)
 
-        self.text_embeddings = self.model.encode(self.texts, show_progress_bar=True)
+        self.text_embeddings = np.load(path, mmap_mode="r")
+        self.index = open_embedding_index(path, precision, rescore)
+
+    @cached_property
+    def model(self):
+        """the model, loaded on first use: only when texts have to be embedded or an image is searched"""
+        from sentence_transformers import SentenceTransformer
+
+        return SentenceTransformer(self.model_name)
 
     def embed_image(self, path):
+        from PIL import Image
+
         image = Image.open(path)
         return self.model.encode([image])[0]
     
+    def embed_text(self, query):
+        if not query or query.isspace():
+            raise ValueError("query is empty or only whitespace")
+        return self.query_cache.embed(query, lambda text: self.model.encode([text])[0])
+
     def search_with_image(self, path):
-        img_embedding = self.embed_image(path)
+        return self.__search(self.embed_image(path))
 
-        similarity_results = []
-        for i, text_embedding in enumerate(self.text_embeddings):
-            similarity_results.append({
-                **self.documents[i], 
-                "similarity_score": cosine_similarity(text_embedding, img_embedding)
-            })
+    def search_with_text(self, query):
+        """movies whose text embeddings are closest to a text query embedded by the same model"""
+        return self.__search(self.embed_text(query))
 
-        similarity_results.sort(key=lambda item: item["similarity_score"], reverse=True)
+    def __search(self, embedding):
+        ids, scores = self.index.search(embedding, DEFAULT_SEARCH_LIMIT)
 
-        return similarity_results[:DEFAULT_SEARCH_LIMIT]
+        # only the top documents are read from the docstore
+        return [
+            {**self.documents[i], "similarity_score": score}
+            for i, score in zip(ids.tolist(), scores.tolist())
+        ]
     
 def verify_image_embedding(path):
     documents = get_documents(DATA_PATH)
@@ -44,4 +78,10 @@ def image_search_command(path):
     documents = get_documents(DATA_PATH)
     multimodal_search = MultimodalSearch(documents)
 
-    return multimodal_search.search_with_image(path)
\ No newline at end of file
+    return multimodal_search.search_with_image(path)
+
+def text_search_command(query):
+    documents = get_documents(DATA_PATH)
+    multimodal_search = MultimodalSearch(documents)
+
+    return multimodal_search.search_with_text(query)
\ No newline at end of file
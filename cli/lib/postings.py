@@ -0,0 +1,217 @@
+import heapq
+import numpy as np
+
+def varint_lengths(values):
+    """number of bytes every value takes as a varint"""
+    values = np.asarray(values, dtype=np.uint64)
+    nbytes = np.ones(len(values), dtype=np.int64)
+    rest = values >> np.uint64(7)
+    while rest.any():
+        nbytes += rest > 0
+        rest >>= np.uint64(7)
+    return nbytes
+
+def encode_varint(values):
+    """encode non-negative integers as LEB128 varints: 7 bits per byte, high bit set on all but the last byte"""
+    values = np.asarray(values, dtype=np.uint64)
+    if values.size == 0:
+        return b""
+
+    nbytes = varint_lengths(values)
+
+    starts = np.cumsum(nbytes) - nbytes
+    # position of every output byte inside its value
+    byte_pos = np.arange(nbytes.sum()) - np.repeat(starts, nbytes)
+    shifted = np.repeat(values, nbytes) >> (np.uint64(7) * byte_pos.astype(np.uint64))
+    out = (shifted & np.uint64(0x7F)).astype(np.uint8)
+    out[byte_pos < np.repeat(nbytes, nbytes) - 1] |= 0x80
+    return out.tobytes()
+
+def decode_varint(buffer):
+    """decode a buffer of LEB128 varints into an int64 array"""
+    data = np.frombuffer(buffer, dtype=np.uint8)
+    if data.size == 0:
+        return np.zeros(0, dtype=np.int64)
+
+    ends = np.flatnonzero(data < 0x80)
+    starts = np.concatenate(([0], ends[:-1] + 1))
+    byte_pos = np.arange(data.size) - np.repeat(starts, ends - starts + 1)
+    parts = (data & 0x7F).astype(np.uint64) << (np.uint64(7) * byte_pos.astype(np.uint64))
+    return np.add.reduceat(parts, starts).astype(np.int64)
+
+def delta_encode(offsets, doc_ordinals):
+    """gaps between consecutive doc ordinals, restarting from the absolute value at every term"""
+    deltas = np.diff(doc_ordinals, prepend=0)
+    term_starts = offsets[:-1][np.diff(offsets) > 0]
+    deltas[term_starts] = doc_ordinals[term_starts]
+    return deltas
+
+def delta_decode(offsets, deltas):
+    """inverse of delta_encode: running sums restarting at every run start"""
+    sums = np.cumsum(deltas)
+    before = np.concatenate(([0], sums))[offsets[:-1]]
+    return sums - np.repeat(before, np.diff(offsets))
+
+def take_runs(values, run_lengths, order):
+    """the consecutive runs of values (of the given lengths) rearranged in the given order"""
+    run_starts = np.cumsum(run_lengths) - run_lengths
+    new_lengths = run_lengths[order]
+    new_starts = np.cumsum(new_lengths) - new_lengths
+    return values[np.arange(new_lengths.sum()) - np.repeat(new_starts - run_starts[order], new_lengths)]
+
+def sorted_contains(haystack, needles):
+    """which of the sorted needles are in the sorted haystack: every needle is binary searched,
+    so the cost grows with len(needles) * log(len(haystack)), not with the length of the haystack"""
+    i = np.searchsorted(haystack, needles)
+    found = i < len(haystack)
+    found[found] = haystack[i[found]] == needles[found]
+    return found
+
+def intersect_sorted(first, second):
+    """doc ordinals in both sorted lists; the shorter list drives the search, skipping through the longer one.
+    Lookups are narrowed to the overlapping range of the two lists before searching."""
+    shorter, longer = (first, second) if len(first) <= len(second) else (second, first)
+    if len(shorter) == 0:
+        return shorter
+    longer = longer[np.searchsorted(longer, shorter[0]):np.searchsorted(longer, shorter[-1], side="right")]
+    return shorter[sorted_contains(longer, shorter)]
+
+def difference_sorted(values, removed):
+    """sorted values that are not in the sorted removed list"""
+    if len(values) == 0 or len(removed) == 0:
+        return values
+    return values[~sorted_contains(removed, values)]
+
+def union_sorted(lists):
+    if not lists:
+        return np.zeros(0, dtype=np.int32)
+    return np.unique(np.concatenate(lists))
+
+class Postings():
+    """postings of every term as sorted doc ordinal and parallel term frequency arrays,
+    stored back to back in two int32 buffers and sliced by per-term offsets.
+    Optionally a parallel buffer holds how many of those occurrences are in the title,
+    and the token positions of every posting follow in another buffer."""
+    def __init__(self, terms, offsets, doc_ordinals, term_frequencies, title_frequencies=None, positions=None):
+        # sorted list of terms
+        self.terms = terms
+        # a dictionary mapping terms to their position in self.terms
+        self.term_ids = {term: i for i, term in enumerate(terms)}
+        # postings of the i-th term are doc_ordinals[offsets[i]:offsets[i + 1]]
+        self.offsets = offsets
+        self.doc_ordinals = doc_ordinals
+        self.term_frequencies = term_frequencies
+        # title part of every term frequency (the rest is in the description), None if not stored
+        self.title_frequencies = title_frequencies
+        # ascending positions of every posting, tf of them per posting, None if positions are not stored;
+        # the positions of the i-th term are positions[position_offsets[i]:position_offsets[i + 1]]
+        self.positions = positions
+        self.position_offsets = None
+        if positions is not None:
+            self.position_offsets = np.concatenate(([0], np.cumsum(term_frequencies, dtype=np.int64)))[offsets]
+
+    @classmethod
+    def from_dict(cls, term_postings, titles=False, positions=False):
+        """build from a dictionary of term -> (doc ordinals in ascending order, term frequencies),
+        followed by the title frequencies with titles and by the positions of every posting back to back with positions"""
+        terms = sorted(term_postings)
+        dfs = np.array([len(term_postings[term][0]) for term in terms], dtype=np.int64)
+        offsets = np.concatenate(([0], np.cumsum(dfs)))
+
+        def column(i):
+            if not terms:
+                return np.zeros(0, dtype=np.int32)
+            return np.concatenate([np.asarray(term_postings[term][i], dtype=np.int32) for term in terms])
+
+        return cls(
+            terms,
+            offsets,
+            column(0),
+            column(1),
+            column(2) if titles else None,
+            column(3 if titles else 2) if positions else None
+        )
+
+    @property
+    def has_titles(self):
+        return self.title_frequencies is not None
+
+    @property
+    def has_positions(self):
+        return self.positions is not None
+
+    def __len__(self):
+        return len(self.terms)
+
+    def __contains__(self, term):
+        return term in self.term_ids
+
+    def get_term_id(self, term):
+        return self.term_ids.get(term)
+
+    def get(self, term):
+        """doc ordinals and term frequencies of a term, empty arrays if it is not indexed"""
+        term_id = self.term_ids.get(term)
+        if term_id is None:
+            return self.doc_ordinals[:0], self.term_frequencies[:0]
+        return self.get_by_id(term_id)
+
+    def get_by_id(self, term_id):
+        start, end = self.offsets[term_id], self.offsets[term_id + 1]
+        return self.doc_ordinals[start:end], self.term_frequencies[start:end]
+
+    def read(self, term, titles=False, positions=False):
+        """doc ordinals and term frequencies of a term, followed by its title frequencies with titles
+        and by its positions (tf of them per posting, back to back) with positions"""
+        term_id = self.term_ids.get(term)
+        start, end = (self.offsets[term_id], self.offsets[term_id + 1]) if term_id is not None else (0, 0)
+        postings = (self.doc_ordinals[start:end], self.term_frequencies[start:end])
+        if titles:
+            postings += (self.title_frequencies[start:end],)
+        if positions:
+            if term_id is None:
+                postings += (self.positions[:0],)
+            else:
+                postings += (self.positions[self.position_offsets[term_id]:self.position_offsets[term_id + 1]],)
+        return postings
+
+    def get_positions(self, term):
+        """doc ordinals, term frequencies and positions (tf of them per posting, back to back) of a term"""
+        return self.read(term, positions=True)
+
+    def get_fields(self, term):
+        """doc ordinals, term frequencies and title frequencies of a term"""
+        return self.read(term, titles=True)
+
+    def df(self, term):
+        term_id = self.term_ids.get(term)
+        if term_id is None:
+            return 0
+        return int(self.offsets[term_id + 1] - self.offsets[term_id])
+
+    def dfs(self):
+        return np.diff(self.offsets)
+
+    def nbytes(self):
+        nbytes = self.offsets.nbytes + self.doc_ordinals.nbytes + self.term_frequencies.nbytes
+        if self.has_titles:
+            nbytes += self.title_frequencies.nbytes
+        if self.has_positions:
+            nbytes += self.positions.nbytes + self.position_offsets.nbytes
+        return nbytes
+
+
+def merge_postings(shards):
+    """k-way merge of the postings of shards covering consecutive, ascending ranges of doc ordinals"""
+    titles = all(shard.has_titles for shard in shards)
+    positions = all(shard.has_positions for shard in shards)
+    term_postings = {}
+    for term, shard_id in heapq.merge(*([(term, shard_id) for term in shard.terms] for shard_id, shard in enumerate(shards))):
+        postings = shards[shard_id].read(term, titles, positions)
+        try:
+            for parts, part in zip(term_postings[term], postings):
+                parts.append(part)
+        except KeyError:
+            term_postings[term] = tuple([part] for part in postings)
+
+    return Postings.from_dict({term: tuple(np.concatenate(parts) for parts in postings) for term, postings in term_postings.items()}, titles, positions)
@@ -0,0 +1,49 @@
+import numpy as np
+
+def occurrences(doc_ordinals, term_frequencies, positions, keep_doc_ordinals):
+    """(doc ordinal, position) of every occurrence of a term inside the kept documents"""
+    docs = np.repeat(doc_ordinals, term_frequencies).astype(np.int64)
+    keep = np.isin(docs, keep_doc_ordinals)
+    return docs[keep], positions[keep].astype(np.int64)
+
+def phrase_matches(phrase_postings):
+    """documents in which the phrase terms occur at consecutive positions, and how many times.
+    phrase_postings are the (doc ordinals, term frequencies, positions) of every term, in phrase order.
+    Candidate documents are intersected shortest list first, then the position lists of every term,
+    shifted back by the term's place in the phrase, are intersected as (doc, start position) keys."""
+    by_length = sorted(range(len(phrase_postings)), key=lambda i: len(phrase_postings[i][0]))
+    candidates = phrase_postings[by_length[0]][0]
+    for i in by_length[1:]:
+        candidates = np.intersect1d(candidates, phrase_postings[i][0], assume_unique=True)
+
+    starts = None
+    for i in by_length:
+        docs, positions = occurrences(*phrase_postings[i], candidates)
+        positions -= i
+        keep = positions >= 0
+        keys = (docs[keep] << 32) | positions[keep]
+        starts = keys if starts is None else np.intersect1d(starts, keys, assume_unique=True)
+        if len(starts) == 0:
+            break
+
+    doc_ordinals, counts = np.unique(starts >> 32, return_counts=True)
+    return doc_ordinals.astype(np.int32), counts
+
+def min_distances(first, second):
+    """documents containing both terms and the smallest distance between an occurrence of one and of the other.
+    first and second are (doc ordinals, term frequencies, positions); the occurrences of both terms
+    are sorted together, so the closest pair is always adjacent."""
+    both = np.intersect1d(first[0], second[0], assume_unique=True)
+    first_docs, first_positions = occurrences(*first, both)
+    second_docs, second_positions = occurrences(*second, both)
+
+    docs = np.concatenate((first_docs, second_docs))
+    positions = np.concatenate((first_positions, second_positions))
+    which = np.concatenate((np.zeros(len(first_docs), dtype=np.int8), np.ones(len(second_docs), dtype=np.int8)))
+    order = np.lexsort((positions, docs))
+    docs, positions, which = docs[order], positions[order], which[order]
+
+    adjacent = (docs[1:] == docs[:-1]) & (which[1:] != which[:-1])
+    distances = np.full(len(both), np.iinfo(np.int64).max)
+    np.minimum.at(distances, np.searchsorted(both, docs[1:][adjacent]), (positions[1:] - positions[:-1])[adjacent])
+    return both.astype(np.int32), distances
@@ -0,0 +1,100 @@
+import os
+import re
+import sqlite3
+
+from collections import OrderedDict
+
+import numpy as np
+
+from .embedding_cache import content_hash
+from .search_utils import CACHE_DIR, QUERY_CACHE_FILE_NAME, QUERY_CACHE_SIZE
+
+def normalize_query(query):
+    """query text with surrounding whitespace stripped and inner runs of whitespace collapsed"""
+    return re.sub(r"\s+", " ", query).strip()
+
+class QueryEmbeddingCache():
+    """query embeddings of one model by normalized query text: the most recently used ones in a bounded
+    in-process LRU, and every one ever computed in an on-disk SQLite key-value table shared by all processes
+    (None as path keeps only the LRU)"""
+    def __init__(self, model_name, path=None, size=QUERY_CACHE_SIZE):
+        self.model_name = model_name
+        self.path = path
+        # content hash of (model name, normalized query) -> vector
+        self.cache = OrderedDict()
+        self.size = size
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.connection = None
+
+    def __connect(self):
+        if self.connection is None:
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            self.connection = sqlite3.connect(self.path)
+            self.connection.execute("CREATE TABLE IF NOT EXISTS query_embeddings (key TEXT PRIMARY KEY, vector BLOB NOT NULL)")
+        return self.connection
+
+    def __remember(self, key, vector):
+        self.cache[key] = vector
+        self.cache.move_to_end(key)
+        if len(self.cache) > self.size:
+            self.cache.popitem(last=False)
+
+    def get(self, query):
+        """the cached embedding of a query, None if it was never computed"""
+        key = content_hash(self.model_name, normalize_query(query)).decode("ascii")
+        vector = self.cache.get(key)
+        if vector is not None:
+            self.memory_hits += 1
+            self.cache.move_to_end(key)
+            return vector
+
+        if self.path is not None:
+            row = self.__connect().execute("SELECT vector FROM query_embeddings WHERE key = ?", (key,)).fetchone()
+            if row is not None:
+                self.disk_hits += 1
+                vector = np.frombuffer(row[0], dtype=np.float32)
+                self.__remember(key, vector)
+                return vector
+
+        self.misses += 1
+        return None
+
+    def put(self, query, vector):
+        key = content_hash(self.model_name, normalize_query(query)).decode("ascii")
+        vector = np.asarray(vector, dtype=np.float32)
+        self.__remember(key, vector)
+        if self.path is not None:
+            with self.__connect() as connection:
+                connection.execute("INSERT OR REPLACE INTO query_embeddings (key, vector) VALUES (?, ?)", (key, vector.tobytes()))
+
+    def embed(self, query, encode):
+        """the cached embedding of a query, else the encoding of the normalized query (the text the cache
+        key is made from, so every spelling of it gets the same vector), which is then cached"""
+        vector = self.get(query)
+        if vector is None:
+            vector = np.asarray(encode(normalize_query(query)), dtype=np.float32)
+            self.put(query, vector)
+        return vector
+
+    def cache_info(self):
+        return {
+            "memory_hits": self.memory_hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "size": len(self.cache),
+            "max_size": self.size
+        }
+
+# process-wide query caches by model name, opened on first use
+_query_caches = {}
+
+def get_query_cache(model_name, cache_dir=CACHE_DIR):
+    """the shared query embedding cache of a model, persisted in cache_dir"""
+    try:
+        return _query_caches[model_name]
+    except KeyError:
+        pass
+    query_cache = _query_caches[model_name] = QueryEmbeddingCache(model_name, os.path.join(cache_dir, QUERY_CACHE_FILE_NAME))
+    return query_cache
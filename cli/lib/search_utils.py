@@ -6,19 +6,72 @@ DEFAULT_CHUNK_OVERLAP = 0
 DEFAULT_MAX_CHUNK_SIZE = 4
 DEFAULT_ALPHA = 0.5
 DEFAULT_RRF_K = 60
+DEFAULT_CHUNK_AGGREGATION = "max"
+DEFAULT_EMBEDDING_PRECISION = "float32"
+DEFAULT_VECTOR_BACKEND = "flat"
 
 PROJECT_ROOT = "/home/pavel/workspace/github.com/PavelVaavra/rag-search-engine"
 DATA_PATH = os.path.join(PROJECT_ROOT, "data", "movies.json")
 STOPWORDS_PATH = os.path.join(PROJECT_ROOT, "data", "stopwords.txt")
 GOLDEN_DATASET_PATH = os.path.join(PROJECT_ROOT, "data", "golden_dataset.json")
 CACHE_DIR = os.path.join(PROJECT_ROOT, "cache")
-INDEX_FILE_NAME = "index.pkl"
-DOCMAP_FILE_NAME = "docmap.pkl"
-TERM_FREQUENCIES_FILE_NAME = "term_frequencies.pkl"
-DOC_LENGTHS_FILE_NAME = "doc_lengths.pkl"
+MANIFEST_FILE_NAME = "index_manifest.json"
 MOVIE_EMBEDDINGS_FILE_NAME = "movie_embeddings.npy"
 CHUNK_EMBEDDINGS_FILE_NAME = "chunk_embeddings.npy"
 CHUNK_METADATA_FILE_NAME = "chunk_metadata.json"
+EMBEDDING_CACHE_DIR_NAME = "embedding_cache"
+EMBEDDING_MODEL_NAME = "all-MiniLM-L6-v2"
+QUERY_CACHE_FILE_NAME = "query_embeddings.sqlite"
+DOCSTORE_FILE_NAME = "docstore.bin"
 
 BM25_K1 = 1.5
-BM25_B = 0.75
\ No newline at end of file
+BM25_B = 0.75
+# BM25F: weight of a term occurrence in every field, and the length normalization of every field
+BM25F_BOOSTS = {"title": 2.0, "description": 1.0}
+BM25F_B = {"title": 0.5, "description": 0.75}
+# delta segments allowed before they are merged back into the base segment
+MAX_DELTA_SEGMENTS = 8
+# a parallel build splits the corpus into this many shards per worker process, to even out the load
+BUILD_SHARDS_PER_WORKER = 4
+# streaming builds: documents indexed per spilled run, texts embedded per spilled batch, bytes read per chunk
+BUILD_BATCH_SIZE = 20000
+EMBEDDING_BATCH_SIZE = 1024
+INGEST_READ_SIZE = 1 << 16
+# terms (and documents) copied per chunk when segments are merged into a new one
+SEGMENT_MERGE_CHUNK = 4096
+# embedding rows scored (or quantized) per block, so memory-mapped embeddings are never copied whole
+VECTOR_BLOCK_ROWS = 16384
+# IVF index of the embeddings: lists probed per query, k-means iterations, and vectors sampled per list to train k-means
+IVF_NPROBE = 8
+IVF_KMEANS_ITERATIONS = 20
+IVF_TRAIN_PER_LIST = 64
+# candidates of a binary (sign bit) Hamming scan rescored with the float32 embeddings
+BINARY_RESCORE = 300
+# HNSW graph of the embeddings: links per node (twice as many on layer 0), and candidates kept while building and searching
+HNSW_M = 16
+HNSW_EF_CONSTRUCTION = 100
+HNSW_EF_SEARCH = 64
+# queries embedded and scored together by the batched (*_many) searches, and read per batch by batch-search
+QUERY_BATCH_SIZE = 64
+# largest dense queries x documents score block the BM25 matrix backend computes at once
+BM25_MATRIX_BATCH_CELLS = 1 << 22
+
+# proximity boost: query terms farther apart than this many positions get none; the description's positions
+# start this far past the title's end, so no phrase or proximity match spans the two fields
+PROXIMITY_WINDOW = 8
+FIELD_POSITION_GAP = PROXIMITY_WINDOW
+# typo-tolerant term lookup: character n-gram size, and the most edits a misspelled word may be away from a term
+SPELL_NGRAM = 3
+SPELL_MAX_EDITS = 2
+# words of at least this many characters may be one edit, and two edits, away from a term
+SPELL_ONE_EDIT_LENGTH = 3
+SPELL_TWO_EDITS_LENGTH = 6
+# prefix ranges up to this many keys are sorted directly; wider ones walk the global rank order in chunks this large
+AUTOCOMPLETE_SCAN_LIMIT = 4096
+
+STEM_CACHE_SIZE = 50000
+# query embeddings kept in memory per model, in front of the on-disk query cache
+QUERY_CACHE_SIZE = 1024
+# documents kept decoded in the shared docstore's LRU cache, and the zlib level of its records
+DOCSTORE_CACHE_SIZE = 1024
+DOCSTORE_COMPRESSION_LEVEL = 6
\ No newline at end of file
@@ -0,0 +1,516 @@
+import bisect
+import heapq
+import json
+import mmap
+import os
+import shutil
+import struct
+import tempfile
+
+from collections.abc import Mapping
+from functools import cached_property
+
+import numpy as np
+
+from .bm25 import bm25_length_norms, bm25_max_impacts
+from .postings import Postings, encode_varint, decode_varint, varint_lengths, delta_encode, delta_decode, take_runs
+from .search_utils import BM25_K1, BM25_B, SEGMENT_MERGE_CHUNK
+
+SEGMENT_MAGIC = b"RSEG"
+SEGMENT_VERSION = 5
+# sections in file order: (name, dtype of the array, None for raw bytes)
+SEGMENT_SECTIONS = (
+    ("terms", None),
+    ("term_offsets", np.uint64),
+    ("dfs", np.uint32),
+    ("postings_offsets", np.uint64),
+    ("postings", None),
+    # empty when the segment stores no positions
+    ("position_offsets", np.uint64),
+    ("positions", None),
+    ("max_impacts", np.float64),
+    ("doc_ids", np.int64),
+    ("doc_lengths", np.int32),
+    ("title_lengths", np.int32),
+    ("length_norms", np.float64),
+    ("docstore_offsets", np.uint64),
+    ("docstore", None),
+)
+# magic, version, number of documents, number of terms, average document length
+SEGMENT_HEADER = struct.Struct("<4sIQQd")
+# byte offset and length of every section
+SEGMENT_SECTION_TABLE = struct.Struct("<" + "QQ" * len(SEGMENT_SECTIONS))
+# arrays start on 8 byte boundaries so they can be viewed in place
+SEGMENT_ALIGNMENT = 8
+
+def encode_postings(offsets, doc_ordinals, term_frequencies, title_frequencies):
+    """varint encode every term's postings as its doc ordinal gaps, then its term frequencies,
+    then its title frequencies; returns the postings blob and the byte offset of every term in it"""
+    dfs = np.diff(offsets)
+    term_starts = np.repeat(offsets[:-1], dfs)
+    deltas = delta_encode(offsets, doc_ordinals.astype(np.int64))
+
+    # the i-th posting of a term goes to 3 * start + i, its tf to 3 * start + df + i, its title tf to 3 * start + 2 * df + i
+    values = np.empty(3 * len(doc_ordinals), dtype=np.int64)
+    posting_ids = 2 * term_starts + np.arange(len(doc_ordinals))
+    values[posting_ids] = deltas
+    values[posting_ids + np.repeat(dfs, dfs)] = term_frequencies
+    values[posting_ids + 2 * np.repeat(dfs, dfs)] = title_frequencies
+
+    byte_ends = np.cumsum(varint_lengths(values))
+    byte_offsets = np.concatenate(([0], byte_ends))[3 * offsets]
+    return encode_varint(values), byte_offsets.astype(np.uint64)
+
+def decode_postings(values, offsets):
+    """split the decoded values of consecutive terms back into doc ordinals, term frequencies and title frequencies"""
+    dfs = np.diff(offsets)
+    value_pos = np.arange(len(values)) - np.repeat(3 * offsets[:-1], 3 * dfs)
+    column = value_pos // np.repeat(dfs, 3 * dfs)
+    doc_ordinals = delta_decode(offsets, values[column == 0]).astype(np.int32)
+    return doc_ordinals, values[column == 1].astype(np.int32), values[column == 2].astype(np.int32)
+
+class SegmentWriter():
+    """writes a segment in pieces: terms (in sorted order) and documents are appended chunk by chunk
+    to one spill file per section, and finish() copies the sections behind the header.
+    Only the chunk being added is held in memory."""
+    def __init__(self, path, positions=False):
+        self.path = path
+        self.positions = positions
+        self.spill_dir = tempfile.TemporaryDirectory(dir=os.path.dirname(path) or ".")
+        self.files = {name: open(os.path.join(self.spill_dir.name, name), "w+b") for name, _ in SEGMENT_SECTIONS}
+        self.num_terms = 0
+        self.num_docs = 0
+        # end offsets of the raw sections written so far
+        self.terms_end = 0
+        self.postings_end = 0
+        self.positions_end = 0
+        self.docstore_end = 0
+        self.last_term = None
+        for name in ("term_offsets", "postings_offsets", "docstore_offsets") + (("position_offsets",) if positions else ()):
+            self.files[name].write(np.zeros(1, dtype=np.uint64).tobytes())
+
+    def __write(self, name, data):
+        if name in ("terms", "postings", "positions", "docstore"):
+            self.files[name].write(data)
+        else:
+            self.files[name].write(np.asarray(data, dtype=dict(SEGMENT_SECTIONS)[name]).tobytes())
+
+    def add_terms(self, postings, max_impacts):
+        """append the terms of postings, which must all sort after the terms added before"""
+        if len(postings) == 0:
+            return
+        if self.last_term is not None and postings.terms[0] <= self.last_term:
+            raise ValueError("segment terms must be added in sorted order")
+        self.last_term = postings.terms[-1]
+
+        terms = [term.encode("utf-8") for term in postings.terms]
+        term_ends = self.terms_end + np.cumsum([len(term) for term in terms])
+        postings_blob, postings_offsets = encode_postings(postings.offsets, postings.doc_ordinals, postings.term_frequencies, postings.title_frequencies)
+
+        self.__write("terms", b"".join(terms))
+        self.__write("term_offsets", term_ends)
+        self.__write("dfs", postings.dfs())
+        self.__write("postings_offsets", self.postings_end + postings_offsets[1:])
+        self.__write("postings", postings_blob)
+        if self.positions:
+            positions_blob, position_offsets = encode_positions(postings.offsets, postings.term_frequencies, postings.positions)
+            self.__write("position_offsets", self.positions_end + position_offsets[1:])
+            self.__write("positions", positions_blob)
+            self.positions_end += len(positions_blob)
+        self.__write("max_impacts", [max_impacts[term] for term in postings.terms])
+        self.num_terms += len(terms)
+        self.terms_end = int(term_ends[-1])
+        self.postings_end += len(postings_blob)
+
+    def add_documents(self, doc_ids, doc_lengths, title_lengths, length_norms, raw_documents):
+        """append documents in ordinal order; raw_documents are their JSON encoded bytes"""
+        if len(raw_documents) == 0:
+            return
+        docstore_ends = self.docstore_end + np.cumsum([len(doc) for doc in raw_documents])
+
+        self.__write("doc_ids", doc_ids)
+        self.__write("doc_lengths", doc_lengths)
+        self.__write("title_lengths", title_lengths)
+        self.__write("length_norms", length_norms)
+        self.__write("docstore_offsets", docstore_ends)
+        self.__write("docstore", b"".join(raw_documents))
+        self.num_docs += len(raw_documents)
+        self.docstore_end = int(docstore_ends[-1])
+
+    def finish(self, avg_doc_length):
+        """write the header, section table and sections to the segment path"""
+        header = SEGMENT_HEADER.pack(SEGMENT_MAGIC, SEGMENT_VERSION, self.num_docs, self.num_terms, avg_doc_length)
+        position = SEGMENT_HEADER.size + SEGMENT_SECTION_TABLE.size
+        table = []
+        paddings = []
+        for name, _ in SEGMENT_SECTIONS:
+            length = self.files[name].tell()
+            paddings.append(-position % SEGMENT_ALIGNMENT)
+            position += paddings[-1]
+            table.extend((position, length))
+            position += length
+
+        with open(self.path, "wb") as file:
+            file.write(header)
+            file.write(SEGMENT_SECTION_TABLE.pack(*table))
+            for (name, _), padding in zip(SEGMENT_SECTIONS, paddings):
+                file.write(b"\0" * padding)
+                self.files[name].seek(0)
+                shutil.copyfileobj(self.files[name], file)
+        self.close()
+
+    def close(self):
+        for file in self.files.values():
+            file.close()
+        self.spill_dir.cleanup()
+
+def encode_positions(offsets, term_frequencies, positions):
+    """varint encode the position gaps of every posting, restarting at each posting;
+    returns the positions blob and the byte offset of every term in it"""
+    posting_offsets = np.concatenate(([0], np.cumsum(term_frequencies, dtype=np.int64)))
+    values = delta_encode(posting_offsets, positions.astype(np.int64))
+    byte_offsets = np.concatenate(([0], np.cumsum(varint_lengths(values))))[posting_offsets[offsets]]
+    return encode_varint(values), byte_offsets.astype(np.uint64)
+
+def write_segment(path, postings, doc_ids, doc_lengths, title_lengths, documents, avg_doc_length, length_norms, max_impacts):
+    """write an index segment: header, section table, then every section of SEGMENT_SECTIONS"""
+    writer = SegmentWriter(path, postings.has_positions)
+    writer.add_terms(postings, max_impacts)
+    writer.add_documents(doc_ids, doc_lengths, title_lengths, length_norms, [json.dumps(document).encode("utf-8") for document in documents])
+    writer.finish(avg_doc_length)
+
+def merge_segments(segment_set, path, k1=BM25_K1, b=BM25_B):
+    """write the live documents of a SegmentSet as one new segment without tombstones.
+    Postings are copied chunk by chunk with the documents renumbered in ascending document ID
+    order, and the scoring tables are recomputed for the merged statistics; nothing is tokenized again."""
+    live = segment_set.live_doc_ordinals()
+    order = live[np.argsort(segment_set.doc_ids[live], kind="stable")]
+    new_ordinals = np.full(int(segment_set.bases[-1]), -1, dtype=np.int64)
+    new_ordinals[order] = np.arange(len(order))
+
+    doc_lengths = segment_set.doc_lengths[order]
+    avg_doc_length, length_norms = bm25_length_norms(doc_lengths, b)
+
+    positions = segment_set.has_positions
+    writer = SegmentWriter(path, positions)
+    term_postings = {}
+    for term in segment_set.terms:
+        doc_ordinals, term_frequencies, title_frequencies, *term_positions = segment_set.read(term, True, positions)
+        if len(doc_ordinals) == 0:
+            continue
+        doc_ordinals = new_ordinals[doc_ordinals]
+        sort = np.argsort(doc_ordinals, kind="stable")
+        term_postings[term] = (doc_ordinals[sort], term_frequencies[sort], title_frequencies[sort])
+        if positions:
+            term_postings[term] += (take_runs(term_positions[0], term_frequencies, sort),)
+        if len(term_postings) == SEGMENT_MERGE_CHUNK:
+            postings = Postings.from_dict(term_postings, True, positions)
+            writer.add_terms(postings, bm25_max_impacts(postings, len(order), length_norms, k1))
+            term_postings = {}
+    postings = Postings.from_dict(term_postings, True, positions)
+    writer.add_terms(postings, bm25_max_impacts(postings, len(order), length_norms, k1))
+
+    for start in range(0, len(order), SEGMENT_MERGE_CHUNK):
+        chunk = order[start:start + SEGMENT_MERGE_CHUNK]
+        writer.add_documents(
+            segment_set.doc_ids[chunk],
+            doc_lengths[start:start + SEGMENT_MERGE_CHUNK],
+            segment_set.title_lengths[chunk],
+            length_norms[start:start + SEGMENT_MERGE_CHUNK],
+            [segment_set.get_raw_document(int(doc_ordinal)) for doc_ordinal in chunk]
+        )
+    writer.finish(avg_doc_length)
+
+class Segment():
+    """read-only, memory-mapped index segment. Opening it only parses the header:
+    terms, postings and documents are paged in from the file when first touched."""
+    def __init__(self, path):
+        with open(path, "rb") as file:
+            self.mmap = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic, version, num_docs, num_terms, avg_doc_length = SEGMENT_HEADER.unpack_from(self.mmap)
+        if magic != SEGMENT_MAGIC:
+            raise ValueError(f"{path} is not an index segment")
+        if version != SEGMENT_VERSION:
+            raise ValueError(f"{path} has segment version {version}, expected {SEGMENT_VERSION}: rebuild the index")
+
+        self.num_docs = num_docs
+        self.num_terms = num_terms
+        self.avg_doc_length = avg_doc_length
+
+        table = SEGMENT_SECTION_TABLE.unpack_from(self.mmap, SEGMENT_HEADER.size)
+        self.sections = {}
+        for i, (name, dtype) in enumerate(SEGMENT_SECTIONS):
+            offset, length = table[2 * i], table[2 * i + 1]
+            if dtype is None:
+                self.sections[name] = (offset, length)
+            else:
+                self.sections[name] = np.frombuffer(self.mmap, dtype=dtype, count=length // np.dtype(dtype).itemsize, offset=offset)
+
+        self.term_offsets = self.sections["term_offsets"]
+        self.postings_offsets = self.sections["postings_offsets"]
+        self.docstore_offsets = self.sections["docstore_offsets"]
+        self.position_offsets = self.sections["position_offsets"]
+        self.doc_ids = self.sections["doc_ids"]
+        self.has_positions = len(self.position_offsets) > 0
+
+    def __raw(self, name, start, end):
+        offset, _ = self.sections[name]
+        return self.mmap[offset + start:offset + end]
+
+    def term(self, term_id):
+        return self.__raw("terms", int(self.term_offsets[term_id]), int(self.term_offsets[term_id + 1])).decode("utf-8")
+
+    @cached_property
+    def terms(self):
+        return [self.term(term_id) for term_id in range(self.num_terms)]
+
+    def get_term_id(self, term):
+        """binary search of the sorted term dictionary"""
+        term_id = bisect.bisect_left(range(self.num_terms), term, key=self.term)
+        if term_id < self.num_terms and self.term(term_id) == term:
+            return term_id
+        return None
+
+    def read_by_id(self, term_id, titles=False, positions=False):
+        """doc ordinals and term frequencies of a term, plus its title term frequencies
+        and the positions of every posting back to back when asked for"""
+        values = decode_varint(self.__raw("postings", int(self.postings_offsets[term_id]), int(self.postings_offsets[term_id + 1])))
+        df = int(self.sections["dfs"][term_id])
+        term_frequencies = values[df:2 * df].astype(np.int32)
+        result = (np.cumsum(values[:df]).astype(np.int32), term_frequencies)
+        if titles:
+            result += (values[2 * df:].astype(np.int32),)
+        if positions:
+            values = decode_varint(self.__raw("positions", int(self.position_offsets[term_id]), int(self.position_offsets[term_id + 1])))
+            posting_offsets = np.concatenate(([0], np.cumsum(term_frequencies, dtype=np.int64)))
+            result += (delta_decode(posting_offsets, values).astype(np.int32),)
+        return result
+
+    def get_by_id(self, term_id):
+        return self.read_by_id(term_id)
+
+    def get_positions_by_id(self, term_id):
+        """doc ordinals, term frequencies and the positions of every posting back to back"""
+        return self.read_by_id(term_id, positions=True)
+
+    def read_postings(self):
+        """the postings of every term decoded at once into an in-memory Postings (with title frequencies, without positions)"""
+        offset, length = self.sections["postings"]
+        values = decode_varint(self.mmap[offset:offset + length])
+        dfs = self.sections["dfs"].astype(np.int64)
+        offsets = np.concatenate(([0], np.cumsum(dfs)))
+        doc_ordinals, term_frequencies, title_frequencies = decode_postings(values, offsets)
+        return Postings(self.terms, offsets, doc_ordinals, term_frequencies, title_frequencies)
+
+    def get_doc_ordinal(self, doc_id):
+        """ordinal of a document ID inside this segment, None if it is not here"""
+        doc_ordinal = int(np.searchsorted(self.doc_ids, doc_id))
+        if doc_ordinal < self.num_docs and self.doc_ids[doc_ordinal] == doc_id:
+            return doc_ordinal
+        return None
+
+    def get_raw_document(self, doc_ordinal):
+        return self.__raw("docstore", int(self.docstore_offsets[doc_ordinal]), int(self.docstore_offsets[doc_ordinal + 1]))
+
+    def get_document(self, doc_ordinal):
+        return json.loads(self.get_raw_document(doc_ordinal))
+
+class SegmentSet():
+    """a base segment plus delta segments seen as one index. Documents get global ordinals:
+    the ordinals of every segment one after the other. Deleted (tombstoned) ordinals
+    are dropped from every lookup."""
+    def __init__(self, segments, deleted):
+        self.segments = segments
+        # global ordinal of the first document of every segment
+        self.bases = np.concatenate(([0], np.cumsum([segment.num_docs for segment in segments]))).astype(np.int64)
+        # sorted global ordinals of tombstoned documents
+        self.deleted = np.asarray(deleted, dtype=np.int64)
+        self.num_docs = int(self.bases[-1]) - len(self.deleted)
+
+        if self.is_single():
+            # one clean segment: use its arrays and stored statistics in place
+            segment = segments[0]
+            self.doc_ids = segment.doc_ids
+            self.doc_lengths = segment.sections["doc_lengths"]
+            self.title_lengths = segment.sections["title_lengths"]
+            self.avg_doc_length = segment.avg_doc_length
+            self.length_norms = segment.sections["length_norms"]
+        else:
+            self.doc_ids = np.concatenate([segment.doc_ids for segment in segments])
+            self.doc_lengths = np.concatenate([segment.sections["doc_lengths"] for segment in segments])
+            self.title_lengths = np.concatenate([segment.sections["title_lengths"] for segment in segments])
+            live_length = int(self.doc_lengths.sum()) - int(self.doc_lengths[self.deleted].sum())
+            self.avg_doc_length = live_length / self.num_docs if self.num_docs else 0.0
+            self.length_norms = None
+
+    def is_single(self):
+        return len(self.segments) == 1 and len(self.deleted) == 0
+
+    def __len__(self):
+        return len(self.terms)
+
+    def __contains__(self, term):
+        return self.df(term) > 0
+
+    @cached_property
+    def terms(self):
+        # every segment's terms are sorted: merge them and drop the duplicates
+        terms = []
+        for term in heapq.merge(*(segment.terms for segment in self.segments)):
+            if not terms or terms[-1] != term:
+                terms.append(term)
+        return terms
+
+    @property
+    def has_positions(self):
+        return all(segment.has_positions for segment in self.segments)
+
+    @property
+    def has_titles(self):
+        # every segment stores title term frequencies
+        return True
+
+    def get(self, term):
+        """global doc ordinals and term frequencies of the live postings of a term"""
+        return self.read(term)
+
+    def get_positions(self, term):
+        """like get, plus the positions of every live posting back to back"""
+        return self.read(term, positions=True)
+
+    def get_fields(self, term):
+        """like get, plus the title term frequency of every live posting"""
+        return self.read(term, titles=True)
+
+    def read(self, term, titles=False, positions=False):
+        parts = []
+        for base, segment in zip(self.bases, self.segments):
+            term_id = segment.get_term_id(term)
+            if term_id is None:
+                continue
+            postings = segment.read_by_id(term_id, titles, positions)
+            parts.append((postings[0] + np.int32(base),) + postings[1:])
+
+        if not parts:
+            return tuple(np.zeros(0, dtype=np.int32) for _ in range(2 + titles + positions))
+        doc_ordinals, term_frequencies, *rest = (np.concatenate(part) for part in zip(*parts))
+        if len(self.deleted):
+            live = ~np.isin(doc_ordinals, self.deleted)
+            if titles:
+                rest[0] = rest[0][live]
+            if positions:
+                rest[-1] = rest[-1][np.repeat(live, term_frequencies)]
+            doc_ordinals, term_frequencies = doc_ordinals[live], term_frequencies[live]
+        return (doc_ordinals, term_frequencies, *rest)
+
+    def df(self, term):
+        return len(self.get(term)[0])
+
+    def dfs(self):
+        """live document frequency of every term, in term order"""
+        if self.is_single():
+            return self.segments[0].sections["dfs"].astype(np.int64)
+        return np.array([self.df(term) for term in self.terms], dtype=np.int64)
+
+    def to_postings(self):
+        """the live postings of every term, with global doc ordinals, as an in-memory Postings (with title frequencies, without positions)"""
+        if self.is_single():
+            return self.segments[0].read_postings()
+        term_postings = {}
+        for term in self.terms:
+            postings = self.read(term, titles=True)
+            if len(postings[0]):
+                term_postings[term] = postings
+        return Postings.from_dict(term_postings, True)
+
+    def max_impact(self, term):
+        """maximum impact stored at build time, only valid while the index is one clean segment"""
+        if not self.is_single():
+            return None
+        term_id = self.segments[0].get_term_id(term)
+        if term_id is None:
+            return None
+        return float(self.segments[0].sections["max_impacts"][term_id])
+
+    def __locate(self, doc_ordinal):
+        i = int(np.searchsorted(self.bases, doc_ordinal, side="right")) - 1
+        return self.segments[i], doc_ordinal - int(self.bases[i])
+
+    def is_deleted(self, doc_ordinal):
+        i = int(np.searchsorted(self.deleted, doc_ordinal))
+        return i < len(self.deleted) and self.deleted[i] == doc_ordinal
+
+    def get_doc_ordinal(self, doc_id):
+        """global ordinal of the live version of a document ID, None if there is none"""
+        # newer segments hold newer versions
+        for i in range(len(self.segments) - 1, -1, -1):
+            segment_doc_ordinal = self.segments[i].get_doc_ordinal(doc_id)
+            if segment_doc_ordinal is None:
+                continue
+            doc_ordinal = int(self.bases[i]) + segment_doc_ordinal
+            if not self.is_deleted(doc_ordinal):
+                return doc_ordinal
+        return None
+
+    def get_raw_document(self, doc_ordinal):
+        segment, segment_doc_ordinal = self.__locate(doc_ordinal)
+        return segment.get_raw_document(segment_doc_ordinal)
+
+    def get_document(self, doc_ordinal):
+        segment, segment_doc_ordinal = self.__locate(doc_ordinal)
+        return segment.get_document(segment_doc_ordinal)
+
+    def live_doc_ordinals(self):
+        return np.setdiff1d(np.arange(self.bases[-1]), self.deleted)
+
+class SegmentDocmap(Mapping):
+    """document ID -> document, read lazily from the segments' docstores"""
+    def __init__(self, segment_set):
+        self.segment_set = segment_set
+
+    def __getitem__(self, doc_id):
+        doc_ordinal = self.segment_set.get_doc_ordinal(doc_id)
+        if doc_ordinal is None:
+            raise KeyError(doc_id)
+        return self.segment_set.get_document(doc_ordinal)
+
+    def __len__(self):
+        return self.segment_set.num_docs
+
+    def __iter__(self):
+        if self.segment_set.is_single():
+            return iter(self.segment_set.doc_ids.tolist())
+        return iter(self.segment_set.doc_ids[self.segment_set.live_doc_ordinals()].tolist())
+
+def read_manifest(cache_dir, manifest_file_name):
+    """segment file names (base first) and, for each, the tombstoned ordinals inside it"""
+    with open(os.path.join(cache_dir, manifest_file_name), "r") as file:
+        return json.load(file)
+
+def write_manifest(cache_dir, manifest_file_name, manifest):
+    # write then rename, so readers never see a half-written manifest
+    path = os.path.join(cache_dir, manifest_file_name)
+    with open(f"{path}.tmp", "w") as file:
+        json.dump(manifest, file, indent=2)
+    os.replace(f"{path}.tmp", path)
+
+def open_segments(cache_dir, manifest):
+    segments = [Segment(os.path.join(cache_dir, entry["file"])) for entry in manifest["segments"]]
+    deleted = []
+    base = 0
+    for segment, entry in zip(segments, manifest["segments"]):
+        deleted.extend(base + doc_ordinal for doc_ordinal in entry["deleted"])
+        base += segment.num_docs
+    return SegmentSet(segments, sorted(deleted))
+
+def segment_file_name(segment_number):
+    return f"index_{segment_number}.seg"
+
+def remove_segment_files(cache_dir, entries):
+    # processes that still have them memory-mapped keep reading the unlinked files
+    for entry in entries:
+        try:
+            os.remove(os.path.join(cache_dir, entry["file"]))
+        except FileNotFoundError:
+            pass
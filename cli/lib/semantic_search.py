@@ -1,29 +1,105 @@
-from sentence_transformers import SentenceTransformer
 import numpy as np
 import os
 import json
 import re
 
+from functools import cached_property
+
+from .docstore import DocStore, document_map, get_docstore
+from .embedding_cache import encode_cached, embeddings_fresh, new_digest, source_fingerprint, update_digest
+from .embedding_store import open_binary_index, open_embedding_index
+from .hnsw import open_hnsw_index
+from .ivf import open_ivf_index
+from .query_cache import get_query_cache, normalize_query
+from .vector_search import segment_reduce, top_k
 from .search_utils import (
+    BINARY_RESCORE,
     CACHE_DIR,
+    DEFAULT_CHUNK_AGGREGATION,
+    DEFAULT_EMBEDDING_PRECISION,
+    DEFAULT_VECTOR_BACKEND,
+    EMBEDDING_MODEL_NAME,
+    HNSW_EF_SEARCH,
+    IVF_NPROBE,
+    QUERY_BATCH_SIZE,
     MOVIE_EMBEDDINGS_FILE_NAME,
     DATA_PATH,
     CHUNK_EMBEDDINGS_FILE_NAME,
     CHUNK_METADATA_FILE_NAME
 )
 
+# how the embeddings are searched: every vector scanned, only the probed lists of an IVF index, an HNSW graph walk,
+# or a Hamming scan of sign bits with the best candidates rescored
+VECTOR_BACKENDS = ("flat", "ivf", "hnsw", "binary")
+
 class SemanticSearch():
-    def __init__(self):
-        self.model = SentenceTransformer('all-MiniLM-L6-v2')
+    def __init__(self, precision=DEFAULT_EMBEDDING_PRECISION, rescore=0, backend=DEFAULT_VECTOR_BACKEND, nprobe=IVF_NPROBE, ef_search=HNSW_EF_SEARCH):
+        if backend not in VECTOR_BACKENDS:
+            raise ValueError(f"unknown vector backend: {backend}")
+        self.model_name = EMBEDDING_MODEL_NAME
+        # query embeddings computed by any instance, in memory and on disk
+        self.query_cache = get_query_cache(self.model_name)
+        # memory-mapped float32 embeddings
         self.embeddings = None
+        # FlatIndex, IVFIndex, HNSWIndex or BinaryIndex over the embeddings, set when they are built or loaded
+        self.index = None
+        # precision the flat backend searches the embeddings in ("float32", "float16" or "int8"), and how
+        # many candidates of a quantized or binary search are rescored with the float32 embeddings
+        # (0: none for a quantized search, BINARY_RESCORE for a binary one)
+        self.precision = precision
+        self.rescore = rescore
+        # one of VECTOR_BACKENDS, the lists an IVF search probes, and the candidates an HNSW search keeps
+        self.backend = backend
+        self.nprobe = nprobe
+        self.ef_search = ef_search
         self.documents = None
         self.document_map = {}
+        # texts the last build had to encode (the others came from the embedding cache)
+        self.last_encoded = None
+
+    @cached_property
+    def model(self):
+        """the embedding model, loaded on first use: searches whose query embeddings are all cached never load it"""
+        # imported here so commands that never embed do not pay for importing sentence_transformers (and torch)
+        from sentence_transformers import SentenceTransformer
+
+        return SentenceTransformer(self.model_name)
+
+    def _open_index(self, path):
+        """the search index of the embeddings saved at path, for the configured backend"""
+        if self.backend == "ivf":
+            return open_ivf_index(path, self.nprobe)
+        if self.backend == "hnsw":
+            return open_hnsw_index(path, self.ef_search)
+        if self.backend == "binary":
+            return open_binary_index(path, self.rescore or BINARY_RESCORE)
+        return open_embedding_index(path, self.precision, self.rescore)
+
+    def _use_documents(self, documents):
+        """documents in embedding order (a list or the shared DocStore) and the ID -> document map over them"""
+        self.documents = documents
+        self.document_map = document_map(documents)
 
     def generate_embedding(self, text):
         if not text or text.isspace():
             raise ValueError("text is empty or only whitespace")
         
-        return self.model.encode([text])[0]
+        return self.query_cache.embed(text, lambda query: self.model.encode([query])[0])
+
+    def generate_embeddings(self, texts):
+        """embeddings of several queries: the ones not in the query cache are encoded in one batch"""
+        for text in texts:
+            if not text or text.isspace():
+                raise ValueError("text is empty or only whitespace")
+
+        embeddings = [self.query_cache.get(text) for text in texts]
+        missing = [i for i, embedding in enumerate(embeddings) if embedding is None]
+        if missing:
+            # the normalized text is encoded, as the query cache keys it
+            for i, embedding in zip(missing, self.model.encode([normalize_query(texts[i]) for i in missing])):
+                embeddings[i] = np.asarray(embedding, dtype=np.float32)
+                self.query_cache.put(texts[i], embeddings[i])
+        return np.array(embeddings, dtype=np.float32)
     
     # Add a new build_embeddings(self, documents) method. documents is a list of dictionaries, each representing a movie.
     # Set self.documents equal to the documents argument.
@@ -33,16 +109,25 @@ class SemanticSearch():
     # Save the embeddings into cache/movie_embeddings.npy using np.save.
     # Return self.embeddings from the method.
     def build_embeddings(self, documents):
-        self.documents = documents
-        movie_strings = []
-        for doc in self.documents:
-            self.document_map[doc["id"]] = doc
-            movie_strings.append(f"{doc['title']}: {doc['description']}")
-
-        self.embeddings = self.model.encode(movie_strings, show_progress_bar=True)
-
-        with open(os.path.join(CACHE_DIR, MOVIE_EMBEDDINGS_FILE_NAME),"wb") as file:
-            np.save(file, self.embeddings)
+        """documents can be the shared DocStore or any iterable (e.g. iter_documents): they are embedded
+        EMBEDDING_BATCH_SIZE at a time and the batches are spilled to disk, then the saved embeddings are memory-mapped.
+        Only texts missing from the model's embedding cache are encoded; a manifest records what was embedded."""
+        stored = isinstance(documents, DocStore)
+        digest = new_digest()
+        def movie_strings():
+            for doc in documents:
+                if not stored:
+                    self.document_map[doc["id"]] = doc
+                text = movie_text(doc)
+                update_digest(digest, text)
+                yield text
+
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        path = os.path.join(CACHE_DIR, MOVIE_EMBEDDINGS_FILE_NAME)
+        _, self.last_encoded = encode_cached(self.model, self.model_name, movie_strings(), path, digest, source_fingerprint(documents))
+        self._use_documents(documents if stored else list(self.document_map.values()))
+        self.embeddings = np.load(path, mmap_mode="r")
+        self.index = self._open_index(path)
 
         return self.embeddings
     
@@ -54,18 +139,18 @@ class SemanticSearch():
     # Verify that the length of self.embeddings is equal to the length of documents. If it is, return the cached self.embeddings.
     # Otherwise, return the result of rebuilding the embeddings from scratch with self.build_embeddings(documents).
     def load_or_create_embeddings(self, documents):
-        if not os.path.exists(os.path.join(CACHE_DIR, MOVIE_EMBEDDINGS_FILE_NAME)):
+        """the saved embeddings when their manifest shows they were built from these documents by this model,
+        else they are rebuilt (re-encoding only new or edited texts)"""
+        path = os.path.join(CACHE_DIR, MOVIE_EMBEDDINGS_FILE_NAME)
+        if not embeddings_fresh(path, self.model_name, source_fingerprint(documents), lambda: movie_digest(documents)):
             return self.build_embeddings(documents)
         
-        self.documents = documents
-        for doc in self.documents:
-            self.document_map[doc["id"]] = doc
+        self._use_documents(documents)
 
-        with open(os.path.join(CACHE_DIR, MOVIE_EMBEDDINGS_FILE_NAME),"rb") as file:
-            self.embeddings = np.load(file)
+        self.embeddings = np.load(path, mmap_mode="r")
+        self.index = self._open_index(path)
 
-        if len(self.embeddings) == len(self.documents):
-            return self.embeddings
+        return self.embeddings
     
     def search(self, query, limit):
         # Generate an embedding for the query using self.generate_embedding(query).
@@ -80,107 +165,144 @@ class SemanticSearch():
             raise ValueError("No embeddings loaded. Call `load_or_create_embeddings` first.")
         
         embedding = self.generate_embedding(query)
-        similarity = []
-        for i, doc in enumerate(self.document_map.values()):
-            similarity.append((cosine_similarity(self.embeddings[i], embedding), doc))
+        return self._results(*self.index.search(embedding, limit))
+
+    def search_many(self, queries, limit):
+        """search of every query: the queries are embedded and scored QUERY_BATCH_SIZE at a time"""
+        if len(self.embeddings) == 0:
+            raise ValueError("No embeddings loaded. Call `load_or_create_embeddings` first.")
 
-        sorted_similarity = sorted(similarity, key=lambda item: item[0], reverse=True)
+        results = []
+        for start in range(0, len(queries), QUERY_BATCH_SIZE):
+            embeddings = self.generate_embeddings(queries[start:start + QUERY_BATCH_SIZE])
+            results.extend(self._results(ids, scores) for ids, scores in self.index.search_many(embeddings, limit))
+        return results
 
-        sorted_similarity = sorted_similarity[:limit]
+    def _results(self, ids, scores):
         result = []
-        for item in sorted_similarity:
+        # only the top documents are read from the docstore
+        for i, score in zip(ids.tolist(), scores.tolist()):
+            doc = self.documents[i]
             result_item = {}
-            result_item["score"] = item[0]
-            result_item["title"] = item[1]["title"]
-            result_item["description"] = item[1]["description"]
+            result_item["id"] = doc["id"]
+            result_item["score"] = score
+            result_item["title"] = doc["title"]
+            result_item["description"] = doc["description"]
             result.append(result_item)
 
         return result
     
 class ChunkedSemanticSearch(SemanticSearch):
-    def __init__(self):
-        super().__init__()
+    def __init__(self, precision=DEFAULT_EMBEDDING_PRECISION, rescore=0, backend=DEFAULT_VECTOR_BACKEND, nprobe=IVF_NPROBE, ef_search=HNSW_EF_SEARCH):
+        super().__init__(precision, rescore, backend, nprobe, ef_search)
         self.chunk_embeddings = None
-        self.chunk_metadata = None
+        # FlatIndex, IVFIndex, HNSWIndex or BinaryIndex over the chunk embeddings
+        self.chunk_index = None
+        # the chunks of movie chunk_movie_ids[i] are the rows chunk_offsets[i]:chunk_offsets[i + 1]
+        self.chunk_movie_ids = None
+        self.chunk_offsets = None
 
     def build_chunk_embeddings(self, documents):
-        self.documents = documents
-        chunks = []
-        chunk_metadata = []
-        for doc in self.documents:
-            self.document_map[doc["id"]] = doc
-            if doc["description"] == "":
-                continue
-            doc_chunks = semantic_chunk(doc["description"], 4, 1)
-            chunks.extend(doc_chunks)
-            doc_chunk_metadata = []
-            for i in range(len(doc_chunks)):
-                doc_chunk_metadata_item = {}
-                doc_chunk_metadata_item["movie_idx"] = doc["id"]
-                doc_chunk_metadata_item["chunk_idx"] = i + 1
-                doc_chunk_metadata_item["total_chunks"] = len(doc_chunks)
-                doc_chunk_metadata.append(doc_chunk_metadata_item)
-            chunk_metadata.extend(doc_chunk_metadata)
-
-
-        self.chunk_embeddings = self.model.encode(chunks, show_progress_bar=True)
-        self.chunk_metadata = chunk_metadata
-
-        with open(os.path.join(CACHE_DIR, CHUNK_EMBEDDINGS_FILE_NAME),"wb") as file:
-            np.save(file, self.chunk_embeddings)
+        """like build_embeddings, documents are chunked and embedded as they are read,
+        so only one batch of chunk embeddings is in memory at a time"""
+        movie_ids = []
+        chunk_offsets = [0]
+        stored = isinstance(documents, DocStore)
+        digest = new_digest()
+
+        def chunks():
+            for doc in documents:
+                if not stored:
+                    self.document_map[doc["id"]] = doc
+                doc_chunks = document_chunks(doc)
+                if doc_chunks:
+                    movie_ids.append(doc["id"])
+                    chunk_offsets.append(chunk_offsets[-1] + len(doc_chunks))
+                    update_chunk_digest(digest, doc["id"], doc_chunks)
+                yield from doc_chunks
+
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        path = os.path.join(CACHE_DIR, CHUNK_EMBEDDINGS_FILE_NAME)
+        # stale metadata is removed first, so an interrupted build is never loaded as fresh
+        metadata_path = os.path.join(CACHE_DIR, CHUNK_METADATA_FILE_NAME)
+        if os.path.exists(metadata_path):
+            os.remove(metadata_path)
+        total_chunks, self.last_encoded = encode_cached(self.model, self.model_name, chunks(), path, digest, source_fingerprint(documents))
+        self._use_documents(documents if stored else list(self.document_map.values()))
+        self.chunk_embeddings = np.load(path, mmap_mode="r")
+        self.chunk_index = self._open_index(path)
+        self.chunk_movie_ids = np.array(movie_ids, dtype=np.int64)
+        self.chunk_offsets = np.array(chunk_offsets, dtype=np.int64)
 
         with open(os.path.join(CACHE_DIR, CHUNK_METADATA_FILE_NAME),"w") as file:
-            json.dump({"chunks": self.chunk_metadata, "total_chunks": len(chunks)}, file, indent=2)
+            json.dump({"movie_ids": movie_ids, "chunk_offsets": chunk_offsets, "total_chunks": total_chunks}, file)
 
         return self.chunk_embeddings
 
     def load_or_create_chunk_embeddings(self, documents):
-        if not os.path.exists(os.path.join(CACHE_DIR, CHUNK_EMBEDDINGS_FILE_NAME)) and \
-            not os.path.exists(os.path.join(CACHE_DIR, CHUNK_METADATA_FILE_NAME)):
+        """like load_or_create_embeddings, for the chunk embeddings and their metadata"""
+        path = os.path.join(CACHE_DIR, CHUNK_EMBEDDINGS_FILE_NAME)
+        if not os.path.exists(os.path.join(CACHE_DIR, CHUNK_METADATA_FILE_NAME)) or \
+            not embeddings_fresh(path, self.model_name, source_fingerprint(documents), lambda: chunk_digest(documents)):
             return self.build_chunk_embeddings(documents)
         
-        self.documents = documents
-        for doc in self.documents:
-            self.document_map[doc["id"]] = doc
+        self._use_documents(documents)
 
-        with open(os.path.join(CACHE_DIR, CHUNK_EMBEDDINGS_FILE_NAME),"rb") as file:
-            self.chunk_embeddings = np.load(file)
+        self.chunk_embeddings = np.load(path, mmap_mode="r")
+        self.chunk_index = self._open_index(path)
 
         with open(os.path.join(CACHE_DIR, CHUNK_METADATA_FILE_NAME),"r") as file:
-            self.chunk_metadata = json.load(file)["chunks"]
+            self.chunk_movie_ids, self.chunk_offsets = chunk_ranges(json.load(file))
 
         return self.chunk_embeddings
     
-    def search_chunks(self, query, limit=10):
+    def search_chunks(self, query, limit=10, aggregation=DEFAULT_CHUNK_AGGREGATION):
+        """movies by the scores of their chunks combined with aggregation ("max", "mean" or "top2"):
+        the chunk scores are reduced per movie range in one pass, then the top movies are partially selected.
+        The other backends only score the chunks they find near the query (the probed IVF lists, at least
+        limit HNSW graph nodes or binary candidates), and only movies with such a chunk are ranked."""
         embedding = self.generate_embedding(query)
-        chunk_scores = []
-        for i in range(len(self.chunk_embeddings)):
-            chunk_scores_item = {}
-            chunk_scores_item["chunk_idx"] = self.chunk_metadata[i]["chunk_idx"]
-            chunk_scores_item["movie_idx"] = self.chunk_metadata[i]["movie_idx"]
-            chunk_scores_item["score"] = cosine_similarity(self.chunk_embeddings[i], embedding)
-            chunk_scores.append(chunk_scores_item)
-
-        idx_to_scores = {}
-        for chunk_score in chunk_scores:
-            try:
-                if idx_to_scores[chunk_score["movie_idx"]] < chunk_score["score"]:
-                    idx_to_scores[chunk_score["movie_idx"]] = chunk_score["score"]
-            except KeyError:
-                idx_to_scores[chunk_score["movie_idx"]] = chunk_score["score"]
-
-        idx_to_scores = dict(sorted(idx_to_scores.items(), key=lambda item: item[1], reverse=True))
-        idx_to_scores = dict(list(idx_to_scores.items())[:limit])
+        chunk_scores = self.chunk_index.scores(embedding) if self.backend == "flat" else None
+        return self._rank_movies(embedding, chunk_scores, limit, aggregation)
+
+    def search_chunks_many(self, queries, limit=10, aggregation=DEFAULT_CHUNK_AGGREGATION):
+        """search_chunks of every query: the queries are embedded QUERY_BATCH_SIZE at a time in one batch,
+        and with the flat backend the chunks are scored against the whole batch in one matrix-matrix product"""
+        results = []
+        for start in range(0, len(queries), QUERY_BATCH_SIZE):
+            embeddings = self.generate_embeddings(queries[start:start + QUERY_BATCH_SIZE])
+            if self.backend == "flat":
+                scores = self.chunk_index.scores_many(embeddings)
+            else:
+                scores = [None] * len(embeddings)
+            results.extend(
+                self._rank_movies(embedding, chunk_scores, limit, aggregation)
+                for embedding, chunk_scores in zip(embeddings, scores)
+            )
+        return results
+
+    def _rank_movies(self, embedding, chunk_scores, limit, aggregation):
+        """top movies of a query embedding, from the scores of every chunk (flat) or else from the chunks the index probes"""
+        if self.backend != "flat":
+            chunk_ids, chunk_scores = self.chunk_index.probe(embedding, limit)
+            movie_positions, chunk_offsets = chunk_groups(chunk_ids, self.chunk_offsets)
+        else:
+            if self.chunk_index.rescore:
+                # the best chunks of a quantized search get their float32 scores before they are aggregated
+                candidates, exact_scores = self.chunk_index.rescore_candidates(chunk_scores, embedding, self.chunk_index.rescore)
+                chunk_scores[candidates] = exact_scores
+            movie_positions, chunk_offsets = np.arange(len(self.chunk_movie_ids)), self.chunk_offsets
+        movie_scores = segment_reduce(chunk_scores, chunk_offsets, aggregation)
+        top_movies = top_k(movie_scores, limit)
 
         results = []
-        for i, idx_to_score in enumerate(idx_to_scores.items()):
-            movie_idx = idx_to_score[0]
+        for movie_idx, score in zip(self.chunk_movie_ids[movie_positions[top_movies]].tolist(), movie_scores[top_movies].tolist()):
             results.append(
                 {
                     "id": movie_idx,
                     "title": self.document_map[movie_idx]["title"],
                     "description": self.document_map[movie_idx]["description"][:100],
-                    "score": round(idx_to_score[1], 4),
+                    "score": round(score, 4),
                     "metadata": {}
                 }
             )
@@ -246,14 +368,14 @@ def cosine_similarity(vec1, vec2):
 
     return dot_product / (norm1 * norm2)
 
-def search(query, limit):
+def search(query, limit, precision=DEFAULT_EMBEDDING_PRECISION, rescore=0, backend=DEFAULT_VECTOR_BACKEND, nprobe=IVF_NPROBE, ef_search=HNSW_EF_SEARCH):
     # It should accept a positional query string argument.
     # Accept an optional --limit argument (default 5).
     # It should create a SemanticSearch instance.
     # Load movies and load/create embeddings.
     # Call the search method with the query and limit.
     # Print the results in this format:
-    semantic_search = SemanticSearch()
+    semantic_search = SemanticSearch(precision, rescore, backend, nprobe, ef_search)
     documents = get_documents(DATA_PATH)
 
     semantic_search.load_or_create_embeddings(documents)
@@ -265,18 +387,18 @@ def search(query, limit):
         print(f"{movie["description"][:100]}...")
         print("===========================")
 
-def search_chunked(query, limit):
+def search_chunked(query, limit, aggregation=DEFAULT_CHUNK_AGGREGATION, precision=DEFAULT_EMBEDDING_PRECISION, rescore=0, backend=DEFAULT_VECTOR_BACKEND, nprobe=IVF_NPROBE, ef_search=HNSW_EF_SEARCH):
     # Load the movie documents using load_movies().
     # Initialize a ChunkedSemanticSearch instance.
     # Load or create chunk embeddings.
     # Get the results using the search_chunks method with the given query and limit arguments.
     # Print results in the following format:
-    chunked_semantic_search = ChunkedSemanticSearch()
+    chunked_semantic_search = ChunkedSemanticSearch(precision, rescore, backend, nprobe, ef_search)
     documents = get_documents(DATA_PATH)
 
     chunked_semantic_search.load_or_create_chunk_embeddings(documents)
 
-    top_similarities = chunked_semantic_search.search_chunks(query, limit)
+    top_similarities = chunked_semantic_search.search_chunks(query, limit, aggregation)
 
     for i, movie in enumerate(top_similarities):
         print(f"\n{i + 1}. {movie["title"]} (score: {movie["score"]:.4f})")
@@ -294,6 +416,52 @@ def chunk(text, size, overlap):
     for i, chunk in enumerate(chunks):
         print(f"{i + 1}. {" ".join(chunk)}")
 
+def movie_text(doc):
+    return f"{doc['title']}: {doc['description']}"
+
+def document_chunks(doc):
+    """the chunks of a movie description that are embedded, none for an empty description"""
+    if doc["description"] == "":
+        return []
+    return semantic_chunk(doc["description"], 4, 1)
+
+def update_chunk_digest(digest, doc_id, doc_chunks):
+    update_digest(digest, str(doc_id))
+    for doc_chunk in doc_chunks:
+        update_digest(digest, doc_chunk)
+
+def movie_digest(documents):
+    """digest of the texts of the movie embeddings, as written to their manifest"""
+    digest = new_digest()
+    for doc in documents:
+        update_digest(digest, movie_text(doc))
+    return digest.hexdigest()
+
+def chunk_digest(documents):
+    """digest of the movie IDs and chunk texts of the chunk embeddings, as written to their manifest"""
+    digest = new_digest()
+    for doc in documents:
+        doc_chunks = document_chunks(doc)
+        if doc_chunks:
+            update_chunk_digest(digest, doc["id"], doc_chunks)
+    return digest.hexdigest()
+
+def chunk_groups(chunk_ids, chunk_offsets):
+    """(movie positions, offsets) grouping ascending chunk ids by movie: the chunks of movie
+    movie_positions[i] are chunk_ids[offsets[i]:offsets[i + 1]]"""
+    movies = np.searchsorted(chunk_offsets, chunk_ids, side="right") - 1
+    starts = np.flatnonzero(np.concatenate(([True], movies[1:] != movies[:-1]))) if len(movies) else np.zeros(0, dtype=np.int64)
+    return movies[starts], np.append(starts, len(movies)).astype(np.int64)
+
+def chunk_ranges(chunk_metadata):
+    """(movie IDs, chunk offsets) of a chunk metadata file; files written with one entry per chunk
+    are converted, their chunks are already grouped by movie"""
+    if "chunk_offsets" in chunk_metadata:
+        return np.array(chunk_metadata["movie_ids"], dtype=np.int64), np.array(chunk_metadata["chunk_offsets"], dtype=np.int64)
+    chunk_movie_ids = np.array([chunk["movie_idx"] for chunk in chunk_metadata["chunks"]], dtype=np.int64)
+    starts = np.flatnonzero(np.concatenate(([True], chunk_movie_ids[1:] != chunk_movie_ids[:-1]))) if len(chunk_movie_ids) else np.zeros(0, dtype=np.int64)
+    return chunk_movie_ids[starts], np.append(starts, len(chunk_movie_ids)).astype(np.int64)
+
 def semantic_chunk(text, max_size, overlap):
     # Strip leading and trailing whitespace from the input text before using the regex to split sentences.
     # If there's nothing left after stripping, return an empty list.
@@ -324,5 +492,5 @@ def semantic_chunk_print(chunks, text_len):
         print(f"{i + 1}. {chunk}")
 
 def get_documents(path):
-    with open(path, "r") as file:
-        return json.load(file)["movies"]
\ No newline at end of file
+    """the corpus as the shared, lazily read docstore"""
+    return get_docstore(path)
\ No newline at end of file
@@ -0,0 +1,121 @@
+import numpy as np
+
+from .search_utils import SPELL_NGRAM, SPELL_MAX_EDITS, SPELL_ONE_EDIT_LENGTH, SPELL_TWO_EDITS_LENGTH
+
+def ngrams(word, n=SPELL_NGRAM):
+    """distinct character n-grams of a word padded with n - 1 "$" on both sides"""
+    padded = "$" * (n - 1) + word + "$" * (n - 1)
+    return {padded[i:i + n] for i in range(len(padded) - n + 1)}
+
+def edit_distance(first, second, max_edits):
+    """optimal string alignment distance (insertions, deletions, substitutions and transpositions of
+    adjacent characters), or max_edits + 1 as soon as it is known to be larger than max_edits"""
+    if abs(len(first) - len(second)) > max_edits:
+        return max_edits + 1
+    previous = None
+    current = list(range(len(second) + 1))
+    for i in range(1, len(first) + 1):
+        before, previous, current = previous, current, [i] + [0] * len(second)
+        for j in range(1, len(second) + 1):
+            cost = first[i - 1] != second[j - 1]
+            current[j] = min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + cost)
+            if i > 1 and j > 1 and first[i - 1] == second[j - 2] and first[i - 2] == second[j - 1]:
+                current[j] = min(current[j], before[j - 2] + 1)
+        if min(current) > max_edits:
+            return max_edits + 1
+    return min(current[-1], max_edits + 1)
+
+def max_edits_for(word):
+    """edit budget of a word as typed (not its stem): short words get fewer edits, or every short term would be a candidate"""
+    if len(word) < SPELL_ONE_EDIT_LENGTH:
+        return 0
+    return 1 if len(word) < SPELL_TWO_EDITS_LENGTH else SPELL_MAX_EDITS
+
+class SpellIndex():
+    """typo-tolerant lookup over the indexed vocabulary. A character n-gram index narrows the
+    vocabulary to the terms sharing enough n-grams with the word (an edit changes only a few of them),
+    and only those are checked with a bounded edit distance. Candidates are ranked by distance,
+    then by document frequency. Corrections are written back as the surface form of the term: the word
+    of the corpus most often stemmed to it."""
+    def __init__(self, terms, dfs, surface_forms=None):
+        # vocabulary terms with their document frequencies and lengths, by term id
+        self.terms = terms
+        # stem -> most frequent word reduced to it, for the terms that have one
+        self.surface_forms = surface_forms or {}
+        self.term_ids = {term: i for i, term in enumerate(terms)}
+        self.dfs = np.asarray(dfs, dtype=np.int64)
+        self.lengths = np.array([len(term) for term in terms], dtype=np.int64)
+
+        # n-gram -> term ids containing it, stored back to back and sliced by per-gram offsets
+        gram_terms = {}
+        for term_id, term in enumerate(terms):
+            for gram in ngrams(term):
+                gram_terms.setdefault(gram, []).append(term_id)
+        self.gram_ids = {gram: i for i, gram in enumerate(gram_terms)}
+        self.gram_offsets = np.concatenate(([0], np.cumsum([len(term_ids) for term_ids in gram_terms.values()]))).astype(np.int64)
+        self.gram_term_ids = np.fromiter(
+            (term_id for term_ids in gram_terms.values() for term_id in term_ids),
+            dtype=np.int32,
+            count=int(self.gram_offsets[-1])
+        )
+
+    @classmethod
+    def from_postings(cls, postings, surface_forms=None):
+        """vocabulary of in-memory postings or of a SegmentSet, without terms whose every posting is deleted"""
+        dfs = postings.dfs()
+        keep = np.flatnonzero(dfs > 0)
+        return cls([postings.terms[i] for i in keep.tolist()], dfs[keep], surface_forms)
+
+    def __contains__(self, term):
+        return term in self.term_ids
+
+    def lookup(self, word, max_edits=None, limit=5):
+        """(term, edit distance, df) of the vocabulary terms within max_edits of word, best first;
+        max_edits defaults to max_edits_for(word)"""
+        if max_edits is None:
+            max_edits = max_edits_for(word)
+        grams = [self.gram_ids[gram] for gram in ngrams(word) if gram in self.gram_ids]
+        if not grams:
+            return []
+
+        term_ids = np.concatenate([self.gram_term_ids[self.gram_offsets[gram]:self.gram_offsets[gram + 1]] for gram in grams])
+        shared = np.bincount(term_ids, minlength=len(self.terms))
+        # q-gram lemma: an edit destroys at most SPELL_NGRAM of the word's n-grams, a transposition SPELL_NGRAM + 1
+        min_shared = max(1, len(ngrams(word)) - (SPELL_NGRAM + 1) * max_edits)
+        candidates = np.flatnonzero((shared >= min_shared) & (np.abs(self.lengths - len(word)) <= max_edits))
+
+        matches = []
+        for term_id in candidates.tolist():
+            distance = edit_distance(word, self.terms[term_id], max_edits)
+            if distance <= max_edits:
+                matches.append((self.terms[term_id], distance, int(self.dfs[term_id])))
+        matches.sort(key=lambda match: (match[1], -match[2], match[0]))
+        return matches[:limit]
+
+    def surface_form(self, term):
+        return self.surface_forms.get(term, term)
+
+    def correct(self, token, max_edits=None):
+        """the indexed token itself, else its best vocabulary match within max_edits, else None"""
+        if token in self:
+            return token
+        matches = self.lookup(token, max_edits, limit=1)
+        return matches[0][0] if matches else None
+
+    def correct_query(self, query, analyzer):
+        """query text with every word whose tokens are not indexed replaced by the surface forms of the
+        closest vocabulary terms; indexed words, words without a close term, stopwords and punctuation
+        are left as they are"""
+        words = []
+        for word in query.split():
+            tokens = analyzer.tokenize(word)
+            if all(token in self for token in tokens):
+                words.append(word)
+                continue
+            max_edits = max_edits_for(word.lower().translate(analyzer.translator))
+            corrections = [self.correct(token, max_edits) for token in tokens]
+            if any(correction is None for correction in corrections):
+                words.append(word)
+            else:
+                words.append(" ".join(self.surface_form(correction) for correction in corrections))
+        return " ".join(words)
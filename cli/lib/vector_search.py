@@ -0,0 +1,126 @@
+import numpy as np
+
+from .search_utils import VECTOR_BLOCK_ROWS
+
+# how the chunk scores of a document are combined into the document's score
+SEGMENT_AGGREGATIONS = ("max", "mean", "top2")
+
+def normalize_rows(vectors):
+    """float32 copy of the vectors scaled to unit L2 norm; zero vectors stay zero"""
+    vectors = np.asarray(vectors, dtype=np.float32)
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    return np.divide(vectors, norms, out=np.zeros_like(vectors), where=norms > 0)
+
+def top_k(scores, k):
+    """indices of the k highest scores, best first and ties in index order, without sorting every score"""
+    k = min(max(k, 0), len(scores))
+    if k == 0:
+        return np.zeros(0, dtype=np.int64)
+    if k < len(scores):
+        kth_score = np.partition(scores, len(scores) - k)[len(scores) - k]
+        # everything tying with the k-th score is kept, so ties are resolved by index below
+        candidates = np.flatnonzero(scores >= kth_score)
+    else:
+        candidates = np.arange(len(scores))
+    order = np.lexsort((candidates, -scores[candidates]))[:k]
+    return candidates[order]
+
+def segment_reduce(values, offsets, method="max"):
+    """one value per segment values[offsets[i]:offsets[i + 1]] (every segment non-empty):
+    its max, its mean, or the sum of its two largest values ("top2")"""
+    starts = offsets[:-1]
+    if len(starts) == 0:
+        return np.zeros(0)
+    match method:
+        case "max":
+            return np.maximum.reduceat(values, starts)
+        case "mean":
+            return np.add.reduceat(values, starts, dtype=np.float64) / np.diff(offsets)
+        case "top2":
+            lengths = np.diff(offsets)
+            segments = np.repeat(np.arange(len(starts)), lengths)
+            # values sorted descending inside every segment; the segments keep their place
+            order = np.lexsort((-values, segments))
+            rank = np.arange(len(values)) - np.repeat(starts, lengths)
+            best = order[rank < 2]
+            return np.bincount(segments[best], weights=values[best], minlength=len(starts))
+        case _:
+            raise ValueError(f"unknown aggregation: {method}")
+
+def inverse_norms(vectors, dim_scale=None):
+    """1 / L2 norm of every vector (0 for zero vectors), read block by block;
+    dim_scale dequantizes int8 vectors first"""
+    result = np.zeros(len(vectors), dtype=np.float32)
+    for start in range(0, len(vectors), VECTOR_BLOCK_ROWS):
+        block = vectors[start:start + VECTOR_BLOCK_ROWS].astype(np.float32)
+        if dim_scale is not None:
+            block *= dim_scale
+        norms = np.linalg.norm(block, axis=1)
+        np.divide(1.0, norms, out=result[start:start + len(block)], where=norms > 0)
+    return result
+
+class FlatIndex():
+    """exact cosine search over vectors as they are stored: float32, float16 or per-dimension scaled int8,
+    possibly memory-mapped. Every vector's inverse norm is computed once, so the scores of a query are
+    one matrix-vector product (a matrix-matrix product for a batch of queries), done VECTOR_BLOCK_ROWS
+    rows at a time so the matrix is never copied whole. With exact float32 vectors and rescore > 0,
+    the best rescore candidates are scored again against the exact vectors."""
+    def __init__(self, vectors, dim_scale=None, exact=None, rescore=0, row_scale=None):
+        self.vectors = vectors
+        # per-dimension dequantization scale of int8 vectors, None otherwise
+        self.dim_scale = dim_scale
+        # 1 / norm of every stored vector: saved ones (see embedding_store.write_norms), else computed from every row
+        self.row_scale = row_scale if row_scale is not None else inverse_norms(vectors, dim_scale)
+        # the float32 vectors the stored ones were quantized from, and how many candidates to rescore with them
+        self.exact = exact
+        self.rescore = rescore if exact is not None else 0
+
+    def __len__(self):
+        return len(self.vectors)
+
+    def nbytes(self):
+        """bytes of the stored vectors and scales (resident once the vectors are paged in)"""
+        nbytes = self.vectors.nbytes + self.row_scale.nbytes
+        if self.dim_scale is not None:
+            nbytes += self.dim_scale.nbytes
+        return nbytes
+
+    def __prepare(self, queries):
+        queries = normalize_rows(queries)
+        return queries * self.dim_scale if self.dim_scale is not None else queries
+
+    def scores(self, query):
+        """cosine similarity of the query with every vector"""
+        return self.scores_many(query[np.newaxis])[0]
+
+    def scores_many(self, queries):
+        """(number of queries x number of vectors) cosine similarities"""
+        queries = self.__prepare(queries)
+        scores = np.empty((len(queries), len(self.vectors)), dtype=np.float32)
+        for start in range(0, len(self.vectors), VECTOR_BLOCK_ROWS):
+            block = self.vectors[start:start + VECTOR_BLOCK_ROWS]
+            scores[:, start:start + len(block)] = queries @ block.astype(np.float32).T
+        return scores * self.row_scale
+
+    def search(self, query, k):
+        """(ids, scores) of the k most similar vectors, best first"""
+        return self.__top(self.scores(query), query, k)
+
+    def search_many(self, queries, k):
+        return [self.__top(scores, query, k) for scores, query in zip(self.scores_many(queries), queries)]
+
+    def rescore_candidates(self, scores, query, k):
+        """(ids, exact scores) of the k best scored vectors, ids ascending; the ids alone when there are no exact vectors"""
+        # sorted candidates read the exact (possibly memory-mapped) vectors in file order
+        candidates = np.sort(top_k(scores, k))
+        if self.exact is None:
+            return candidates, scores[candidates]
+        return candidates, normalize_rows(self.exact[candidates]) @ normalize_rows(query)
+
+    def __top(self, scores, query, k):
+        if not self.rescore:
+            ids = top_k(scores, k)
+            return ids, scores[ids]
+        candidates, exact_scores = self.rescore_candidates(scores, query, max(k, self.rescore))
+        best = top_k(exact_scores, k)
+        return candidates[best], exact_scores[best]
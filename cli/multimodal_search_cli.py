@@ -1,6 +1,6 @@
 import argparse
 
-from lib.multimodal_search import verify_image_embedding, image_search_command
+from lib.multimodal_search import verify_image_embedding, image_search_command, text_search_command
 
 def main():
     parser = argparse.ArgumentParser(description="Multimodal Search CLI")
@@ -12,14 +12,20 @@ def main():
     image_search_parser = subparsers.add_parser("image_search", help="Search image through documents")
     image_search_parser.add_argument("image_path", type=str, help="Path to an image to be searched for")
 
+    text_search_parser = subparsers.add_parser("text_search", help="Search documents with a text query embedded by the image model")
+    text_search_parser.add_argument("query", type=str, help="Search query")
+
     args = parser.parse_args()
 
     match args.command:
         case "verify_image_embedding":
             verify_image_embedding(args.image_path)
 
-        case "image_search":
-            found_docs = image_search_command(args.image_path)
+        case "image_search" | "text_search":
+            if args.command == "image_search":
+                found_docs = image_search_command(args.image_path)
+            else:
+                found_docs = text_search_command(args.query)
 
             for i in range(len(found_docs)):
                 title = found_docs[i]["title"]
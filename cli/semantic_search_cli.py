@@ -19,8 +19,16 @@ from lib.search_utils import (
     DEFAULT_SEARCH_LIMIT,
     DEFAULT_CHUNK_SIZE,
     DEFAULT_CHUNK_OVERLAP,
-    DEFAULT_MAX_CHUNK_SIZE
+    DEFAULT_MAX_CHUNK_SIZE,
+    DEFAULT_CHUNK_AGGREGATION,
+    DEFAULT_EMBEDDING_PRECISION,
+    DEFAULT_VECTOR_BACKEND,
+    IVF_NPROBE,
+    HNSW_EF_SEARCH
 )
+from lib.embedding_store import EMBEDDING_PRECISIONS
+from lib.semantic_search import VECTOR_BACKENDS
+from lib.vector_search import SEGMENT_AGGREGATIONS
 
 def main():
     parser = argparse.ArgumentParser(description="Semantic Search CLI")
@@ -39,6 +47,11 @@ def main():
     search_parser = subparsers.add_parser("search", help="Search movies semantically")
     search_parser.add_argument("query", type=str, help="Search query")
     search_parser.add_argument("--limit", type=int, default=DEFAULT_SEARCH_LIMIT, help="How many top documents should be shown")
+    search_parser.add_argument("--precision", type=str, choices=EMBEDDING_PRECISIONS, default=DEFAULT_EMBEDDING_PRECISION, help="Precision the embeddings are searched in")
+    search_parser.add_argument("--rescore", type=int, default=0, help="How many top candidates of a quantized or binary search are rescored with float32 embeddings")
+    search_parser.add_argument("--backend", type=str, choices=VECTOR_BACKENDS, default=DEFAULT_VECTOR_BACKEND, help="Scan every embedding, only the probed lists of an IVF index, walk an HNSW graph, or prefilter by Hamming distance of sign bits")
+    search_parser.add_argument("--nprobe", type=int, default=IVF_NPROBE, help="How many IVF lists are scanned per query")
+    search_parser.add_argument("--ef-search", type=int, default=HNSW_EF_SEARCH, help="How many candidates an HNSW search keeps")
 
     chunk_parser = subparsers.add_parser("chunk", help="Chunk text")
     chunk_parser.add_argument("text", type=str, help="Text to chunk")
@@ -55,6 +68,12 @@ def main():
     search_chunked_parser = subparsers.add_parser("search_chunked", help="Search chunks semantically")
     search_chunked_parser.add_argument("query", type=str, help="Search query")
     search_chunked_parser.add_argument("--limit", type=int, default=DEFAULT_SEARCH_LIMIT, help="How many top documents should be shown")
+    search_chunked_parser.add_argument("--aggregation", type=str, choices=SEGMENT_AGGREGATIONS, default=DEFAULT_CHUNK_AGGREGATION, help="How a movie's chunk scores are combined: best chunk, mean, or sum of the best two")
+    search_chunked_parser.add_argument("--precision", type=str, choices=EMBEDDING_PRECISIONS, default=DEFAULT_EMBEDDING_PRECISION, help="Precision the chunk embeddings are searched in")
+    search_chunked_parser.add_argument("--rescore", type=int, default=0, help="How many top chunks of a quantized or binary search are rescored with float32 embeddings")
+    search_chunked_parser.add_argument("--backend", type=str, choices=VECTOR_BACKENDS, default=DEFAULT_VECTOR_BACKEND, help="Scan every chunk embedding, only the probed lists of an IVF index, walk an HNSW graph, or prefilter by Hamming distance of sign bits")
+    search_chunked_parser.add_argument("--nprobe", type=int, default=IVF_NPROBE, help="How many IVF lists are scanned per query")
+    search_chunked_parser.add_argument("--ef-search", type=int, default=HNSW_EF_SEARCH, help="How many candidates an HNSW search keeps")
 
     args = parser.parse_args()
 
@@ -68,7 +87,7 @@ def main():
         case "embedquery":
             embed_query_text(args.query)
         case "search":
-            search(args.query, args.limit)
+            search(args.query, args.limit, args.precision, args.rescore, args.backend, args.nprobe, args.ef_search)
         case "chunk":
             chunk(args.text, args.chunk_size, args.overlap)
         case "semantic_chunk":
@@ -77,7 +96,7 @@ def main():
         case "embed_chunks":
             embed_chunks()
         case "search_chunked":
-            search_chunked(args.query, args.limit)
+            search_chunked(args.query, args.limit, args.aggregation, args.precision, args.rescore, args.backend, args.nprobe, args.ef_search)
         case _:
             parser.print_help()
 